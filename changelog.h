@@ -8,7 +8,8 @@
 // Vers   When      Who      What
 //---------------------------------------------------------------------------------------------------------
 // 1000  05-Jan-22  DWW      Initial creation
+// 1001  17-Oct-26  DWW      SP_BATCH: several packets under one CRC and one ACK, negotiated by the client
 //=========================================================================================================
-#define FW_VERSION "1000"
+#define FW_VERSION "1001"
 
 #endif
\ No newline at end of file
@@ -54,6 +54,14 @@ struct to_radio_t
     uint16_t dst_node;
     uint8_t  payload[0];
 };
+
+struct batched_to_radio_t
+{
+    uint8_t  sub_len;
+    uint8_t  packet_type;
+    uint16_t dst_node;
+    uint8_t  payload[0];
+};
 //=========================================================================================================
 
 
@@ -130,6 +138,24 @@ void handle_encrypt_key(const unsigned char* raw)
 //=========================================================================================================
 
 
+//=========================================================================================================
+// send_to_radio() - Sends a message to a node
+//=========================================================================================================
+void send_to_radio(uint16_t dst_node, const uint8_t* payload, uint8_t payload_len)
+{
+    // Make sure the radio is initialized before trying to send a message
+    if (!is_radio_initialized)
+    {
+        UART.printf("Radio not initialized!");
+        return;
+    }
+
+    // Ask the radio to send this message
+    Radio.send(dst_node, payload, payload_len);
+}
+//=========================================================================================================
+
+
 //=========================================================================================================
 // handle_to_radio() - Sends a packet to the radio
 //=========================================================================================================
@@ -138,18 +164,55 @@ void handle_to_radio(const unsigned char* raw)
     // Map our structure on top of the raw packet
     map_struct(to_radio_t, msg);
 
-    // Make sure the radio is initialized before trying to send a message
-    if (!is_radio_initialized)
+    // Figure out how many bytes of message data there are, and send them
+    send_to_radio(msg.dst_node, msg.payload, msg.packet_len - sizeof(msg));
+}
+//=========================================================================================================
+
+
+//=========================================================================================================
+// handle_batch() - Sends every packet in a batch to the radio.  An empty batch is the client asking
+//                  whether we do batches: we say yes by sending it back, and start batching
+//=========================================================================================================
+void handle_batch(const unsigned char* raw)
+{
+    // Map our structure on top of the raw packet
+    map_struct(packet_header_t, batch);
+
+    // If the batch is empty, agree to batching
+    if (batch.packet_len == sizeof(batch))
     {
-        UART.printf("Radio not initialized!");
+        UART.transmit(raw);
+        UART.enable_batching();
         return;
     }
 
-    // Figure out how many bytes of message data there are
-    uint8_t payload_len = msg.packet_len - sizeof(msg);
+    // Point to the first sub-packet and to the end of the batch
+    const unsigned char* p   = raw + sizeof(batch);
+    const unsigned char* end = raw + batch.packet_len;
 
-    // Ask the radio to send this message
-    Radio.send(msg.dst_node, msg.payload, payload_len);
+    // Loop through each sub-packet in the batch
+    while (p < end)
+    {
+        // Map a sub-packet structure on top of this sub-packet
+        const batched_to_radio_t& msg = *(const batched_to_radio_t*)p;
+
+        // A sub-packet that's too short or runs off the end means the rest of the batch is garbage
+        if (msg.sub_len < sizeof(sub_header_t) || p + msg.sub_len > end)
+        {
+            UART.printf("Bad batch");
+            return;
+        }
+
+        // Send this sub-packet to the radio
+        if (msg.packet_type == SP_TO_RADIO && msg.sub_len >= sizeof(msg))
+            send_to_radio(msg.dst_node, msg.payload, msg.sub_len - sizeof(msg));
+        else
+            UART.printf("Recvd unknown batched packet type %i", msg.packet_type);
+
+        // Point to the next sub-packet
+        p += msg.sub_len;
+    }
 }
 //=========================================================================================================
 
@@ -181,6 +244,10 @@ void dispatch_serial_message(const unsigned char* raw)
             handle_to_radio(raw);
             break;
 
+        case SP_BATCH:
+            handle_batch(raw);
+            break;
+
         default:
             UART.printf("Recvd unknown packet type %i", packet.packet_type);
             break;
@@ -191,7 +258,8 @@ void dispatch_serial_message(const unsigned char* raw)
 
 
 //=========================================================================================================
-// handle_incoming_radio_packet() - Sends an incoming packet to the client
+// handle_incoming_radio_packet() - Sends an incoming packet to the client, batched if the client
+//                                  asked for batches
 //=========================================================================================================
 void handle_incoming_radio_packet()
 {
@@ -204,7 +272,7 @@ void handle_incoming_radio_packet()
     packet.dst_node    =   Radio.TARGETID;
     packet.rssi        =   Radio.RSSI;
     memcpy(packet.payload, Radio.DATA, Radio.DATALEN);
-    UART.transmit(raw);
+    UART.queue(raw);
 }
 //=========================================================================================================
 
@@ -226,5 +294,7 @@ void loop()
     {
         handle_incoming_radio_packet();
     }
+
+    UART.service_batch();
 }
 //========================================================================================================= 
@@ -89,6 +89,16 @@ static const packet_header_t NAK = {PACKET_HEADER_SIZE, 0, SP_NAK};
 //=========================================================================================================
 
 
+//=========================================================================================================
+// The outgoing batch.  Packets are held for at most BATCH_HOLD_MS before the batch is sent
+//=========================================================================================================
+const int BATCH_HOLD_MS = 2;
+static unsigned char  tx_batch[255];
+static unsigned char& tx_batch_len = tx_batch[0];
+static unsigned long  tx_batch_start;
+//=========================================================================================================
+
+
 //=========================================================================================================
 // xUSART_RX_vect() - The interrupt service routine to store incoming serial characters
 //=========================================================================================================
@@ -141,6 +151,70 @@ void CPacketUART::transmit(const packet_header_t& ph) {transmit(&ph);}
 //=========================================================================================================
 
 
+//=========================================================================================================
+// queue() - Sends a packet to the client, or adds it to the outgoing batch if batching is enabled
+//=========================================================================================================
+void CPacketUART::queue(const void* vp)
+{
+    // If the client hasn't asked for batches, just send the packet
+    if (!batching)
+    {
+        transmit(vp);
+        return;
+    }
+
+    // Map a packet-header over the packet
+    const packet_header_t& packet_header = *(const packet_header_t*)vp;
+
+    // A sub-packet is the packet without its length byte and CRC, behind a sub-header
+    unsigned char sub_len = packet_header.packet_len - PACKET_HEADER_SIZE + sizeof(sub_header_t);
+
+    // If this packet won't fit in the batch, send the batch first
+    if (tx_batch_len + sub_len > sizeof(tx_batch)) flush_batch();
+
+    // If the batch is empty, start a new one
+    if (tx_batch_len == 0)
+    {
+        tx_batch_len   = PACKET_HEADER_SIZE;
+        tx_batch_start = millis();
+    }
+
+    // Append the sub-header, then the packet type and body
+    tx_batch[tx_batch_len] = sub_len;
+    memcpy(tx_batch + tx_batch_len + 1, (const unsigned char*)vp + CRC_START, sub_len - 1);
+    tx_batch_len += sub_len;
+}
+//=========================================================================================================
+
+
+//=========================================================================================================
+// service_batch() - Sends the outgoing batch once it has been held for BATCH_HOLD_MS
+//=========================================================================================================
+void CPacketUART::service_batch()
+{
+    if (tx_batch_len && millis() - tx_batch_start >= BATCH_HOLD_MS) flush_batch();
+}
+//=========================================================================================================
+
+
+//=========================================================================================================
+// flush_batch() - Sends the outgoing batch, if there is one
+//=========================================================================================================
+void CPacketUART::flush_batch()
+{
+    // If there's nothing in the batch, there's nothing to do
+    if (tx_batch_len == 0) return;
+
+    // Fill in the packet type.  transmit() stamps the CRC
+    ((packet_header_t*)tx_batch)->packet_type = SP_BATCH;
+    transmit(tx_batch);
+
+    // The batch is now empty
+    tx_batch_len = 0;
+}
+//=========================================================================================================
+
+
 
 //=========================================================================================================
 // begin() - Sets of the UART configuration, enables the interrupts, and sends a "ready to receive" msg
@@ -172,6 +246,10 @@ void CPacketUART::begin(uint32_t baud)
 
     // Make the RX machinery ready to receive a packet
     make_ready_to_receive();
+
+    // We don't batch until the client asks us to
+    batching = false;
+    tx_batch_len = 0;
     
     // Tell the backhaulthat we're alive
     indicate_alive();
@@ -14,7 +14,8 @@ enum
     SP_ENCRYPT_KEY = 0x06,  // From client
     SP_FROM_RADIO  = 0x07,  // To client
     SP_TO_RADIO    = 0x08,  // From client
-    SP_NAK         = 0x09   // To client
+    SP_NAK         = 0x09,  // To client
+    SP_BATCH       = 0x0A   // To and From client
 };
 
 
@@ -25,6 +26,22 @@ struct packet_header_t
     uint8_t   packet_type;
 };
 
+//=========================================================================================================
+// An SP_BATCH packet carries several packets under one header, one CRC and one ACK.  After the
+// packet header come sub-packets, each of which is a sub_header_t followed by the body of an ordinary
+// packet of that type (everything after its packet_type).  sub_len counts the sub_header_t.
+//
+// An SP_BATCH with no sub-packets asks whether batching is supported.  The gateway answers by
+// sending it back, and from then on batches its SP_FROM_RADIO packets.  Firmware that doesn't know
+// SP_BATCH answers with a "Recvd unknown packet type" message instead, and the client keeps sending
+// single packets.
+//=========================================================================================================
+struct sub_header_t
+{
+    uint8_t   sub_len;
+    uint8_t   packet_type;
+};
+
 
 class CPacketUART
 {
@@ -48,6 +65,15 @@ public:
     // Send a raw packet to the client
     void    transmit(const void* vp);
 
+    // Start batching the packets passed to "queue()"
+    void    enable_batching() {batching = true;}
+
+    // Send a packet to the client, in a batch if batching is enabled
+    void    queue(const void* vp);
+
+    // Call this from the main loop so a batch is never held for long
+    void    service_batch();
+
 protected:
 
     // The state machine that manages the receipt of incoming serial packets
@@ -59,6 +85,12 @@ protected:
     // A wrapper for "transmit(void*)"
     void    transmit(const packet_header_t& packet);
 
+    // Sends the batch being assembled, if there is one
+    void    flush_batch();
+
+    // True once the client has asked for batched packets
+    bool    batching;
+
 };
 
 
@@ -0,0 +1,235 @@
+# ==========================================================================================================
+# aggregator.py - Reduces each node's telemetry to one summary point per time window
+# ==========================================================================================================
+import array
+import math
+import time
+import metrics
+
+SAMPLES    = metrics.counter('moteino_aggregated_samples_total', 'Telemetry points folded into window aggregates')
+AGGREGATES = metrics.counter('moteino_aggregate_points_total', 'Window aggregate points emitted')
+
+
+# ==========================================================================================================
+# WindowAggregator - Keeps a running min, max, mean, count and last value of every numeric field for
+#                    every node, and emits one point per node per window
+#
+# Windows are aligned to the wall clock, so with a 60-second window every node's aggregates cover
+# whole minutes.  Each statistic is a flat array indexed by node ID, exactly like LatestCache, so
+# the memory used depends only on the highest node ID, never on how many packets arrive, and adding
+# a sample is a handful of array stores.  A node's window is emitted when its first sample of the
+# next window arrives, or by flush_due() once the window is over if the node has gone quiet.
+#
+# An aggregate point looks like:
+#
+#     {'measurement': 'node_data_aggregate', 'tags': {'node_id': 12, 'window': '60s'},
+#      'time': <start of the window, in ns>,
+#      'fields': {'temperature_min': 22.5, 'temperature_max': 22.9, 'temperature_mean': 22.71,
+#                 'temperature_last': 22.8, 'temperature_count': 6, ...}}
+#
+# Fields named in "raw_fields" are also passed through in the original points, so anything that
+# needs every sample still gets it.
+#
+# An aggregator belongs to one thread: the ingest loop.
+# ==========================================================================================================
+class WindowAggregator:
+
+    SWEEP_INTERVAL = 1.0   # Most often flush_due() looks for windows that have ended
+
+    fields      = None  # Tuple of field names that are aggregated
+    raw_fields  = None  # Frozenset of field names that are also written as raw points
+    window      = 0     # Window length in seconds
+    measurement = None  # Measurement the aggregate points are written to
+    columns     = None  # Dictionary of field name -> (count, min, max, sum, last) arrays
+    windows     = None  # array of the window number each node's statistics belong to, -1 = none
+    capacity    = 0     # Number of node slots currently allocated
+    highest     = -1    # Highest node ID with an open window
+    next_sweep  = 0     # When flush_due() next looks for windows that have ended
+
+    # Counters
+    samples     = 0     # Points folded in
+    emitted     = 0     # Aggregate points emitted
+
+    # ------------------------------------------------------------------------------
+    # Constructor - Allocates room for "capacity" nodes
+    # ------------------------------------------------------------------------------
+    def __init__(self, fields, window = 60.0, raw_fields = (), measurement = 'node_data_aggregate',
+                 capacity = 1024):
+        self.fields      = tuple(fields)
+        self.raw_fields  = frozenset(raw_fields)
+        self.window      = window
+        self.measurement = measurement
+        self.columns     = {name: (array.array('I'), array.array('d'), array.array('d'),
+                                   array.array('d'), array.array('d')) for name in self.fields}
+        self.windows     = array.array('q')
+        self.grow(capacity)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # add_points() - Folds a list of telemetry points into the aggregates
+    #
+    # Returns: The points to upload instead: raw points trimmed to "raw_fields", and
+    #          the aggregate points of any windows that have ended
+    # ------------------------------------------------------------------------------
+    def add_points(self, points, timestamp = None):
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        output = []
+        for point in points:
+
+            fields = point['fields']
+            output += self.add(point['tags']['node_id'], fields, timestamp)
+
+            # pass through the fields that are wanted raw, with the original tags
+            if self.raw_fields:
+                raw = {name: value for name, value in fields.items() if name in self.raw_fields}
+                if raw:
+                    point['fields'] = raw
+                    output.append(point)
+
+        SAMPLES.inc(len(points))
+        return output + self.flush_due(timestamp)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # add() - Folds one node's measurements into its current window
+    #
+    # Returns: A list holding the aggregate point of the node's previous window if
+    #          this sample starts a new one, otherwise an empty list
+    # ------------------------------------------------------------------------------
+    def add(self, node_id, measurements, timestamp):
+
+        if node_id >= self.capacity:
+            self.grow(max(node_id + 1, self.capacity * 2))
+
+        finished = []
+        window = int(timestamp // self.window)
+        if self.windows[node_id] != window:
+            if self.windows[node_id] >= 0:
+                finished = self.emit(node_id)
+            self.windows[node_id] = window
+            self.highest = max(self.highest, node_id)
+
+        for name, value in measurements.items():
+
+            columns = self.columns.get(name)
+            if columns is None or value is None:
+                continue
+
+            count, minimum, maximum, total, last = columns
+            if count[node_id]:
+                if value < minimum[node_id]:
+                    minimum[node_id] = value
+                if value > maximum[node_id]:
+                    maximum[node_id] = value
+                total[node_id] += value
+            else:
+                minimum[node_id] = maximum[node_id] = total[node_id] = value
+            last[node_id] = value
+            count[node_id] += 1
+
+        self.samples += 1
+        return finished
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # flush_due() - Emits the windows that have ended for nodes that have gone quiet.
+    #               Cheap to call on every burst; it only looks once a second
+    # ------------------------------------------------------------------------------
+    def flush_due(self, timestamp = None):
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        if timestamp < self.next_sweep:
+            return []
+        self.next_sweep = timestamp + self.SWEEP_INTERVAL
+
+        current = int(timestamp // self.window)
+        finished = []
+        windows = self.windows
+        for node_id in range(self.highest + 1):
+            if 0 <= windows[node_id] < current:
+                finished += self.emit(node_id)
+
+        return finished
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # flush_all() - Emits every open window, finished or not.  Call at shutdown
+    # ------------------------------------------------------------------------------
+    def flush_all(self):
+
+        finished = []
+        for node_id in range(self.highest + 1):
+            if self.windows[node_id] >= 0:
+                finished += self.emit(node_id)
+
+        return finished
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # stats() - Returns the counters as a dictionary
+    # ------------------------------------------------------------------------------
+    def stats(self):
+        return {'samples': self.samples, 'emitted': self.emitted,
+                'open': sum(1 for node_id in range(self.highest + 1) if self.windows[node_id] >= 0)}
+    # ------------------------------------------------------------------------------
+
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # From here on down are methods that are private to this class
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+
+    # ------------------------------------------------------------------------------
+    # emit() - Builds the aggregate point for a node's window and resets the node
+    #
+    # Returns: A list holding the point, or an empty list if the window held
+    #          nothing we aggregate
+    # ------------------------------------------------------------------------------
+    def emit(self, node_id):
+
+        fields = {}
+        for name, (count, minimum, maximum, total, last) in self.columns.items():
+            n = count[node_id]
+            if n:
+                fields[name + '_min']   = minimum[node_id]
+                fields[name + '_max']   = maximum[node_id]
+                fields[name + '_mean']  = total[node_id] / n
+                fields[name + '_last']  = last[node_id]
+                fields[name + '_count'] = n
+                count[node_id] = 0
+
+        start = self.windows[node_id] * self.window
+        self.windows[node_id] = -1
+
+        if not fields:
+            return []
+
+        self.emitted += 1
+        AGGREGATES.inc()
+        return [{
+            'measurement' : self.measurement,
+            'tags'        : {'node_id': node_id, 'window': f'{self.window:g}s'},
+            'time'        : int(start * 1000000000),
+            'fields'      : fields
+        }]
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # grow() - Extends every array to hold "capacity" nodes
+    # ------------------------------------------------------------------------------
+    def grow(self, capacity):
+        extra = capacity - self.capacity
+        for count, minimum, maximum, total, last in self.columns.values():
+            count.extend([0] * extra)
+            for column in (minimum, maximum, total, last):
+                column.extend([math.nan] * extra)
+        self.windows.extend([-1] * extra)
+        self.capacity = capacity
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
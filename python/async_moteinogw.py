@@ -0,0 +1,305 @@
+# ==========================================================================================================
+# async_moteinogw.py - An asyncio client for the Moteino gateway
+#
+# This speaks exactly the same serial protocol as moteinogw.MoteinoGateway, but instead of a reader
+# thread and a loopback socket, the serial port's file descriptor is registered with the event loop
+# and incoming packets are handed to coroutines through an asyncio.Queue.
+# ==========================================================================================================
+import asyncio
+import struct
+import time
+import serial
+from moteinogw import MoteinoGateway, BadPacket, decode_packet, fast_crc16, ACK_RTT, ACK_FAILURES
+from framer import StreamFramer
+from rtt import RttEstimator
+
+
+# ==========================================================================================================
+# AsyncMoteinoGateway - Manages communications with the Moteino gateway from an asyncio event loop
+#
+#     gw = AsyncMoteinoGateway()
+#     await gw.startup('/dev/ttyUSB0')
+#     async for packet in gw:
+#         ...
+# ==========================================================================================================
+class AsyncMoteinoGateway:
+
+    comport    = None  # A PySerial object, opened non-blocking
+    loop       = None  # The event loop the serial port is registered with
+    queue      = None  # An asyncio.Queue of incoming packets
+    framer     = None  # The StreamFramer that splits serial data into packets
+    stall_timer = None # Fires if the line goes quiet in the middle of a packet
+    tx_lock    = None  # Only one packet may be in flight to the gateway at a time
+    ack_waiter = None  # The future waiting for the next ACK or NAK
+    stray_acks = 0     # ACKs/NAKs that arrived when nothing was waiting for one
+    prologue_rtt = None # RttEstimator of how long the gateway takes to ACK a prologue
+    frame_rtt    = None # RttEstimator of how long it takes to handle and ACK a frame
+
+    SP_PRINT       = MoteinoGateway.SP_PRINT
+    SP_READY       = MoteinoGateway.SP_READY
+    SP_ECHO        = MoteinoGateway.SP_ECHO
+    SP_ALIVE       = MoteinoGateway.SP_ALIVE
+    SP_INIT_RADIO  = MoteinoGateway.SP_INIT_RADIO
+    SP_ENCRYPT_KEY = MoteinoGateway.SP_ENCRYPT_KEY
+    SP_FROM_RADIO  = MoteinoGateway.SP_FROM_RADIO
+    SP_TO_RADIO    = MoteinoGateway.SP_TO_RADIO
+    SP_NAK         = MoteinoGateway.SP_NAK
+
+    # ------------------------------------------------------------------------------
+    # startup() - Opens the serial port and registers it with the running loop
+    # ------------------------------------------------------------------------------
+    async def startup(self, port):
+
+        self.loop      = asyncio.get_running_loop()
+        self.queue     = asyncio.Queue()
+        self.framer    = StreamFramer(self.on_discard)
+        self.tx_lock   = asyncio.Lock()
+        self.prologue_rtt = RttEstimator()
+        self.frame_rtt    = RttEstimator()
+
+        # Open the connection to the serial port.  Reads never block
+        self.comport = serial.Serial(port, 250000, timeout = 0)
+
+        # Wait for the receive line to go quiet
+        while True:
+            await asyncio.sleep(.1)
+            if not self.comport.read(self.comport.in_waiting or 1):
+                break
+
+        # From now on, the event loop tells us when there is data to read
+        self.loop.add_reader(self.comport.fileno(), self.on_readable)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # wait_for_message() - Waits for an incoming packet.  Returns None if the
+    #                      timeout expires first
+    # ------------------------------------------------------------------------------
+    async def wait_for_message(self, timeout_seconds = None):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout_seconds)
+        except asyncio.TimeoutError:
+            return None
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # "async for packet in gw" yields incoming packets forever
+    # ------------------------------------------------------------------------------
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.queue.get()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # echo() - Ask the gateway to echo a message back to us
+    # ------------------------------------------------------------------------------
+    async def echo(self, payload, timeout = None):
+        return await self.send_packet(self.SP_ECHO, payload, timeout)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # init_radio() - Initialize the radio.
+    #
+    # Passed: frequency must be 433, 868, or 915
+    #         node_id = Between 0 and 1023
+    #         network_id = Between 0 and 255
+    # ------------------------------------------------------------------------------
+    async def init_radio(self, frequency, node_id, network_id, timeout = None):
+        packet = struct.pack('<HHB', frequency, node_id, network_id)
+        return await self.send_packet(self.SP_INIT_RADIO, packet, timeout)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # set_encryption_key() - Tells the radio what the network encryption key is
+    #
+    # The key must be exactly 16 bytes long
+    # ------------------------------------------------------------------------------
+    async def set_encryption_key(self, key, timeout = None):
+        return await self.send_packet(self.SP_ENCRYPT_KEY, key, timeout)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # send_radio_packet() - Sends a data-packet to a node via the radio
+    #
+    # Returns: True on success, otherwise false
+    # ------------------------------------------------------------------------------
+    async def send_radio_packet(self, node_id, payload, timeout = None):
+        packet = node_id.to_bytes(2, 'little') + payload
+        return await self.send_packet(self.SP_TO_RADIO, packet, timeout)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # close() - Unregisters the serial port from the loop and closes it
+    # ------------------------------------------------------------------------------
+    def close(self):
+        self.loop.remove_reader(self.comport.fileno())
+        self.comport.close()
+    # ------------------------------------------------------------------------------
+
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # From here on down are methods that are private to this class
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+
+    # ------------------------------------------------------------------------------
+    # send_packet() - Sends a generic packet and waits for the gateway to ACK it.
+    #                 If "timeout" is given, gives up after that many seconds
+    #
+    # Returns: True on success, otherwise false
+    # ------------------------------------------------------------------------------
+    async def send_packet(self, packet_type, payload, timeout = None):
+        try:
+            return await asyncio.wait_for(self.transmit(packet_type, payload), timeout)
+        except asyncio.TimeoutError:
+            print("Timed out sending packet!")
+            return False
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # transmit() - Sends the prologue and the packet, with the same retry policy
+    #              and adaptive timeouts as MoteinoGateway.  The caller's timeout
+    #              is the deadline
+    # ------------------------------------------------------------------------------
+    async def transmit(self, packet_type, payload):
+
+        # Prepend the packet type to the packet data
+        packet = packet_type.to_bytes(1, 'little') + payload
+
+        # Prepend the CRC of the packet data (including the packet type)
+        packet = fast_crc16(packet).to_bytes(2, 'little') + packet
+
+        # The total length of the packet includes the length byte
+        packet_length = len(packet) + 1
+
+        # Create the two-byte packet prologue
+        prologue = bytes([packet_length, ~packet_length & 0xFF])
+
+        # Attempts (prologue or packet) that have failed so far, which stretch the timeouts
+        failures = 0
+
+        async with self.tx_lock:
+
+            # Make multiple attempts to transmit the prologue + packet
+            for attempt in range(MoteinoGateway.FRAME_ATTEMPTS):
+
+                for prologue_attempt in range(MoteinoGateway.PROLOGUE_ATTEMPTS):
+                    if await self.send_and_wait(prologue, self.prologue_rtt, failures):
+                        break
+                    failures += 1
+                else:
+                    break
+
+                if await self.send_and_wait(packet, self.frame_rtt, failures):
+                    return True
+                failures += 1
+
+        print("Gave up sending packet!")
+        return False
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # send_and_wait() - Sends data and waits for an ACK or NAK, for as long as
+    #                   "estimator" recommends after "failures" failed attempts.
+    #                   ACKs to first attempts are fed back to the estimator
+    #
+    # Returns True if an ACK was received, else false
+    # ------------------------------------------------------------------------------
+    async def send_and_wait(self, data, estimator, failures):
+
+        self.ack_waiter = self.loop.create_future()
+        start_time = time.perf_counter()
+        self.comport.write(data)
+
+        try:
+            result = await asyncio.wait_for(self.ack_waiter, estimator.timeout(failures))
+        except asyncio.TimeoutError:
+            result = False
+        finally:
+            self.ack_waiter = None
+
+        if result:
+            rtt = time.perf_counter() - start_time
+            ACK_RTT.observe(rtt)
+            if failures == 0:
+                estimator.observe(rtt)
+        else:
+            ACK_FAILURES.inc()
+
+        return result
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # on_readable() - Called by the event loop when the serial port has data.
+    #                 Splits whatever has arrived into packets
+    # ------------------------------------------------------------------------------
+    def on_readable(self):
+
+        self.framer.feed(self.comport.read(self.comport.in_waiting or 1))
+        self.process_frames()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # on_stalled() - Called when the line has been quiet for 100ms with a partial
+    #                packet in the framer.  That packet is never going to complete
+    # ------------------------------------------------------------------------------
+    def on_stalled(self):
+        self.stall_timer = None
+        self.framer.skip_stalled()
+        self.process_frames()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # process_frames() - Dispatches every complete packet in the framer, and arms
+    #                    the stall timer if a partial packet is left over
+    # ------------------------------------------------------------------------------
+    def process_frames(self):
+
+        for frame in self.framer.frames():
+            self.dispatch(frame)
+
+        if self.stall_timer:
+            self.stall_timer.cancel()
+            self.stall_timer = None
+
+        if self.framer.pending():
+            self.stall_timer = self.loop.call_later(.1, self.on_stalled)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # dispatch() - Routes one CRC-checked packet (a memoryview that is only valid
+    #              for the duration of this call) from the gateway
+    # ------------------------------------------------------------------------------
+    def dispatch(self, frame):
+
+        # Packet-type is the 4th byte in the packet
+        packet_type = frame[3]
+
+        # If this is a "print this" packet, make it so
+        if packet_type == self.SP_PRINT:
+            print("Gateway says:", bytes(frame[4:]))
+            return
+
+        # If this is an ACK or a NAK, hand it to whoever is waiting for it
+        if packet_type == self.SP_READY or packet_type == self.SP_NAK:
+            waiter = self.ack_waiter
+            if waiter is None or waiter.done():
+                self.stray_acks += 1
+            else:
+                waiter.set_result(packet_type == self.SP_READY)
+            return
+
+        # Everything else goes to the consumer
+        self.queue.put_nowait(decode_packet(bytes(frame), verify_crc = False))
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # on_discard() - Called by the framer with each run of bytes it threw away
+    # ------------------------------------------------------------------------------
+    def on_discard(self, junk):
+        print(f">>> Discarded {len(junk)} bytes while resynchronising <<<")
+        self.queue.put_nowait(BadPacket(bytes(junk)))
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
@@ -0,0 +1,497 @@
+# ==========================================================================================================
+# benchmarks.py - Micro- and macro-benchmarks for the host-side gateway code.  Run with:
+#
+#     python3 benchmarks.py --output results.json --baseline baseline.json --tolerance 0.10
+#
+# The micro-benchmarks time the hot functions one at a time.  The macro-benchmark drives the whole
+# readserial_upload pipeline, from serial bytes to InfluxDB write, against a fake serial port and a
+# local HTTP server standing in for InfluxDB.  Results are written as JSON, and if a baseline is
+# given, any metric that is worse than the baseline by more than the tolerance fails the run.
+# ==========================================================================================================
+import threading
+import collections
+import socket
+import struct
+import time
+import tracemalloc
+import argparse
+import json
+import os
+import platform
+import resource
+import tempfile
+import http.server
+import urllib.parse
+import moteinogw
+import crc16
+from framer import build_frame
+
+
+# ==========================================================================================================
+# bench_queue_per_packet() - The original hand-off: one lock and one socket byte per packet
+#
+# Returns: Microseconds per packet
+# ==========================================================================================================
+def bench_queue_per_packet(count):
+
+    queue = collections.deque()
+    mutex = threading.Lock()
+    pipe_in, pipe_out = socket.socketpair()
+
+    def producer():
+        for n in range(count):
+            mutex.acquire()
+            queue.append(n)
+            mutex.release()
+            pipe_out.send(b'\x01')
+
+    start_time = time.perf_counter()
+    thread = threading.Thread(target=producer)
+    thread.start()
+
+    for _ in range(count):
+        pipe_in.recv(1)
+        mutex.acquire()
+        queue.popleft()
+        mutex.release()
+
+    elapsed = time.perf_counter() - start_time
+    thread.join()
+    pipe_in.close()
+    pipe_out.close()
+    return elapsed * 1e6 / count
+# ==========================================================================================================
+
+# ==========================================================================================================
+# bench_queue_drain() - MoteinoGateway.enqueue() feeding MoteinoGateway.drain_messages()
+#
+# Returns: Microseconds per packet
+# ==========================================================================================================
+def bench_queue_drain(count):
+
+    gw = moteinogw.MoteinoGateway(rx_capacity = count)
+    gw.create_notification_pipe()
+
+    # Radio packets, so they go in the data lane rather than the small control lane
+    packet = moteinogw.RadioPacket(bytes(moteinogw.RADIO_DATA_OFFSET))
+
+    def producer():
+        for n in range(count):
+            gw.enqueue(packet)
+
+    start_time = time.perf_counter()
+    thread = threading.Thread(target=producer)
+    thread.start()
+
+    received = 0
+    while received < count:
+        received += len(gw.drain_messages())
+
+    elapsed = time.perf_counter() - start_time
+    thread.join()
+    gw.close()
+    return elapsed * 1e6 / count
+# ==========================================================================================================
+
+# ==========================================================================================================
+# LegacyRadioPacket - RadioPacket as it was before it gained __slots__ and lazy decoding, kept here
+#                     so the two can be compared
+# ==========================================================================================================
+class LegacyRadioPacket:
+
+    src_node = None
+    dst_node = None
+    rssi     = None
+    data     = None
+
+    def __init__(self, raw_packet):
+        format = '<4sHHh'
+        fixed_size = struct.calcsize(format)
+        _, self.src_node, self.dst_node, self.rssi = struct.unpack(format, raw_packet[:fixed_size])
+        self.data = raw_packet[fixed_size:]
+# ==========================================================================================================
+
+# ==========================================================================================================
+# bench_radio_packet() - Decodes "count" copies of a typical BORC telemetry frame with the given
+#                        packet class, touching the fields the ingest loop uses
+#
+# Returns: (microseconds per packet, allocated blocks per packet, allocated bytes per packet)
+# ==========================================================================================================
+def bench_radio_packet(packet_class, count):
+
+    payload = struct.pack('<BBBBBBHHHH', 1, 1, 72, 3, 0, 17, 2285, 8075, 4187, 3562)
+    frame = bytes(moteinogw.RADIO_DATA_OFFSET) + payload
+    frames = [bytes(frame) for _ in range(count)]
+
+    # Time how long it takes to decode the packets
+    start_time = time.perf_counter()
+    for raw in frames:
+        packet = packet_class(raw)
+        packet.src_node, packet.rssi, packet.data[0]
+    elapsed = time.perf_counter() - start_time
+
+    # Count what it costs to keep the decoded packets alive, as the receive queue does
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    packets = [packet_class(raw) for raw in frames]
+    for packet in packets:
+        packet.src_node
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+
+    return elapsed * 1e6 / count, blocks / count, size / count
+# ==========================================================================================================
+
+# Offset of the transaction ID in a BORC telemetry RadioPacket
+RADIO_TRANSACTION_OFFSET = moteinogw.RADIO_DATA_OFFSET + 5
+
+# ==========================================================================================================
+# sample_telemetry() - Returns "count" BORC telemetry RadioPackets from "nodes" different nodes, with
+#                      a unique (node ID, transaction ID) for each, and the config packets that
+#                      introduce those nodes
+# ==========================================================================================================
+def sample_telemetry(count, nodes = 200, first_node = 100):
+
+    header = bytes(moteinogw.PACKET_HEADER_SIZE)
+    configs = [header + moteinogw.RADIO_HEADER.pack(first_node + n, 1, -60)
+               + struct.pack('<BBBH8s', 0, 1, 1, 100, (first_node + n).to_bytes(8, 'big'))
+               for n in range(nodes)]
+
+    telemetry = []
+    for i in range(count):
+        node_id = first_node + i % nodes
+        payload = struct.pack('<BBBBBBHHHH', 1, 1, 72, 3, 0, (i // nodes) & 0xFF, 2285 + i % 100, 8075, 4187, 3562)
+        telemetry.append(header + moteinogw.RADIO_HEADER.pack(node_id, 1, -60) + payload)
+
+    return configs, telemetry
+# ==========================================================================================================
+
+# ==========================================================================================================
+# timed() - Calls "function" "count" times
+#
+# Returns: Microseconds per call
+# ==========================================================================================================
+def timed(function, count):
+    start_time = time.perf_counter()
+    for _ in range(count):
+        function()
+    return (time.perf_counter() - start_time) * 1e6 / count
+# ==========================================================================================================
+
+# ==========================================================================================================
+# micro_benchmarks() - Times the hot functions one at a time
+#
+# Returns: A dictionary of metric name -> value
+# ==========================================================================================================
+def micro_benchmarks(count):
+
+    import readserial_upload as ru
+
+    results = {}
+
+    results['queue_per_packet_usec'] = bench_queue_per_packet(count)
+    results['queue_drain_usec']      = bench_queue_drain(count)
+
+    for name, rate in crc16.benchmark().items():
+        results[f'crc16_{name}_mbps'] = rate
+
+    frame = bytes(range(64))
+    results['fast_crc16_64_byte_usec'] = timed(lambda: crc16.fast_crc16(frame), count)
+
+    results['radio_packet_usec'], _, results['radio_packet_bytes'] = bench_radio_packet(moteinogw.RadioPacket, count)
+
+    # The ingest loop reads "data" several times per packet: once to route it, again to decode it
+    packet = moteinogw.RadioPacket(bytes(moteinogw.RADIO_DATA_OFFSET) + bytes(range(16)))
+    results['radio_packet_data_usec'] = timed(lambda: packet.data, count)
+
+    # The telemetry unpack path, one packet at a time and a burst at a time
+    _, telemetry = sample_telemetry(count)
+    packets = [moteinogw.RadioPacket(raw) for raw in telemetry]
+    codec = ru.telemetry_codecs.lookup(ru.TYPE_BORC_DEVICE)
+    results['telemetry_decode_usec'] = timed(lambda: codec.decode(packets[0].data), count)
+
+    burst = [(packet, codec) for packet in packets[:500]]
+    start_time = time.perf_counter()
+    for _ in range(max(1, count // len(burst))):
+        ru.process_telemetry_batch(burst)
+    results['telemetry_batch_usec'] = (time.perf_counter() - start_time) * 1e6 / (max(1, count // len(burst)) * len(burst))
+
+    tags, fields = codec.decode(packets[0].data)
+    results['pack_json_usec'] = timed(lambda: ru.pack_JSON(tags, fields), count)
+
+    return results
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# FakeSerial - Stands in for serial.Serial.  Serves pre-built gateway frames, either as fast as they
+#              are read or at "rate" frames per second, and answers every write with an ACK
+# ==========================================================================================================
+class FakeSerial:
+
+    ACK = build_frame(moteinogw.MoteinoGateway.SP_READY, b'')
+
+    timeout   = None  # Read timeout in seconds, as for serial.Serial
+    frames    = None  # List of frames still to serve
+    keys      = None  # List of (node ID, transaction ID), or None, for each frame
+    rate      = 0     # Frames per second, 0 = as fast as they're read
+    chunk     = 16    # Most frames handed out by one read
+    pending   = None  # Bytes that have "arrived" but haven't been read
+    position  = 0     # Index of the next frame to serve
+    started   = None  # When the first frame was served
+    sent_at   = None  # Dictionary of key -> time its frame was served
+    condition = None  # Protects "pending", and wakes a reader when an ACK is queued
+
+    def __init__(self, frames, keys, rate = 0, chunk = 16):
+        self.frames    = frames
+        self.keys      = keys
+        self.rate      = rate
+        self.chunk     = chunk
+        self.pending   = bytearray()
+        self.sent_at   = {}
+        self.condition = threading.Condition()
+
+    @property
+    def in_waiting(self):
+        with self.condition:
+            self.arrive()
+            return len(self.pending)
+
+    def read(self, size = 1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self.condition:
+            while True:
+                self.arrive()
+                if self.pending:
+                    data = bytes(self.pending[:size])
+                    del self.pending[:size]
+                    return data
+                wait = self.next_arrival()
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return b''
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.condition.wait(wait)
+
+    def write(self, data):
+        with self.condition:
+            self.pending += self.ACK
+            self.condition.notify()
+        return len(data)
+
+    def finished(self):
+        return self.position == len(self.frames)
+
+    # Moves every frame that is due into "pending".  Caller holds the condition
+    def arrive(self):
+        now = time.perf_counter()
+        if self.started is None:
+            self.started = now
+        due = len(self.frames) if not self.rate else int((now - self.started) * self.rate) + 1
+        end = min(due, self.position + self.chunk, len(self.frames))
+        for i in range(self.position, end):
+            self.pending += self.frames[i]
+            if self.keys[i] is not None:
+                self.sent_at[self.keys[i]] = now
+        self.position = max(self.position, end)
+
+    # Seconds until the next frame is due, or None if there are no more
+    def next_arrival(self):
+        if self.finished():
+            return None
+        if not self.rate:
+            return 0
+        return max(0, self.started + self.position / self.rate - time.perf_counter())
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# FakeInflux - A local HTTP server that accepts InfluxDB line-protocol writes and notes when each
+#              (node_id, transaction_id) point arrived
+# ==========================================================================================================
+class FakeInflux(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    points      = 0     # Points received
+    received_at = None  # Dictionary of (node ID, transaction ID) -> time the point arrived
+    mutex       = None
+
+    def __init__(self):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), FakeInfluxHandler)
+        self.received_at = {}
+        self.mutex = threading.Lock()
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+
+    def record(self, body):
+        now = time.perf_counter()
+        lines = body.decode().splitlines()
+        with self.mutex:
+            self.points += len(lines)
+            for line in lines:
+                tags = dict(tag.split('=', 1) for tag in line.split(' ', 1)[0].split(',')[1:])
+                if 'transaction_id' in tags:
+                    self.received_at[(int(tags['node_id']), int(tags['transaction_id']))] = now
+
+
+class FakeInfluxHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if urllib.parse.urlparse(self.path).path == '/write':
+            self.server.record(body)
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# macro_benchmark() - Drives readserial_upload's ingest loop over a FakeSerial, with a FakeInflux as
+#                     the database, until every point has been written
+#
+# Returns: A dictionary of metric name -> value
+# ==========================================================================================================
+def macro_benchmark(count, rate = 0, prefix = 'pipeline'):
+
+    import readserial_upload as ru
+    from influx_pool import InfluxPool
+    from influx_writer import InfluxWriter
+    from node_registry import NodeRegistry
+    from dedup import DedupWindow
+
+    configs, telemetry = sample_telemetry(count)
+    frames = [build_frame(moteinogw.MoteinoGateway.SP_FROM_RADIO, raw[moteinogw.PACKET_HEADER_SIZE:])
+              for raw in configs + telemetry]
+    keys = [None] * len(configs) + [(moteinogw.RADIO_HEADER.unpack_from(raw, moteinogw.PACKET_HEADER_SIZE)[0],
+                                     raw[RADIO_TRANSACTION_OFFSET]) for raw in telemetry]
+
+    server = FakeInflux()
+    scratch = tempfile.mkdtemp()
+    ini = os.path.join(scratch, 'database.ini')
+    with open(ini, 'w') as file:
+        file.write(f'[influxdb]\nserver = 127.0.0.1\ninflux_port = {server.server_address[1]}\n'
+                   f'user = bench\npasswd = bench\ndb = bench\n')
+
+    # Point the pipeline's globals at the fakes
+    ru.pool     = InfluxPool(ini)
+    ru.registry = NodeRegistry(os.path.join(scratch, 'nodes.db'))
+    ru.dedup    = DedupWindow()
+    ru.writer   = InfluxWriter(ru.pool)
+    ru.registry.open()
+    ru.writer.start()
+
+    port = FakeSerial(frames, keys, rate)
+    ru.gw = moteinogw.MoteinoGateway()
+    ru.gw.startup(port, wait_for_quiet = False)
+
+    # Run the ingest loop until the last point has reached the database
+    expected = len(configs) + len(telemetry)
+    deadline = time.monotonic() + 60 + (count / rate if rate else 0)
+    while server.points < expected and time.monotonic() < deadline:
+        ru.handle_burst(ru.gw.drain_messages(timeout_seconds = .1))
+
+    ru.gw.close()
+    ru.writer.shutdown()
+    ru.registry.close()
+    ru.pool.close()
+    server.shutdown()
+    server.server_close()
+
+    latencies = sorted(server.received_at[key] - port.sent_at[key] for key in server.received_at if key in port.sent_at)
+    elapsed = max(server.received_at.values()) - port.started if server.received_at else 0
+
+    return {
+        f'{prefix}_pps'         : len(latencies) / elapsed if elapsed else 0,
+        f'{prefix}_p50_ms'      : percentile(latencies, .50) * 1000,
+        f'{prefix}_p99_ms'      : percentile(latencies, .99) * 1000,
+        f'{prefix}_lost_packets': len(telemetry) - len(latencies),
+    }
+# ==========================================================================================================
+
+# ==========================================================================================================
+# percentile() - Returns the "fraction" percentile of a sorted list, or 0 if it is empty
+# ==========================================================================================================
+def percentile(values, fraction):
+    return values[int(fraction * (len(values) - 1))] if values else 0
+# ==========================================================================================================
+
+# ==========================================================================================================
+# compare() - Compares results against a baseline.  Metrics ending in _pps or _mbps are better when
+#             higher; everything else is better when lower
+#
+# Returns: A list of (metric, baseline value, new value, change) for every regression beyond
+#          "tolerance" (a fraction, e.g. 0.1 for 10%)
+# ==========================================================================================================
+def compare(results, baseline, tolerance):
+
+    regressions = []
+    for section in ('micro', 'macro', 'process'):
+        for name, old in baseline.get(section, {}).items():
+            new = results.get(section, {}).get(name)
+            if new is None or not old:
+                continue
+            change = (new - old) / old
+            higher_is_better = name.endswith('_pps') or name.endswith('_mbps')
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append((f'{section}.{name}', old, new, change))
+
+    return regressions
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# MAIN
+# ==========================================================================================================
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Benchmarks the host-side gateway code')
+    parser.add_argument('--count', type = int, default = 200000, help = 'iterations for each micro-benchmark')
+    parser.add_argument('--packets', type = int, default = 20000, help = 'packets for the macro-benchmark')
+    parser.add_argument('--rate', type = float, default = 1000, help = 'packets/sec for the paced macro run')
+    parser.add_argument('--output', help = 'write the results to this JSON file')
+    parser.add_argument('--baseline', help = 'compare the results against this JSON file')
+    parser.add_argument('--tolerance', type = float, default = 0.10, help = 'allowed regression, as a fraction')
+    args = parser.parse_args()
+
+    results = {
+        'timestamp': time.time(),
+        'python'   : platform.python_version(),
+        'micro'    : micro_benchmarks(args.count),
+        'macro'    : {},
+    }
+
+    # Flat out, for throughput, then paced like a real serial line, for latency
+    results['macro'].update(macro_benchmark(args.packets, 0, 'pipeline_max'))
+    results['macro'].update(macro_benchmark(min(args.packets, int(args.rate * 10)), args.rate, 'pipeline_paced'))
+
+    results['process'] = {'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+    for section in ('micro', 'macro', 'process'):
+        print(f"{section}:")
+        for name, value in results[section].items():
+            print(f"    {name:36s}: {value:12.3f}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent = 4)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for name, old, new, change in regressions:
+            print(f"REGRESSION {name}: {old:.3f} -> {new:.3f} ({change:+.1%})")
+        if regressions:
+            raise SystemExit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+# ==========================================================================================================
@@ -0,0 +1,521 @@
+# ==========================================================================================================
+# capture.py - Records the raw byte stream between the host and the gateway, and plays it back
+#
+# A capture is a series of segment files, "<base>.000000.cap", "<base>.000001.cap" and so on.  Each
+# segment starts with an 8-byte magic number followed by records of:
+#
+#     timestamp   float64   Wall-clock time the bytes were read or written
+#     direction   uint8     RX (from the gateway) or TX (to the gateway)
+#     length      uint32    Number of bytes that follow
+#     data        bytes     Exactly what came off (or went on to) the wire
+#
+# Beside each segment is an index, "<base>.NNNNNN.idx", holding a (timestamp, offset) pair for every
+# INDEX_EVERY'th record, so a replay can start at any point in time without scanning the capture.
+# ==========================================================================================================
+import glob
+import mmap
+import bisect
+import struct
+import threading
+import time
+
+MAGIC       = b'MGWCAP01'
+RECORD      = struct.Struct('<dBI')
+INDEX_ENTRY = struct.Struct('<dQ')
+INDEX_EVERY = 256
+
+RX = 0      # Bytes read from the gateway
+TX = 1      # Bytes written to the gateway
+
+
+# ==========================================================================================================
+# CaptureWriter - Appends records to a segmented capture
+#
+# Records are buffered in memory and written out in large blocks.  A new segment is started once the
+# current one reaches "segment_bytes".  Safe to use from the reader and transmit threads at once.
+# ==========================================================================================================
+class CaptureWriter:
+
+    base          = None  # Path prefix of the segment files
+    segment_bytes = 0     # Size at which a new segment is started
+    buffer_bytes  = 0     # Size at which buffered records are written out
+    segment       = -1    # Number of the current segment
+    file          = None  # The current segment file
+    index         = None  # The current segment's index file
+    buffer        = None  # A bytearray of records not yet written
+    offset        = 0     # Offset in the current segment at which "buffer" will land
+    count         = 0     # Records written to the current segment
+    closed        = False # Once True, further records are ignored
+    mutex         = None
+
+    # Counters
+    records = 0           # Records captured
+    bytes   = 0           # Payload bytes captured
+
+    # ------------------------------------------------------------------------------
+    # Constructor - Opens the first segment
+    # ------------------------------------------------------------------------------
+    def __init__(self, base, segment_bytes = 64 << 20, buffer_bytes = 256 << 10):
+        self.base          = base
+        self.segment_bytes = segment_bytes
+        self.buffer_bytes  = buffer_bytes
+        self.buffer        = bytearray()
+        self.mutex         = threading.Lock()
+
+        # Never overwrite an earlier capture with the same base name
+        existing = segment_paths(base)
+        self.segment = int(existing[-1][-10:-4]) if existing else -1
+        self.next_segment()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # record() - Captures one read from or write to the serial port
+    # ------------------------------------------------------------------------------
+    def record(self, direction, data, timestamp = None):
+
+        if not data:
+            return
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.mutex:
+
+            if self.closed:
+                return
+
+            # Every so often, note where this record is so a replay can seek to it
+            if self.count % INDEX_EVERY == 0:
+                self.index.write(INDEX_ENTRY.pack(timestamp, self.offset + len(self.buffer)))
+
+            self.buffer += RECORD.pack(timestamp, direction, len(data))
+            self.buffer += data
+            self.count += 1
+            self.records += 1
+            self.bytes += len(data)
+
+            if len(self.buffer) >= self.buffer_bytes:
+                self.write_buffer()
+                if self.offset >= self.segment_bytes:
+                    self.next_segment()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # flush() - Writes out everything captured so far
+    # ------------------------------------------------------------------------------
+    def flush(self):
+        with self.mutex:
+            if self.closed:
+                return
+            self.write_buffer()
+            self.file.flush()
+            self.index.flush()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # close() - Writes out everything captured so far and closes the files
+    # ------------------------------------------------------------------------------
+    def close(self):
+        with self.mutex:
+            if self.closed:
+                return
+            self.closed = True
+            self.write_buffer()
+            self.file.close()
+            self.index.close()
+    # ------------------------------------------------------------------------------
+
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # From here on down are methods that are private to this class
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+
+    # ------------------------------------------------------------------------------
+    # write_buffer() - Writes buffered records to the current segment
+    # ------------------------------------------------------------------------------
+    def write_buffer(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.offset += len(self.buffer)
+            self.buffer.clear()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # next_segment() - Closes the current segment and starts a new one
+    # ------------------------------------------------------------------------------
+    def next_segment(self):
+
+        if self.file:
+            self.file.close()
+            self.index.close()
+
+        self.segment += 1
+        path = f'{self.base}.{self.segment:06d}'
+        self.file   = open(path + '.cap', 'wb')
+        self.index  = open(path + '.idx', 'wb')
+        self.file.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.count  = 0
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# CapturingSerial - Wraps an open serial port and records everything read from and written to it
+# ==========================================================================================================
+class CapturingSerial:
+
+    port   = None  # The real serial port
+    writer = None  # The CaptureWriter
+
+    def __init__(self, port, writer):
+        self.port   = port
+        self.writer = writer
+
+    def read(self, size = 1):
+        data = self.port.read(size)
+        self.writer.record(RX, data)
+        return data
+
+    def write(self, data):
+        self.writer.record(TX, data)
+        return self.port.write(data)
+
+    def close(self):
+        self.port.close()
+        self.writer.close()
+
+    # Everything else (timeout, in_waiting, fileno() ...) is the real port's
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def __setattr__(self, name, value):
+        if name in ('port', 'writer'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.port, name, value)
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# ReplaySerial - Plays a capture back in place of a serial.Serial
+#
+# The bytes the gateway sent are handed to read() at the time they were originally received,
+# scaled by "speed": 1 is real time, 10 is ten times faster, and 0 is as fast as the reader can
+# take them.  Whatever the host writes is thrown away, but the replay stays in step with it: when
+# the capture shows the host writing to the gateway, playback waits (up to "sync_timeout" seconds)
+# for the host to write something, so that the gateway's recorded ACK never arrives before the
+# write it acknowledges.
+#
+#     gw.startup(ReplaySerial('captures/site3', speed = 0))
+# ==========================================================================================================
+class ReplaySerial:
+
+    timeout      = None  # Read timeout in seconds, as for serial.Serial
+    speed        = 1.0   # Playback speed, 0 = as fast as possible
+    sync_timeout = 1.0   # How long to wait for the host to write when the capture says it did
+    segments     = None  # List of segment paths still to play
+    view         = None  # mmap of the segment being played
+    file         = None  # The file "view" maps
+    position     = 0     # Offset of the next record in "view"
+    pending      = None  # memoryview of RX bytes that are due but haven't been read yet
+    origin       = None  # (capture time, wall-clock time) that playback is measured from
+    writes       = 0     # Host writes that haven't been matched to a TX record yet
+    condition    = None  # Protects "writes"
+    finished     = False # True once the whole capture has been played
+
+    # Counters
+    records    = 0       # Records played
+    rx_bytes   = 0       # Bytes handed to read()
+    sync_waits = 0       # Times the host didn't write when the capture said it would
+    started    = None    # When the first byte was read
+    stopped    = None    # When the last byte was read
+
+    # ------------------------------------------------------------------------------
+    # Constructor - If "start" is given, playback begins at that capture timestamp
+    # ------------------------------------------------------------------------------
+    def __init__(self, base, speed = 1.0, start = None, timeout = None, sync_timeout = 1.0):
+        self.speed        = speed
+        self.timeout      = timeout
+        self.sync_timeout = sync_timeout
+        self.segments     = segment_paths(base)
+        self.condition    = threading.Condition()
+        if not self.segments:
+            raise FileNotFoundError(f'No capture segments found for {base}')
+        self.open_next_segment()
+        if start is not None:
+            self.seek(start)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # seek() - Skips to the first indexed record at or after "timestamp"
+    # ------------------------------------------------------------------------------
+    def seek(self, timestamp):
+
+        # Skip whole segments that end before the time we want
+        while self.segments:
+            following = read_index(self.segments[0][:-4] + '.idx')
+            if not following or following[0][0] > timestamp:
+                break
+            self.open_next_segment()
+
+        if self.view is None:
+            return
+
+        # Start from the index entry before it, then walk forward record by record
+        entries = read_index(self.file.name[:-4] + '.idx')
+        i = bisect.bisect_left([entry[0] for entry in entries], timestamp)
+        self.position = entries[i - 1][1] if i else len(MAGIC)
+
+        while True:
+            record = self.peek_record()
+            if record is None or record[0] >= timestamp:
+                break
+            self.position += RECORD.size + record[2]
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # in_waiting - The number of replayed bytes that are due and waiting to be read
+    # ------------------------------------------------------------------------------
+    @property
+    def in_waiting(self):
+        self.advance(0)
+        return len(self.pending) if self.pending is not None else 0
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # read() - Returns up to "size" bytes, waiting up to "timeout" for some to be due
+    # ------------------------------------------------------------------------------
+    def read(self, size = 1):
+
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        self.advance(deadline)
+
+        if not self.pending:
+            return b''
+
+        data = bytes(self.pending[:size])
+        self.pending = self.pending[size:] if size < len(self.pending) else None
+        self.rx_bytes += len(data)
+        self.stopped = time.monotonic()
+        if self.started is None:
+            self.started = self.stopped
+        return data
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # write() - Throws the data away, but lets playback move past the next TX record
+    # ------------------------------------------------------------------------------
+    def write(self, data):
+        with self.condition:
+            self.writes += 1
+            self.condition.notify_all()
+        return len(data)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # stats() - Returns a dictionary of playback statistics
+    # ------------------------------------------------------------------------------
+    def stats(self):
+        elapsed = (self.stopped - self.started) if self.started is not None else 0
+        return {'records': self.records, 'rx_bytes': self.rx_bytes, 'sync_waits': self.sync_waits,
+                'seconds': elapsed, 'finished': self.finished}
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # close() - Unmaps the capture
+    # ------------------------------------------------------------------------------
+    def close(self):
+        self.pending = None
+        if self.view is not None:
+            self.view.close()
+            self.file.close()
+            self.view = None
+        self.segments = []
+    # ------------------------------------------------------------------------------
+
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # From here on down are methods that are private to this class
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+
+    # ------------------------------------------------------------------------------
+    # advance() - Plays records until there are RX bytes to hand out, or until the
+    #             monotonic-clock "deadline" passes (None = wait as long as it takes,
+    #             0 = don't wait at all)
+    # ------------------------------------------------------------------------------
+    def advance(self, deadline):
+
+        while not self.pending and self.view is not None:
+
+            record = self.peek_record()
+            if record is None:
+                self.open_next_segment()
+                continue
+
+            timestamp, direction, length = record
+
+            # Hold the record back until it is due
+            due = self.due_time(timestamp)
+            if due is not None and due > time.monotonic():
+                if deadline is not None and (deadline == 0 or due > deadline):
+                    if deadline:
+                        time.sleep(max(0, deadline - time.monotonic()))
+                    return
+                time.sleep(due - time.monotonic())
+
+            # The host wrote to the gateway here, so wait for it to do the same
+            if direction == TX and not self.match_write(0 if deadline == 0 else self.sync_timeout):
+                if deadline == 0:
+                    return
+                self.sync_waits += 1
+
+            start = self.position + RECORD.size
+            self.position = start + length
+            self.records += 1
+            if direction == RX:
+                self.pending = memoryview(self.view)[start:start + length]
+
+        if self.view is None:
+            self.finished = True
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # match_write() - Waits up to "wait" seconds for a host write that hasn't yet
+    #                 been matched to a TX record, and matches it
+    # ------------------------------------------------------------------------------
+    def match_write(self, wait):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.writes, wait):
+                return False
+            self.writes -= 1
+            return True
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # due_time() - Returns the monotonic time at which a record should be played, or
+    #              None if playback isn't paced
+    # ------------------------------------------------------------------------------
+    def due_time(self, timestamp):
+
+        if not self.speed:
+            return None
+
+        if self.origin is None:
+            self.origin = (timestamp, time.monotonic())
+
+        return self.origin[1] + (timestamp - self.origin[0]) / self.speed
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # peek_record() - Returns (timestamp, direction, length) of the next record in
+    #                 the current segment, or None at the end of it
+    # ------------------------------------------------------------------------------
+    def peek_record(self):
+
+        if self.position + RECORD.size > len(self.view):
+            return None
+
+        timestamp, direction, length = RECORD.unpack_from(self.view, self.position)
+
+        # A record cut short by a crash ends the segment
+        if self.position + RECORD.size + length > len(self.view):
+            return None
+
+        return timestamp, direction, length
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # open_next_segment() - Maps the next segment, or marks playback as finished
+    # ------------------------------------------------------------------------------
+    def open_next_segment(self):
+
+        if self.view is not None:
+            self.pending = None
+            self.view.close()
+            self.file.close()
+            self.view = None
+
+        while self.segments:
+            self.file = open(self.segments.pop(0), 'rb')
+            if len(MAGIC) < self.file.seek(0, 2):
+                self.view = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+                if self.view[:len(MAGIC)] == MAGIC:
+                    self.position = len(MAGIC)
+                    return
+                self.view.close()
+                self.view = None
+            self.file.close()
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# segment_paths() - Returns the segment files of a capture, in order
+# ==========================================================================================================
+def segment_paths(base):
+    return sorted(glob.glob(glob.escape(base) + '.[0-9][0-9][0-9][0-9][0-9][0-9].cap'))
+# ==========================================================================================================
+
+# ==========================================================================================================
+# read_index() - Returns the list of (timestamp, offset) entries in an index file
+# ==========================================================================================================
+def read_index(path):
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+    except FileNotFoundError:
+        return []
+    usable = len(data) - len(data) % INDEX_ENTRY.size
+    return list(INDEX_ENTRY.iter_unpack(data[:usable]))
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# replay() - Feeds a capture through MoteinoGateway's framing and decoding and counts the packets
+#            that come out the other end.  Nothing is sent to the gateway, so playback doesn't wait
+#            for the host's writes
+#
+# Returns: A dictionary of packets, seconds and packets per second
+# ==========================================================================================================
+def replay(base, speed = 0):
+
+    import moteinogw
+
+    port = ReplaySerial(base, speed, sync_timeout = 0)
+    gw = moteinogw.MoteinoGateway()
+    gw.startup(port, wait_for_quiet = False)
+
+    packets = 0
+    while not port.finished or gw.queue:
+        packets += len(gw.drain_messages(timeout_seconds = .2))
+
+    gw.close()
+    stats = port.stats()
+    seconds = stats['seconds']
+    return {'packets': packets, 'seconds': seconds, 'pps': packets / seconds if seconds else 0,
+            'bytes': stats['rx_bytes'], 'sync_waits': stats['sync_waits']}
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# MAIN - Replays a capture:  python3 capture.py <base> [speed]
+# ==========================================================================================================
+if __name__ == '__main__':
+
+    import sys
+
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python3 capture.py <capture_base> [speed, 0 = as fast as possible]")
+        sys.exit(1)
+
+    result = replay(sys.argv[1], float(sys.argv[2]) if len(sys.argv) == 3 else 0)
+    print(f"Replayed {result['packets']} packets ({result['bytes']} bytes) in {result['seconds']:.3f}s: "
+          f"{result['pps']:.0f} packets/sec, {result['sync_waits']} sync waits")
+
+# ==========================================================================================================
@@ -0,0 +1,234 @@
+# ==========================================================================================================
+# crc16.py - The 16-bit CRC used on the serial link between the host and the gateway firmware
+#
+# This is CRC-16/CCITT-FALSE: polynomial 0x1021, seed 0xFFFF, no reflection, no final XOR, exactly as
+# computed by fast_crc16() in fast_crc16.cpp.  Several interchangeable backends are provided and the
+# fastest one that passes a self-test is bound to "fast_crc16" when this module is imported.  Set the
+# environment variable MOTEINO_CRC_BACKEND to one of the names in "backends" to force a choice.
+# ==========================================================================================================
+import binascii
+import os
+import random
+import time
+
+
+# ==========================================================================================================
+# 16-bit CRC lookup table for polynomial 0x1021
+# ==========================================================================================================
+crc16_table = [
+    0x0000, 0x1021, 0x2042, 0x3063, 0x4084, 0x50A5, 0x60C6, 0x70E7,
+    0x8108, 0x9129, 0xA14A, 0xB16B, 0xC18C, 0xD1AD, 0xE1CE, 0xF1EF,
+    0x1231, 0x0210, 0x3273, 0x2252, 0x52B5, 0x4294, 0x72F7, 0x62D6,
+    0x9339, 0x8318, 0xB37B, 0xA35A, 0xD3BD, 0xC39C, 0xF3FF, 0xE3DE,
+    0x2462, 0x3443, 0x0420, 0x1401, 0x64E6, 0x74C7, 0x44A4, 0x5485,
+    0xA56A, 0xB54B, 0x8528, 0x9509, 0xE5EE, 0xF5CF, 0xC5AC, 0xD58D,
+    0x3653, 0x2672, 0x1611, 0x0630, 0x76D7, 0x66F6, 0x5695, 0x46B4,
+    0xB75B, 0xA77A, 0x9719, 0x8738, 0xF7DF, 0xE7FE, 0xD79D, 0xC7BC,
+    0x48C4, 0x58E5, 0x6886, 0x78A7, 0x0840, 0x1861, 0x2802, 0x3823,
+    0xC9CC, 0xD9ED, 0xE98E, 0xF9AF, 0x8948, 0x9969, 0xA90A, 0xB92B,
+    0x5AF5, 0x4AD4, 0x7AB7, 0x6A96, 0x1A71, 0x0A50, 0x3A33, 0x2A12,
+    0xDBFD, 0xCBDC, 0xFBBF, 0xEB9E, 0x9B79, 0x8B58, 0xBB3B, 0xAB1A,
+    0x6CA6, 0x7C87, 0x4CE4, 0x5CC5, 0x2C22, 0x3C03, 0x0C60, 0x1C41,
+    0xEDAE, 0xFD8F, 0xCDEC, 0xDDCD, 0xAD2A, 0xBD0B, 0x8D68, 0x9D49,
+    0x7E97, 0x6EB6, 0x5ED5, 0x4EF4, 0x3E13, 0x2E32, 0x1E51, 0x0E70,
+    0xFF9F, 0xEFBE, 0xDFDD, 0xCFFC, 0xBF1B, 0xAF3A, 0x9F59, 0x8F78,
+    0x9188, 0x81A9, 0xB1CA, 0xA1EB, 0xD10C, 0xC12D, 0xF14E, 0xE16F,
+    0x1080, 0x00A1, 0x30C2, 0x20E3, 0x5004, 0x4025, 0x7046, 0x6067,
+    0x83B9, 0x9398, 0xA3FB, 0xB3DA, 0xC33D, 0xD31C, 0xE37F, 0xF35E,
+    0x02B1, 0x1290, 0x22F3, 0x32D2, 0x4235, 0x5214, 0x6277, 0x7256,
+    0xB5EA, 0xA5CB, 0x95A8, 0x8589, 0xF56E, 0xE54F, 0xD52C, 0xC50D,
+    0x34E2, 0x24C3, 0x14A0, 0x0481, 0x7466, 0x6447, 0x5424, 0x4405,
+    0xA7DB, 0xB7FA, 0x8799, 0x97B8, 0xE75F, 0xF77E, 0xC71D, 0xD73C,
+    0x26D3, 0x36F2, 0x0691, 0x16B0, 0x6657, 0x7676, 0x4615, 0x5634,
+    0xD94C, 0xC96D, 0xF90E, 0xE92F, 0x99C8, 0x89E9, 0xB98A, 0xA9AB,
+    0x5844, 0x4865, 0x7806, 0x6827, 0x18C0, 0x08E1, 0x3882, 0x28A3,
+    0xCB7D, 0xDB5C, 0xEB3F, 0xFB1E, 0x8BF9, 0x9BD8, 0xABBB, 0xBB9A,
+    0x4A75, 0x5A54, 0x6A37, 0x7A16, 0x0AF1, 0x1AD0, 0x2AB3, 0x3A92,
+    0xFD2E, 0xED0F, 0xDD6C, 0xCD4D, 0xBDAA, 0xAD8B, 0x9DE8, 0x8DC9,
+    0x7C26, 0x6C07, 0x5C64, 0x4C45, 0x3CA2, 0x2C83, 0x1CE0, 0x0CC1,
+    0xEF1F, 0xFF3E, 0xCF5D, 0xDF7C, 0xAF9B, 0xBFBA, 0x8FD9, 0x9FF8,
+    0x6E17, 0x7E36, 0x4E55, 0x5E74, 0x2E93, 0x3EB2, 0x0ED1, 0x1EF0
+]
+# ==========================================================================================================
+
+# ==========================================================================================================
+# Slicing-by-4 tables: crc16_slices[k][x] is the CRC of byte x followed by k zero bytes, starting
+# from a CRC of zero.  crc16_slices[0] is crc16_table
+# ==========================================================================================================
+def build_slices(count):
+    slices = [crc16_table]
+    for _ in range(1, count):
+        prior = slices[-1]
+        slices.append([((crc << 8) ^ crc16_table[crc >> 8]) & 0xFFFF for crc in prior])
+    return slices
+
+crc16_slices = build_slices(4)
+# ==========================================================================================================
+
+# ==========================================================================================================
+# crc16_reference() - Byte-at-a-time table lookup.  A line-for-line port of fast_crc16.cpp
+# ==========================================================================================================
+def crc16_reference(data):
+    crc = 0xFFFF
+    for value in data:
+        pos = (crc >> 8) ^ value
+        crc = ((crc << 8) ^ crc16_table[pos]) & 0xFFFF
+    return crc
+# ==========================================================================================================
+
+# ==========================================================================================================
+# crc16_slicing() - Consumes four bytes per table round.  The CRC register is folded into the
+#                   first two bytes of each group, and the four partial CRCs are XORed together
+# ==========================================================================================================
+def crc16_slicing(data):
+    t0, t1, t2, t3 = crc16_slices
+    crc = 0xFFFF
+    tail = len(data) & ~3
+    values = iter(data[:tail])
+    for b0, b1, b2, b3 in zip(values, values, values, values):
+        crc = t3[(crc >> 8) ^ b0] ^ t2[(crc & 0xFF) ^ b1] ^ t1[b2] ^ t0[b3]
+    for value in data[tail:]:
+        crc = ((crc << 8) ^ t0[(crc >> 8) ^ value]) & 0xFFFF
+    return crc
+# ==========================================================================================================
+
+# ==========================================================================================================
+# crc16_binascii() - The C implementation of CRC-CCITT in the standard library, seeded with 0xFFFF
+# ==========================================================================================================
+def crc16_binascii(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+# ==========================================================================================================
+
+# ==========================================================================================================
+# The available backends, fastest first
+# ==========================================================================================================
+backends = {
+    'binascii'  : crc16_binascii,
+    'slicing'   : crc16_slicing,
+    'reference' : crc16_reference
+}
+# ==========================================================================================================
+
+# ==========================================================================================================
+# cross_check() - Compares every backend against "expected" (by default the reference backend) on
+#                 randomized vectors of up to 255 bytes, the longest the firmware can CRC
+#
+# Returns: A list of the names of the backends that disagreed
+# ==========================================================================================================
+def cross_check(count = 1000, expected = crc16_reference, seed = None):
+
+    rng = random.Random(seed)
+    failed = set()
+
+    for _ in range(count):
+        data = bytes(rng.getrandbits(8) for _ in range(rng.randint(0, 255)))
+        want = expected(data)
+        for name, backend in backends.items():
+            if backend(data) != want:
+                failed.add(name)
+
+    return sorted(failed)
+# ==========================================================================================================
+
+# ==========================================================================================================
+# firmware_crc16() - Compiles fast_crc16.cpp for the host with a stub <avr/pgmspace.h> and returns
+#                    a Python callable for it, or None if no C++ compiler is available
+# ==========================================================================================================
+def firmware_crc16(source = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fast_crc16.cpp')):
+
+    import ctypes
+    import shutil
+    import subprocess
+    import tempfile
+
+    compiler = shutil.which('g++') or shutil.which('clang++')
+    if compiler is None:
+        return None
+
+    # The library stays loaded after its directory is deleted
+    with tempfile.TemporaryDirectory() as workdir:
+        os.mkdir(os.path.join(workdir, 'avr'))
+
+        with open(os.path.join(workdir, 'avr', 'pgmspace.h'), 'w') as f:
+            f.write('#define PROGMEM\n#define pgm_read_word(addr) (*(const uint16_t*)(addr))\n')
+
+        with open(os.path.join(workdir, 'host_crc16.cpp'), 'w') as f:
+            f.write('#include <stdint.h>\n'
+                    'uint16_t fast_crc16(const uint8_t* in, uint8_t count);\n'
+                    'extern "C" uint16_t host_crc16(const uint8_t* in, uint8_t count) {return fast_crc16(in, count);}\n')
+
+        library = os.path.join(workdir, 'fast_crc16.so')
+        subprocess.run([compiler, '-shared', '-fPIC', '-I', workdir, source,
+                        os.path.join(workdir, 'host_crc16.cpp'), '-o', library], check = True)
+
+        host_crc16 = ctypes.CDLL(library).host_crc16
+        host_crc16.restype = ctypes.c_uint16
+        host_crc16.argtypes = [ctypes.c_char_p, ctypes.c_uint8]
+
+    return lambda data: host_crc16(bytes(data), len(data))
+# ==========================================================================================================
+
+# ==========================================================================================================
+# benchmark() - Measures the throughput of every backend on frame-sized buffers
+#
+# Returns: A dictionary of backend name -> MB/s
+# ==========================================================================================================
+def benchmark(frame_size = 64, total_bytes = 4000000):
+
+    data = bytes(random.getrandbits(8) for _ in range(frame_size))
+    rounds = total_bytes // frame_size
+    results = {}
+
+    for name, backend in backends.items():
+        start_time = time.perf_counter()
+        for _ in range(rounds):
+            backend(data)
+        elapsed = time.perf_counter() - start_time
+        results[name] = rounds * frame_size / elapsed / 1e6
+
+    return results
+# ==========================================================================================================
+
+# ==========================================================================================================
+# select_backend() - Returns the requested backend, or the fastest one that agrees with the reference
+# ==========================================================================================================
+def select_backend(name = None):
+
+    if name:
+        return backends[name]
+
+    vectors = [b'', b'123456789', bytes(range(256))[:255]]
+    for backend in backends.values():
+        if all(backend(v) == crc16_reference(v) for v in vectors):
+            return backend
+
+    return crc16_reference
+# ==========================================================================================================
+
+# ==========================================================================================================
+# fast_crc16() - Computes the 16-bit CRC of a byte string using the selected backend
+# ==========================================================================================================
+fast_crc16 = select_backend(os.environ.get('MOTEINO_CRC_BACKEND'))
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# MAIN - Cross-checks the backends against the firmware and reports their throughput
+# ==========================================================================================================
+if __name__ == '__main__':
+
+    firmware = firmware_crc16()
+    if firmware is None:
+        print("No C++ compiler found, cross-checking against the reference port of fast_crc16.cpp")
+        failed = cross_check(10000)
+    else:
+        print("Cross-checking against fast_crc16.cpp compiled for the host")
+        failed = cross_check(10000, firmware)
+
+    print("Mismatched backends:", failed or "none")
+    print("Selected backend   :", fast_crc16.__name__)
+
+    for name, rate in benchmark().items():
+        print(f"    {name:10s} : {rate:8.2f} MB/s")
+
+# ==========================================================================================================
@@ -0,0 +1,113 @@
+# ==========================================================================================================
+# dedup.py - Recognises packets that a node has retransmitted because it missed our response
+# ==========================================================================================================
+import collections
+import threading
+import time
+
+
+# ==========================================================================================================
+# DedupWindow - Remembers the last few transaction IDs heard from each node, and the response we sent
+#
+# Each node gets a small ring of (transaction ID, response, time) entries.  Nodes are kept in
+# least-recently-heard order, and when there are more than "max_nodes" of them the one we've
+# heard from least recently is forgotten.  An entry older than "max_age" seconds no longer counts
+# as a duplicate, because transaction IDs are only 8 bits and a rebooted node starts again at 0.
+#
+#     response = dedup.lookup(node_id, transaction_id)
+#     if response is not None:
+#         resend(response)
+#     else:
+#         dedup.remember(node_id, transaction_id, respond())
+#
+# Safe to use from any thread, so a response can be replaced from the thread that learns how its
+# send went.
+# ==========================================================================================================
+class DedupWindow:
+
+    per_node  = 0     # How many transaction IDs to remember for each node
+    max_nodes = 0     # How many nodes to remember
+    max_age   = 0     # Seconds after which a transaction ID is forgotten
+    nodes     = None  # OrderedDict of node ID -> deque of (transaction ID, response, time)
+    mutex     = None  # Protects "nodes" and the counters
+
+    # Counters
+    unique     = 0    # Packets we hadn't seen before
+    duplicates = 0    # Retransmissions that were answered from the cache and dropped
+    evictions  = 0    # Nodes forgotten to make room for others
+
+    # ------------------------------------------------------------------------------
+    # Constructor
+    # ------------------------------------------------------------------------------
+    def __init__(self, per_node = 8, max_nodes = 4096, max_age = 60.0):
+        self.per_node  = per_node
+        self.max_nodes = max_nodes
+        self.max_age   = max_age
+        self.nodes     = collections.OrderedDict()
+        self.mutex     = threading.Lock()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # lookup() - Checks whether this transaction is one we've already answered
+    #
+    # Returns: The response we sent the first time, or None if this is new
+    # ------------------------------------------------------------------------------
+    def lookup(self, node_id, transaction_id):
+
+        with self.mutex:
+
+            ring = self.nodes.get(node_id)
+            if ring is not None:
+                oldest = time.monotonic() - self.max_age
+                for entry_id, response, seen in ring:
+                    if entry_id == transaction_id and seen >= oldest:
+                        self.nodes.move_to_end(node_id)
+                        self.duplicates += 1
+                        return response
+
+            self.unique += 1
+            return None
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # remember() - Records the response we've just sent for a new transaction
+    # ------------------------------------------------------------------------------
+    def remember(self, node_id, transaction_id, response):
+
+        with self.mutex:
+
+            ring = self.nodes.get(node_id)
+            if ring is None:
+                ring = self.nodes[node_id] = collections.deque(maxlen = self.per_node)
+                if len(self.nodes) > self.max_nodes:
+                    self.nodes.popitem(last = False)
+                    self.evictions += 1
+            else:
+                self.nodes.move_to_end(node_id)
+
+            ring.append((transaction_id, response, time.monotonic()))
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # replace() - Changes the response remembered for a transaction, if it's still
+    #             remembered, without changing when it was seen
+    # ------------------------------------------------------------------------------
+    def replace(self, node_id, transaction_id, response):
+
+        with self.mutex:
+            ring = self.nodes.get(node_id, ())
+            for index, (entry_id, _, seen) in enumerate(ring):
+                if entry_id == transaction_id:
+                    ring[index] = (entry_id, response, seen)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # stats() - Returns the counters as a dictionary
+    # ------------------------------------------------------------------------------
+    def stats(self):
+        with self.mutex:
+            return {'unique': self.unique, 'duplicates': self.duplicates,
+                    'evictions': self.evictions, 'nodes': len(self.nodes)}
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
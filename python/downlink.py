@@ -0,0 +1,183 @@
+# ==========================================================================================================
+# downlink.py - Commands waiting to be delivered to nodes in our response to their next uplink
+# ==========================================================================================================
+import struct
+import threading
+
+# ==========================================================================================================
+# The response packet: packet type, tasks_bit_field, setpoint, manual index, network ID, node ID and
+# the 16-byte encryption key.  The node only acts on the parts whose bit is set in tasks_bit_field.
+# ==========================================================================================================
+RESPONSE = struct.Struct('<BBBBBH16s')
+
+TASK_SETPOINT     = (1 << 0)   # Change setpoint
+TASK_MANUAL_INDEX = (1 << 1)   # Update manual index
+TASK_REBOOT       = (1 << 2)   # Reboot node
+TASK_NODE_PARAMS  = (1 << 3)   # Update node params (network ID, node ID, encryption key)
+
+
+# ==========================================================================================================
+# DownlinkMailbox - A mailbox of pending commands for every node
+#
+# Operators and the HTTP API post commands at any time.  Commands for the same node are coalesced:
+# their bits are OR'd into one tasks_bit_field and a later value replaces an earlier one.  When the
+# node next sends us a packet, take() returns a single response carrying everything pending and
+# empties the mailbox.  Responses are packed when the mailbox changes rather than when they are
+# sent, and nodes with nothing pending all share one precomputed response.
+#
+# Safe to use from any thread.
+# ==========================================================================================================
+class DownlinkMailbox:
+
+    packet_type = 0     # The packet type byte our responses start with
+    defaults    = None  # Dictionary of values sent when the matching task bit isn't set
+    idle        = None  # The packed response for a node with nothing pending
+    pending     = None  # Dictionary of node ID -> dictionary of pending values, including tasks_bit_field
+    packed      = None  # Dictionary of node ID -> packed response for what's pending
+    mutex       = None  # Protects "pending" and "packed"
+
+    # Counters
+    posted    = 0       # Commands posted
+    delivered = 0       # Responses that carried at least one command
+    requeued  = 0       # Responses that couldn't be sent, whose commands went back in the mailbox
+
+    # ------------------------------------------------------------------------------
+    # Constructor
+    # ------------------------------------------------------------------------------
+    def __init__(self, packet_type, setpoint, manual_index, network_id, node_id, encryption_key):
+        self.packet_type = packet_type
+        self.defaults    = {'tasks_bit_field': 0, 'setpoint': setpoint, 'manual_index': manual_index,
+                            'network_id': network_id, 'node_id': node_id, 'encryption_key': encryption_key}
+        self.idle        = self.pack(self.defaults)
+        self.pending     = {}
+        self.packed      = {}
+        self.mutex       = threading.Lock()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # set_setpoint() - Queues a setpoint change
+    # ------------------------------------------------------------------------------
+    def set_setpoint(self, node_id, setpoint):
+        self.post(node_id, TASK_SETPOINT, {'setpoint': setpoint})
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # set_manual_index() - Queues a manual index change
+    # ------------------------------------------------------------------------------
+    def set_manual_index(self, node_id, manual_index):
+        self.post(node_id, TASK_MANUAL_INDEX, {'manual_index': manual_index})
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # reboot() - Queues a reboot
+    # ------------------------------------------------------------------------------
+    def reboot(self, node_id):
+        self.post(node_id, TASK_REBOOT)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # set_node_params() - Queues new radio parameters for the node
+    # ------------------------------------------------------------------------------
+    def set_node_params(self, node_id, network_id, new_node_id, encryption_key):
+        self.post(node_id, TASK_NODE_PARAMS, {'network_id': network_id, 'node_id': new_node_id,
+                                              'encryption_key': encryption_key})
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # post() - Adds one or more commands to a node's mailbox, merging them with
+    #          what's there.  "task" is the OR of their task bits and "values" a
+    #          dictionary of the values they set.  Raises struct.error, and changes
+    #          nothing, if a value doesn't fit the response packet
+    # ------------------------------------------------------------------------------
+    def post(self, node_id, task, values = None):
+
+        with self.mutex:
+            entry = dict(self.pending.get(node_id, self.defaults))
+            entry['tasks_bit_field'] |= task
+            entry.update(values or {})
+
+            # packing first means a value that doesn't fit raises struct.error and changes nothing
+            self.packed[node_id] = self.pack(entry)
+            self.pending[node_id] = entry
+            self.posted += bin(task).count('1')
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # peek() - Returns a copy of what's pending for a node, or None
+    # ------------------------------------------------------------------------------
+    def peek(self, node_id):
+        with self.mutex:
+            entry = self.pending.get(node_id)
+            return dict(entry) if entry else None
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # take() - Empties a node's mailbox
+    #
+    # Returns: (response bytes, the pending entry that was taken or None).  Hand the
+    #          entry back to requeue() if the response can't be sent
+    # ------------------------------------------------------------------------------
+    def take(self, node_id):
+
+        with self.mutex:
+            entry = self.pending.pop(node_id, None)
+            if entry is None:
+                return self.idle, None
+
+            response = self.packed.pop(node_id)
+            self.delivered += 1
+            return response, entry
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # response() - Returns what take() would return for a node, without taking it
+    # ------------------------------------------------------------------------------
+    def response(self, node_id):
+        with self.mutex:
+            return self.packed.get(node_id, self.idle)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # requeue() - Puts the commands from an undelivered response back.  Anything
+    #             posted since then takes priority
+    # ------------------------------------------------------------------------------
+    def requeue(self, node_id, entry):
+
+        with self.mutex:
+            newer = self.pending.get(node_id)
+            if newer is not None:
+                tasks = entry['tasks_bit_field'] | newer['tasks_bit_field']
+                entry = dict(entry)
+                entry.update(newer)
+                entry['tasks_bit_field'] = tasks
+            self.pending[node_id] = entry
+            self.packed[node_id] = self.pack(entry)
+            self.delivered -= 1
+            self.requeued += 1
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # stats() - Returns the counters as a dictionary
+    # ------------------------------------------------------------------------------
+    def stats(self):
+        with self.mutex:
+            return {'posted': self.posted, 'delivered': self.delivered,
+                    'requeued': self.requeued, 'waiting': len(self.pending)}
+    # ------------------------------------------------------------------------------
+
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # From here on down are methods that are private to this class
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+
+    # ------------------------------------------------------------------------------
+    # pack() - Packs a response from a dictionary of values
+    # ------------------------------------------------------------------------------
+    def pack(self, values):
+        return RESPONSE.pack(self.packet_type, values['tasks_bit_field'], values['setpoint'],
+                             values['manual_index'], values['network_id'], values['node_id'],
+                             values['encryption_key'])
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
@@ -0,0 +1,693 @@
+# ==========================================================================================================
+# emulator.py - A software Moteino gateway on a pseudo-terminal, for testing without hardware
+#
+# The emulator opens a pty pair and behaves, on the far end of it, the way moteino_gateway.ino does:
+# CPacketUART's receive state machine accepts prologues and packets and answers with SP_READY and
+# SP_NAK, dispatch_serial_message()'s handlers answer SP_ECHO, SP_INIT_RADIO, SP_ENCRYPT_KEY,
+# SP_TO_RADIO and SP_BATCH, and once the radio is initialised a population of virtual BORC and STM
+# nodes sends SP_FROM_RADIO traffic, batched if the host has asked for batches.  Faults can be
+# injected on the serial line to exercise the host's framing and retry logic.
+#
+#     emulator = GatewayEmulator(nodes = make_nodes(50, interval = 5))
+#     emulator.start()
+#     gw.startup(emulator.path)
+#
+# Or run it standalone, and point readserial_upload.py at the path it prints:
+#
+#     python3 emulator.py --nodes 50 --interval 5 --drop 0.001
+#
+# test_batching.py runs MoteinoGateway against the emulator, with and without batching support.
+# ==========================================================================================================
+import os
+import tty
+import time
+import heapq
+import random
+import select
+import struct
+import threading
+from crc16 import fast_crc16
+
+SP_PRINT       = 0x01
+SP_READY       = 0x02
+SP_ECHO        = 0x03
+SP_ALIVE       = 0x04
+SP_INIT_RADIO  = 0x05
+SP_ENCRYPT_KEY = 0x06
+SP_FROM_RADIO  = 0x07
+SP_TO_RADIO    = 0x08
+SP_NAK         = 0x09
+SP_BATCH       = 0x0A
+
+PACKET_HEADER_SIZE = 4
+CRC_START          = 3
+SUB_HEADER_SIZE    = 2
+MAX_BATCH_SIZE     = 255
+BATCH_HOLD         = .002   # Seconds the firmware holds a batch of radio packets before sending it
+
+# The receive states of CPacketUART
+WAIT_PROLOGUE_1      = 0
+WAIT_PROLOGUE_2      = 1
+WAIT_PACKET_COMPLETE = 2
+
+# Node payloads, as readserial_upload.py decodes them
+TYPE_BORC_DEVICE      = 1
+TYPE_STM_DEVICE       = 2
+TYPE_CONFIG_PACKET    = 0
+TYPE_TELEMETRY_PACKET = 1
+CONFIG_FORMAT         = struct.Struct('<BBBH8s')
+BORC_FORMAT           = struct.Struct('<BBBBBBHHHH')
+STM_FORMAT            = struct.Struct('<BBHHBB')
+FROM_RADIO_HEADER     = struct.Struct('<BHBHHh')
+TO_RADIO_HEADER       = struct.Struct('<BHBH')
+INIT_RADIO_FORMAT     = struct.Struct('<BHBHHB')
+BATCHED_TO_RADIO      = struct.Struct('<BBH')
+
+
+# ==========================================================================================================
+# Faults - What to do wrong, and how often.  Rates are probabilities between 0 and 1
+# ==========================================================================================================
+class Faults:
+
+    drop_rate      = 0.0   # Chance of dropping each byte we send to the host
+    rx_drop_rate   = 0.0   # Chance of dropping each byte the host sends us
+    corrupt_rate   = 0.0   # Chance of sending a packet with a bad CRC
+    ack_delay      = 0.0   # Seconds to sit on an ACK or NAK before sending it...
+    ack_delay_rate = 0.0   # ...with this chance
+    burst_size     = 0     # Every "burst_every" seconds, this many extra radio packets arrive at once
+    burst_every    = 0.0
+
+    def __init__(self, **settings):
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise TypeError(f'Unknown fault: {name}')
+            setattr(self, name, value)
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# VirtualNode - A BORC or STM node that sends a config packet when it starts, then telemetry every
+#               "interval" seconds.  Like a real node, it retransmits a packet (with the same
+#               transaction ID) if no response arrives within "response_timeout" seconds
+# ==========================================================================================================
+class VirtualNode:
+
+    node_id          = 0
+    device_type      = TYPE_BORC_DEVICE
+    interval         = 10.0  # Seconds between telemetry packets
+    response_timeout = 0.5   # Seconds to wait for a response before retransmitting
+    max_retries      = 3
+    rssi             = -60
+
+    transaction_id   = 0     # ID of the most recent packet
+    outstanding      = None  # The payload waiting for a response, or None
+    retries          = 0     # Retransmissions of "outstanding" so far
+    retry_at         = 0.0   # When to retransmit "outstanding"
+    next_due         = 0.0   # When to send the next new packet
+    configured       = False # True once our config packet has been answered
+    setpoint         = 72
+
+    # Counters
+    sent             = 0     # Packets sent, including retransmissions
+    retransmits      = 0     # Retransmissions
+    responses        = 0     # Responses received
+
+    def __init__(self, node_id, device_type = TYPE_BORC_DEVICE, interval = 10.0, response_timeout = 0.5):
+        self.node_id          = node_id
+        self.device_type      = device_type
+        self.interval         = interval
+        self.response_timeout = response_timeout
+        self.transaction_id   = random.randrange(256)
+
+    # ------------------------------------------------------------------------------
+    # poll() - Returns the payload the node sends at monotonic time "now" (or None),
+    #          and the time at which it next wants to be polled
+    # ------------------------------------------------------------------------------
+    def poll(self, now):
+
+        payload = None
+
+        # Nobody answered the last packet, so send it again, or give up on it
+        if self.outstanding is not None and now >= self.retry_at:
+            if self.retries < self.max_retries:
+                self.retries += 1
+                self.retransmits += 1
+                self.retry_at = now + self.response_timeout
+                payload = self.outstanding
+            else:
+                self.outstanding = None
+
+        # Time for a new packet
+        if payload is None and now >= self.next_due:
+            payload = self.outstanding = self.make_payload()
+            self.retries  = 0
+            self.retry_at = now + self.response_timeout
+            self.next_due = now + self.interval
+
+        if payload is not None:
+            self.sent += 1
+
+        wake = self.next_due if self.outstanding is None else min(self.next_due, self.retry_at)
+        return payload, wake
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # make_payload() - Builds the node's next packet with a new transaction ID: its
+    #                  config until the gateway has answered that, then telemetry
+    # ------------------------------------------------------------------------------
+    def make_payload(self):
+
+        self.transaction_id = (self.transaction_id + 1) & 0xFF
+
+        if not self.configured:
+            uid = self.node_id.to_bytes(8, 'big')
+            return CONFIG_FORMAT.pack(TYPE_CONFIG_PACKET, 1, self.device_type, 100, uid)
+
+        if self.device_type == TYPE_BORC_DEVICE:
+            return BORC_FORMAT.pack(TYPE_TELEMETRY_PACKET, 1, self.setpoint, 0, 0, self.transaction_id,
+                                    random.randrange(3000, 6000), random.randrange(1500, 3000),
+                                    random.randrange(3000, 4200), random.randrange(1000, 2000))
+
+        return STM_FORMAT.pack(TYPE_TELEMETRY_PACKET, 1, random.randrange(1500, 3000),
+                               random.randrange(1500, 3000), 0, self.transaction_id)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # on_response() - Called when the gateway transmits a packet to this node
+    # ------------------------------------------------------------------------------
+    def on_response(self, payload):
+
+        self.responses += 1
+        self.outstanding = None
+        self.configured = True
+
+        # Act on a setpoint change, so tests can see commands arrive
+        if len(payload) >= 3 and payload[1] & 1:
+            self.setpoint = payload[2]
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# make_nodes() - Returns "count" virtual nodes starting at node ID "first", alternating BORC and STM
+# ==========================================================================================================
+def make_nodes(count, interval = 10.0, first = 100, response_timeout = 0.5):
+    device_types = (TYPE_BORC_DEVICE, TYPE_STM_DEVICE)
+    return [VirtualNode(first + i, device_types[i % 2], interval, response_timeout) for i in range(count)]
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# GatewayEmulator - The firmware, on a thread, on the master side of a pty
+# ==========================================================================================================
+class GatewayEmulator(threading.Thread):
+
+    path        = None  # Path of the pty's slave side; hand this to MoteinoGateway.startup()
+    master      = None  # File descriptor of the pty's master side
+    slave       = None  # File descriptor of the pty's slave side, kept open so the pty survives
+    faults      = None  # A Faults object
+    nodes       = None  # Dictionary of node ID -> VirtualNode
+    schedule    = None  # Heap of (when, node ID) for nodes that want to send
+    boot_delay  = 0.5   # Seconds from start() to SP_ALIVE, long enough for the host to open the port
+    stopping    = False
+    batching_supported = True  # False behaves like firmware from before SP_BATCH
+
+    # The state of CPacketUART
+    rx_buffer   = None  # Bytes received for the packet being assembled
+    rx_start    = 0.0   # When the first or second byte of it arrived
+    rx_state    = WAIT_PROLOGUE_1
+    batching    = False # True once the host has asked for batches
+    tx_batch    = None  # Sub-packets of the batch being assembled
+    tx_batched  = 0     # Number of them
+    tx_batch_start = 0.0
+
+    # The state of the radio
+    is_radio_initialized = False
+    radio_node_id        = 0
+    network_id           = 0
+    encryption_key       = None
+    next_burst           = None
+
+    # Counters
+    packets_handled = 0  # Packets that made it through the state machine
+    acks            = 0  # SP_READY sent
+    naks            = 0  # SP_NAK sent
+    radio_rx        = 0  # SP_FROM_RADIO packets sent to the host
+    radio_tx        = 0  # SP_TO_RADIO packets the host sent
+    batches_rx      = 0  # SP_BATCH packets the host sent
+    batches_tx      = 0  # SP_BATCH packets sent to the host
+    bytes_dropped   = 0  # Bytes dropped by fault injection, in either direction
+    crcs_corrupted  = 0  # Packets sent with a deliberately bad CRC
+
+    # ------------------------------------------------------------------------------
+    # Constructor - Opens the pty.  Call start() to power the gateway on
+    # ------------------------------------------------------------------------------
+    def __init__(self, nodes = (), faults = None, boot_delay = 0.5, batching_supported = True):
+
+        threading.Thread.__init__(self, daemon = True)
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path       = os.ttyname(self.slave)
+        self.faults     = faults or Faults()
+        self.boot_delay = boot_delay
+        self.nodes      = {node.node_id: node for node in nodes}
+        self.schedule   = []
+        self.rx_buffer  = bytearray()
+        self.tx_batch   = bytearray()
+        self.batching_supported = batching_supported
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # stop() - Powers the gateway off and closes the pty
+    # ------------------------------------------------------------------------------
+    def stop(self):
+        self.stopping = True
+        if self.is_alive():
+            self.join()
+        os.close(self.master)
+        os.close(self.slave)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # inject() - Delivers a radio packet from a node that isn't in the population
+    # ------------------------------------------------------------------------------
+    def inject(self, src_node, payload, rssi = -60):
+        self.send_from_radio(src_node, payload, rssi)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # stats() - Returns a dictionary of the emulator's counters
+    # ------------------------------------------------------------------------------
+    def stats(self):
+        nodes = self.nodes.values()
+        return {'packets_handled': self.packets_handled, 'acks': self.acks, 'naks': self.naks,
+                'radio_rx': self.radio_rx, 'radio_tx': self.radio_tx, 'batches_rx': self.batches_rx,
+                'batches_tx': self.batches_tx, 'bytes_dropped': self.bytes_dropped,
+                'crcs_corrupted': self.crcs_corrupted,
+                'node_retransmits': sum(node.retransmits for node in nodes),
+                'node_responses': sum(node.responses for node in nodes)}
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # run() - setup() once, then loop() forever
+    # ------------------------------------------------------------------------------
+    def run(self):
+
+        # Opening the port resets a real Moteino, and it takes a moment to boot
+        time.sleep(self.boot_delay)
+
+        # UART.begin(): get ready to receive, stop batching, and tell the host we're alive
+        self.make_ready_to_receive()
+        self.batching = False
+        self.transmit(SP_ALIVE)
+
+        while not self.stopping:
+
+            # The ISR: collect whatever the host has sent
+            readable, _, _ = select.select([self.master], [], [], self.idle_time())
+            if readable:
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:
+                    break
+                self.receive(data)
+
+            if self.is_message_waiting():
+                self.dispatch_serial_message(bytes(self.rx_buffer))
+                self.acknowledge_handled_packet()
+
+            if self.is_radio_initialized:
+                self.run_radio()
+
+            self.service_batch()
+    # ------------------------------------------------------------------------------
+
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # From here on down are methods that are private to this class
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+
+    # ------------------------------------------------------------------------------
+    # idle_time() - How long the loop may wait for serial data before it has other
+    #               work to do
+    # ------------------------------------------------------------------------------
+    def idle_time(self):
+
+        # A partial prologue or packet may be about to time out, or a batch be due
+        if self.rx_buffer or self.tx_batch:
+            return .002
+
+        if not self.is_radio_initialized:
+            return .05
+
+        due = [self.schedule[0][0]] if self.schedule else []
+        if self.next_burst is not None:
+            due.append(self.next_burst)
+        if not due:
+            return .05
+
+        return min(.05, max(0, min(due) - time.monotonic()))
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # receive() - What the receive ISR does with each incoming byte
+    # ------------------------------------------------------------------------------
+    def receive(self, data):
+
+        for byte in data:
+
+            if self.faults.rx_drop_rate and random.random() < self.faults.rx_drop_rate:
+                self.bytes_dropped += 1
+                continue
+
+            # The firmware's buffer is 256 bytes and its pointer wraps
+            if len(self.rx_buffer) < 256:
+                self.rx_buffer.append(byte)
+
+            if len(self.rx_buffer) <= 2:
+                self.rx_start = time.monotonic()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # is_message_waiting() - CPacketUART::rx_state_machine()
+    # ------------------------------------------------------------------------------
+    def is_message_waiting(self):
+
+        rx_count = len(self.rx_buffer)
+
+        # If we're waiting for the first prologue byte to arrive...
+        if self.rx_state == WAIT_PROLOGUE_1:
+            if rx_count == 0:
+                return False
+            self.rx_state = WAIT_PROLOGUE_2
+
+        # If we're waiting for the 2nd prologue byte to arrive and it hasn't...
+        if self.rx_state == WAIT_PROLOGUE_2 and rx_count == 1:
+            if time.monotonic() - self.rx_start > .020:
+                self.make_ready_to_receive()
+                self.transmit_ack(SP_NAK)
+            return False
+
+        # If we're waiting for the 2nd prologue byte to arrive and it has...
+        if self.rx_state == WAIT_PROLOGUE_2 and rx_count == 2:
+            if self.rx_buffer[0] == (~self.rx_buffer[1] & 0xFF):
+                del self.rx_buffer[1]
+                self.transmit_ack(SP_READY)
+                self.rx_state = WAIT_PACKET_COMPLETE
+            else:
+                self.make_ready_to_receive()
+                self.transmit_ack(SP_NAK)
+            return False
+
+        # We haven't received any bytes after the prologue yet
+        if rx_count == 1:
+            return False
+
+        # If we don't have a complete message yet...
+        if rx_count != self.rx_buffer[0]:
+            if time.monotonic() - self.rx_start > .020:
+                self.make_ready_to_receive()
+                self.transmit_ack(SP_NAK)
+            return False
+
+        # We have a complete packet.  Reject it if the CRC is wrong
+        packet_crc = self.rx_buffer[1] | (self.rx_buffer[2] << 8)
+        if packet_crc != fast_crc16(self.rx_buffer[CRC_START:]):
+            self.make_ready_to_receive()
+            self.transmit_ack(SP_NAK)
+            return False
+
+        self.packets_handled += 1
+        return True
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # make_ready_to_receive() - Empties the receive buffer
+    # ------------------------------------------------------------------------------
+    def make_ready_to_receive(self):
+        self.rx_buffer.clear()
+        self.rx_state = WAIT_PROLOGUE_1
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # acknowledge_handled_packet() - Tells the host it may send the next packet
+    # ------------------------------------------------------------------------------
+    def acknowledge_handled_packet(self):
+        self.make_ready_to_receive()
+        self.transmit_ack(SP_READY)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # dispatch_serial_message() - Processes a packet from the host
+    # ------------------------------------------------------------------------------
+    def dispatch_serial_message(self, raw):
+
+        packet_type = raw[3]
+
+        if packet_type == SP_ECHO:
+            self.transmit(SP_ECHO, raw[4:])
+
+        elif packet_type == SP_INIT_RADIO:
+            _, _, _, frequency, node_id, network_id = INIT_RADIO_FORMAT.unpack_from(raw)
+            if frequency not in (915, 868, 433):
+                self.printf(f"Bad frequency: {frequency}")
+                return
+            self.radio_node_id = node_id
+            self.network_id = network_id
+            self.start_radio()
+
+        elif packet_type == SP_ENCRYPT_KEY:
+            self.encryption_key = bytes(raw[4:20])
+
+        elif packet_type == SP_TO_RADIO:
+            _, _, _, dst_node = TO_RADIO_HEADER.unpack_from(raw)
+            self.send_to_radio(dst_node, raw[TO_RADIO_HEADER.size:])
+
+        elif packet_type == SP_BATCH and self.batching_supported:
+            self.handle_batch(raw)
+
+        else:
+            self.printf(f"Recvd unknown packet type {packet_type}")
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # handle_batch() - Sends each packet in a batch to the radio, or agrees to
+    #                  batching if the batch is empty
+    # ------------------------------------------------------------------------------
+    def handle_batch(self, raw):
+
+        if len(raw) == PACKET_HEADER_SIZE:
+            self.transmit(SP_BATCH)
+            self.batching = True
+            return
+
+        self.batches_rx += 1
+        position = PACKET_HEADER_SIZE
+        while position < len(raw):
+            sub_len = raw[position]
+            if sub_len < SUB_HEADER_SIZE or position + sub_len > len(raw):
+                self.printf("Bad batch")
+                return
+            if raw[position + 1] == SP_TO_RADIO and sub_len >= BATCHED_TO_RADIO.size:
+                _, _, dst_node = BATCHED_TO_RADIO.unpack_from(raw, position)
+                self.send_to_radio(dst_node, raw[position + BATCHED_TO_RADIO.size:position + sub_len])
+            else:
+                self.printf(f"Recvd unknown batched packet type {raw[position + 1]}")
+            position += sub_len
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # send_to_radio() - Delivers a packet from the host to one of our nodes
+    # ------------------------------------------------------------------------------
+    def send_to_radio(self, dst_node, payload):
+
+        if not self.is_radio_initialized:
+            self.printf("Radio not initialized!")
+            return
+
+        self.radio_tx += 1
+        node = self.nodes.get(dst_node)
+        if node is not None:
+            node.on_response(payload)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # start_radio() - Brings the virtual nodes to life, staggered over one interval
+    # ------------------------------------------------------------------------------
+    def start_radio(self):
+
+        self.is_radio_initialized = True
+
+        now = time.monotonic()
+        for node in self.nodes.values():
+            node.next_due = now + random.uniform(0, node.interval)
+        self.schedule = [(node.next_due, node.node_id) for node in self.nodes.values()]
+        heapq.heapify(self.schedule)
+
+        if self.faults.burst_size and self.faults.burst_every:
+            self.next_burst = now + self.faults.burst_every
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # run_radio() - Sends every radio packet that's due
+    # ------------------------------------------------------------------------------
+    def run_radio(self):
+
+        now = time.monotonic()
+
+        while self.schedule and self.schedule[0][0] <= now:
+            _, node_id = heapq.heappop(self.schedule)
+            node = self.nodes[node_id]
+            payload, wake = node.poll(now)
+            if payload is not None:
+                self.send_from_radio(node_id, payload, node.rssi)
+            heapq.heappush(self.schedule, (wake, node_id))
+
+        # A burst: lots of extra packets at once
+        if self.next_burst is not None and self.next_burst <= now:
+            self.next_burst = now + self.faults.burst_every
+            population = list(self.nodes.values())
+            for _ in range(self.faults.burst_size if population else 0):
+                node = random.choice(population)
+                self.send_from_radio(node.node_id, node.make_payload(), node.rssi)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # send_from_radio() - handle_incoming_radio_packet()
+    # ------------------------------------------------------------------------------
+    def send_from_radio(self, src_node, payload, rssi):
+        self.radio_rx += 1
+        header = FROM_RADIO_HEADER.pack(0, 0, SP_FROM_RADIO, src_node, self.radio_node_id, rssi)
+        self.queue(SP_FROM_RADIO, header[PACKET_HEADER_SIZE:] + payload)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # queue() - CPacketUART::queue(): sends a packet, or adds it to the batch
+    # ------------------------------------------------------------------------------
+    def queue(self, packet_type, body):
+
+        if not self.batching:
+            self.transmit(packet_type, body)
+            return
+
+        sub_len = SUB_HEADER_SIZE + len(body)
+        if PACKET_HEADER_SIZE + len(self.tx_batch) + sub_len > MAX_BATCH_SIZE:
+            self.flush_batch()
+
+        if not self.tx_batch:
+            self.tx_batch_start = time.monotonic()
+
+        self.tx_batch += bytes((sub_len, packet_type)) + body
+        self.tx_batched += 1
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # service_batch() - Sends the batch once it has been held for BATCH_HOLD
+    # ------------------------------------------------------------------------------
+    def service_batch(self):
+        if self.tx_batch and time.monotonic() - self.tx_batch_start >= BATCH_HOLD:
+            self.flush_batch()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # flush_batch() - Sends the batch, if there is one
+    # ------------------------------------------------------------------------------
+    def flush_batch(self):
+        if self.tx_batch:
+            self.transmit(SP_BATCH, bytes(self.tx_batch))
+            self.tx_batch.clear()
+            self.tx_batched = 0
+            self.batches_tx += 1
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # printf() - CPacketUART::printf()
+    # ------------------------------------------------------------------------------
+    def printf(self, text):
+        self.transmit(SP_PRINT, text.encode())
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # transmit_ack() - Sends an SP_READY or SP_NAK, late if the faults say so
+    # ------------------------------------------------------------------------------
+    def transmit_ack(self, packet_type):
+
+        if packet_type == SP_READY:
+            self.acks += 1
+        else:
+            self.naks += 1
+
+        if self.faults.ack_delay_rate and random.random() < self.faults.ack_delay_rate:
+            time.sleep(self.faults.ack_delay)
+
+        self.transmit(packet_type)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # transmit() - CPacketUART::transmit(): stamps the length and CRC on a packet
+    #              and writes it to the host, applying any faults
+    # ------------------------------------------------------------------------------
+    def transmit(self, packet_type, payload = b''):
+
+        body = bytes([packet_type]) + payload
+        crc = fast_crc16(body)
+
+        if self.faults.corrupt_rate and random.random() < self.faults.corrupt_rate:
+            crc ^= 0x5A5A
+            self.crcs_corrupted += 1
+
+        packet = bytes([len(body) + CRC_START]) + crc.to_bytes(2, 'little') + body
+
+        if self.faults.drop_rate:
+            kept = bytes(byte for byte in packet if random.random() >= self.faults.drop_rate)
+            self.bytes_dropped += len(packet) - len(kept)
+            packet = kept
+
+        try:
+            os.write(self.master, packet)
+        except OSError:
+            self.stopping = True
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# MAIN - Runs an emulator until interrupted, printing its statistics every few seconds
+# ==========================================================================================================
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Emulates a Moteino gateway and its nodes on a pty')
+    parser.add_argument('--nodes', type = int, default = 10, help = 'number of virtual nodes')
+    parser.add_argument('--interval', type = float, default = 10.0, help = 'seconds between telemetry packets per node')
+    parser.add_argument('--drop', type = float, default = 0.0, help = 'chance of dropping each byte sent to the host')
+    parser.add_argument('--rx-drop', type = float, default = 0.0, help = 'chance of dropping each byte from the host')
+    parser.add_argument('--corrupt', type = float, default = 0.0, help = 'chance of a bad CRC on each packet')
+    parser.add_argument('--ack-delay', type = float, default = 0.0, help = 'seconds to delay a delayed ACK')
+    parser.add_argument('--ack-delay-rate', type = float, default = 0.0, help = 'chance of delaying each ACK')
+    parser.add_argument('--burst', type = int, default = 0, help = 'packets in each burst')
+    parser.add_argument('--burst-every', type = float, default = 0.0, help = 'seconds between bursts')
+    args = parser.parse_args()
+
+    faults = Faults(drop_rate = args.drop, rx_drop_rate = args.rx_drop, corrupt_rate = args.corrupt,
+                    ack_delay = args.ack_delay, ack_delay_rate = args.ack_delay_rate,
+                    burst_size = args.burst, burst_every = args.burst_every)
+
+    emulator = GatewayEmulator(make_nodes(args.nodes, args.interval), faults)
+    emulator.start()
+    print(f"Emulated gateway on {emulator.path}")
+
+    try:
+        while True:
+            time.sleep(5)
+            print(emulator.stats())
+    except KeyboardInterrupt:
+        emulator.stop()
+
+# ==========================================================================================================
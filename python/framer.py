@@ -0,0 +1,205 @@
+# ==========================================================================================================
+# framer.py - Splits the byte stream coming from the gateway into CRC-checked packets
+# ==========================================================================================================
+import time
+from crc16 import fast_crc16
+import metrics
+
+CRC_SECONDS = metrics.histogram('moteino_crc_seconds', 'Time to check the CRC of each candidate packet',
+                                metrics.MICRO_BUCKETS)
+
+
+# ==========================================================================================================
+# build_frame() - Builds a packet the way the gateway sends it: length, CRC, packet type, payload.
+#                 For replays, benchmarks and tests, which need to produce what the framer accepts
+# ==========================================================================================================
+def build_frame(packet_type, payload):
+    body = bytes([packet_type]) + payload
+    return bytes([len(body) + 3]) + fast_crc16(body).to_bytes(2, 'little') + body
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# StreamFramer - Accumulates serial data in one reusable buffer and carves complete packets out of it
+#
+# Every packet from the gateway starts with a length byte (which counts itself), followed by a 16-bit
+# CRC and a packet-type byte.  A candidate packet is only accepted if its length is sane and its CRC
+# checks out.  When a candidate fails, the framer drops one byte and tries again at the next offset,
+# so a single lost or corrupted byte costs one packet rather than everything after it.
+#
+#     framer.feed(comport.read(comport.in_waiting or 1))
+#     for frame in framer.frames():
+#         ...
+#
+# The frames are memoryview slices of the internal buffer and are only valid until the loop
+# advances.  Anything that must outlive the loop body has to be copied out with bytes(frame).
+# ==========================================================================================================
+class StreamFramer:
+
+    HEADER_SIZE = 4      # Length byte, 2-byte CRC, packet-type byte
+    MIN_TYPE    = 0x01   # Lowest packet type the gateway sends
+    MAX_TYPE    = 0x0A   # Highest packet type the gateway sends (SP_BATCH)
+    ACK_TYPES   = (0x02, 0x09)  # SP_READY and SP_NAK
+
+    buffer     = None   # A bytearray of data received but not yet framed
+    on_discard = None   # If not None, called with a memoryview of every run of discarded bytes
+
+    # Counters
+    frames_ok       = 0  # Packets that passed the length and CRC checks
+    bytes_discarded = 0  # Bytes thrown away while hunting for a valid packet
+    resyncs         = 0  # Number of times we lost framing and had to hunt for a valid packet
+
+    # ------------------------------------------------------------------------------
+    # Constructor
+    # ------------------------------------------------------------------------------
+    def __init__(self, on_discard = None):
+        self.buffer = bytearray()
+        self.on_discard = on_discard
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # feed() - Appends newly received bytes to the buffer
+    # ------------------------------------------------------------------------------
+    def feed(self, data):
+        self.buffer += data
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # frames() - Yields every complete, valid packet in the buffer as a memoryview,
+    #            then discards the consumed bytes
+    # ------------------------------------------------------------------------------
+    def frames(self):
+
+        buffer = self.buffer
+        view = memoryview(buffer)
+        position = 0
+        discard_start = None
+
+        try:
+            while True:
+
+                available = len(buffer) - position
+
+                # We need at least the length byte
+                if available < 1:
+                    break
+
+                count = buffer[position]
+
+                # A packet can't be shorter than its header
+                if count < self.HEADER_SIZE:
+                    if discard_start is None:
+                        discard_start = position
+                    position += 1
+                    continue
+
+                # Wait for the rest of the packet to arrive
+                if available < count:
+                    break
+
+                frame = view[position:position + count]
+                packet_type = frame[3]
+                packet_crc = frame[1] | (frame[2] << 8)
+
+                # If this candidate is garbage, slide forward one byte and try again
+                if packet_type < self.MIN_TYPE or packet_type > self.MAX_TYPE \
+                        or (not self.crc_matches(frame, packet_crc) and not self.is_bare_ack(count, packet_type, packet_crc)):
+                    frame.release()
+                    if discard_start is None:
+                        discard_start = position
+                    position += 1
+                    continue
+
+                # If we skipped anything to get here, report it
+                if discard_start is not None:
+                    self.discard(view, discard_start, position)
+                    discard_start = None
+
+                position += count
+                self.frames_ok += 1
+
+                try:
+                    yield frame
+                finally:
+                    frame.release()
+
+            # Bytes that can't yet be judged stay in the buffer.  Bytes that have
+            # already been judged bad are reported now
+            if discard_start is not None:
+                self.discard(view, discard_start, position)
+
+        finally:
+            view.release()
+
+            # Throw away everything we've consumed, even if the caller stopped early
+            del buffer[:position]
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # skip_stalled() - Called when the line has gone quiet with a partial packet in
+    #                  the buffer.  That packet is never going to complete, so its
+    #                  first byte is discarded and framing resumes after it
+    # ------------------------------------------------------------------------------
+    def skip_stalled(self):
+
+        if not self.buffer:
+            return
+
+        view = memoryview(self.buffer)
+        try:
+            self.discard(view, 0, 1)
+        finally:
+            view.release()
+
+        del self.buffer[0]
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # pending() - Returns the number of bytes waiting for the rest of their packet
+    # ------------------------------------------------------------------------------
+    def pending(self):
+        return len(self.buffer)
+    # ------------------------------------------------------------------------------
+
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # From here on down are methods that are private to this class
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+
+    # ------------------------------------------------------------------------------
+    # crc_matches() - Checks a candidate packet's CRC, timing the check
+    # ------------------------------------------------------------------------------
+    def crc_matches(self, frame, packet_crc):
+        start_time = time.perf_counter()
+        result = packet_crc == fast_crc16(frame[3:])
+        CRC_SECONDS.observe(time.perf_counter() - start_time)
+        return result
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # is_bare_ack() - The firmware's ACK and NAK are constant headers.  Where that
+    #                 constant can't be written to, they arrive with a CRC of zero,
+    #                 so a header-only ACK/NAK with a zero CRC is accepted as-is
+    # ------------------------------------------------------------------------------
+    def is_bare_ack(self, count, packet_type, packet_crc):
+        return count == self.HEADER_SIZE and packet_crc == 0 and packet_type in self.ACK_TYPES
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # discard() - Counts a run of discarded bytes and reports it
+    # ------------------------------------------------------------------------------
+    def discard(self, view, start, end):
+
+        self.bytes_discarded += end - start
+        self.resyncs += 1
+
+        if self.on_discard:
+            junk = view[start:end]
+            try:
+                self.on_discard(junk)
+            finally:
+                junk.release()
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
@@ -0,0 +1,73 @@
+# ==========================================================================================================
+# http_server.py - Serves the Flask API from a background thread of the gateway process
+# ==========================================================================================================
+import threading
+
+# waitress is the better server, if it's installed; otherwise Werkzeug's threaded server does the job
+try:
+    import waitress.server
+except ImportError:
+    waitress = None
+
+from werkzeug.serving import make_server
+
+
+# ==========================================================================================================
+# ApiServer - A threaded WSGI server running an application on its own daemon thread
+#
+# Because it runs inside the gateway process, the API reads the same caches, registry and mailbox
+# that the ingest loop writes, with nothing to keep in sync.  Every connection gets a thread of its
+# own, so a long-lived /stream client never holds up an ordinary request.
+# ==========================================================================================================
+class ApiServer(threading.Thread):
+
+    server = None  # The waitress or Werkzeug server
+    kind   = None  # 'waitress' or 'werkzeug'
+
+    # ------------------------------------------------------------------------------
+    # Constructor - Binds the listening socket straight away, so a port that's in use
+    #               is reported before the thread starts.  "threads" is the most
+    #               connections waitress handles at once
+    # ------------------------------------------------------------------------------
+    def __init__(self, app, host = '0.0.0.0', port = 5000, threads = 72):
+        super().__init__(name = 'api-server', daemon = True)
+        if waitress is not None:
+            self.server = waitress.server.create_server(app, host = host, port = port, threads = threads)
+            self.kind   = 'waitress'
+        else:
+            self.server = make_server(host, port, app, threaded = True)
+            self.kind   = 'werkzeug'
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # run() - Serves requests until close() is called
+    # ------------------------------------------------------------------------------
+    def run(self):
+        if self.kind == 'waitress':
+            self.server.run()
+        else:
+            self.server.serve_forever()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # close() - Stops accepting requests.  Connections still open (such as /stream
+    #           clients) end with the process
+    # ------------------------------------------------------------------------------
+    def close(self):
+        if self.kind == 'waitress':
+            self.server.close()
+        else:
+            self.server.shutdown()
+            self.server.server_close()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # address() - Returns the (host, port) actually being listened on
+    # ------------------------------------------------------------------------------
+    def address(self):
+        if self.kind == 'waitress':
+            return self.server.effective_host, self.server.effective_port
+        return self.server.server_address[:2]
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
@@ -0,0 +1,164 @@
+# ==========================================================================================================
+# influx_pool.py - A pool of persistent InfluxDB connections shared by every thread in the process
+# ==========================================================================================================
+import threading
+import configparser
+import contextlib
+import os
+from influxdb import InfluxDBClient
+
+
+# ==========================================================================================================
+# read_db_config() - Parses one section of an INI file into a dictionary
+# ==========================================================================================================
+def read_db_config(filename='database.ini', section='influxdb'):
+    # Create a parser
+    parser = configparser.ConfigParser()
+    # Read the config file
+    parser.read(filename)
+
+    # Get section, default to influxdb
+    db_config = {}
+    if parser.has_section(section):
+        params = parser.items(section)
+        for param in params:
+            db_config[param[0]] = param[1]
+    else:
+        raise Exception(f'Section {section} not found in the {filename} file')
+
+    return db_config
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# InfluxPool - Hands out InfluxDB clients whose HTTP sessions stay open between uses
+#
+# Each client is checked out by exactly one thread at a time, so the serial ingest thread and any
+# number of Flask worker threads can share the pool.  The config file is parsed once, and is only
+# parsed again when its modification time changes.  Clients built from an older config are closed
+# when they are returned to the pool.
+# ==========================================================================================================
+class InfluxPool:
+
+    filename   = None  # Path of the INI file
+    section    = None  # Name of the INI section holding the connection parameters
+    max_idle   = 4     # Maximum number of idle clients we keep around
+    mutex      = None  # Protects everything below
+    idle       = None  # Stack of idle (generation, client) tuples
+    db_config  = None  # The most recently parsed config
+    mtime      = None  # Modification time of the config file when we parsed it
+    generation = 0     # Bumped every time the config is reloaded
+
+    # ------------------------------------------------------------------------------
+    # Constructor - Doesn't touch the config file or the network
+    # ------------------------------------------------------------------------------
+    def __init__(self, filename = 'database.ini', section = 'influxdb', max_idle = 4):
+        self.filename = filename
+        self.section  = section
+        self.max_idle = max_idle
+        self.mutex    = threading.Lock()
+        self.idle     = []
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # config() - Returns the parsed config, re-reading the file only if it changed
+    # ------------------------------------------------------------------------------
+    def config(self):
+        with self.mutex:
+            return self.refresh_config()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # connection() - A context manager that checks a client out of the pool:
+    #
+    #     with pool.connection() as client:
+    #         client.write_points(points)
+    # ------------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def connection(self):
+
+        generation, client = self.checkout()
+
+        try:
+            yield client
+
+        # If the client blew up, don't trust its session again
+        except Exception:
+            client.close()
+            raise
+
+        self.checkin(generation, client)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # close() - Closes every idle client
+    # ------------------------------------------------------------------------------
+    def close(self):
+        with self.mutex:
+            idle, self.idle = self.idle, []
+        for _, client in idle:
+            client.close()
+    # ------------------------------------------------------------------------------
+
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # From here on down are methods that are private to this class
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+
+    # ------------------------------------------------------------------------------
+    # refresh_config() - Re-parses the config file if its mtime has changed.
+    #                    Caller must hold the mutex
+    # ------------------------------------------------------------------------------
+    def refresh_config(self):
+
+        mtime = os.stat(self.filename).st_mtime_ns
+
+        if mtime != self.mtime:
+            self.db_config = read_db_config(self.filename, self.section)
+            self.mtime = mtime
+            self.generation += 1
+
+        return self.db_config
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # checkout() - Returns an idle client, or builds a new one
+    # ------------------------------------------------------------------------------
+    def checkout(self):
+
+        with self.mutex:
+            db_config = self.refresh_config()
+            generation = self.generation
+
+            # Throw away idle clients built from an old config
+            stale = [c for g, c in self.idle if g != generation]
+            if stale:
+                self.idle = [(g, c) for g, c in self.idle if g == generation]
+
+            client = self.idle.pop()[1] if self.idle else None
+
+        for old_client in stale:
+            old_client.close()
+
+        if client is None:
+            client = InfluxDBClient(db_config['server'], db_config['influx_port'],
+                                    db_config['user'], db_config['passwd'], db_config['db'])
+
+        return generation, client
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # checkin() - Returns a client to the pool, or closes it if it's no longer wanted
+    # ------------------------------------------------------------------------------
+    def checkin(self, generation, client):
+
+        with self.mutex:
+            if generation == self.generation and len(self.idle) < self.max_idle:
+                self.idle.append((generation, client))
+                return
+
+        client.close()
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
@@ -0,0 +1,404 @@
+# ==========================================================================================================
+# influx_writer.py - Batches points in memory and writes them to InfluxDB from a background thread
+# ==========================================================================================================
+import threading
+import collections
+import time
+import metrics
+
+WRITE_SECONDS = metrics.histogram('influx_write_seconds', 'Time to write one batch of points to InfluxDB')
+REPLAYED      = metrics.counter('influx_spool_replayed_points_total', 'Points written to InfluxDB from the spool')
+CATCH_UP_RATE = metrics.gauge('influx_spool_catch_up_points_per_second',
+                              'Rate at which the spool was last drained into InfluxDB')
+
+
+# ==========================================================================================================
+# InfluxWriter - Accepts points from the ingest loop and flushes them to the database in batches
+#
+# A batch is flushed when "batch_size" points are waiting, or when the oldest waiting point is
+# "max_age" seconds old, whichever comes first.  The queue never holds more than "max_queued"
+# points; once it is full, newly arriving points are counted as dropped rather than blocking
+# the caller.
+#
+# If a Spool is given, points are only dropped when the spool itself is full or can't be written.  A
+# batch that can't be written, and anything arriving while the queue is full, goes to the spool
+# instead, and the writer backs off before trying the database again.  All spooling happens on the
+# writer thread, so write() never waits on the disk.  While the spool holds anything, new batches
+# are appended behind it, and the spool is drained from the front in batches of "bulk_size", so
+# points reach the database in the order they arrived.  Every point is stamped with the time it was
+# queued, so a point written late still lands at the right time.  The writer closes the spool when
+# it exits.
+#
+# flush() is a barrier: it writes out whatever is queued without waiting for the batch to fill or
+# age, and returns once every point handed to write() so far has been written to the database,
+# spooled or dropped.
+# ==========================================================================================================
+class InfluxWriter(threading.Thread):
+
+    MIN_BACKOFF = 1.0    # Seconds to wait after the first failed write
+    MAX_BACKOFF = 60.0   # Longest we ever wait between attempts
+
+    pool       = None  # The InfluxPool we borrow database connections from
+    queue      = None  # Points waiting to be written
+    overflow   = None  # Points that arrived while the queue was full, waiting to be spooled
+    condition  = None  # Protects the queue and wakes the writer thread
+    oldest     = None  # Time at which the oldest point in the queue was enqueued
+    stopping   = False # True once shutdown() has been called
+    flushing   = 0     # Number of callers waiting in flush()
+    busy       = False # True while the writer thread holds points it has taken from the queues
+    batch_size = 500
+    max_age    = 1.0
+    max_queued = 50000
+    spool      = None  # Where points go when they can't be written, or None to drop them
+    bulk_size  = 5000  # Points per write when draining the spool
+    retry_at   = 0     # Don't try the database again before this time
+    backoff    = 1.0   # Seconds to back off after the next failure
+
+    # Counters
+    queued     = 0     # Points accepted by write()
+    flushed    = 0     # Points successfully written to the database
+    dropped    = 0     # Points thrown away because the queue was full or the write or spool failed
+    spooled    = 0     # Points sent to the spool
+    replayed   = 0     # Points written to the database from the spool
+
+    # ------------------------------------------------------------------------------
+    # Constructor - Saves the configuration and creates the objects we'll need to
+    #               communicate with the writer thread
+    # ------------------------------------------------------------------------------
+    def __init__(self, pool, batch_size = 500, max_age = 1.0, max_queued = 50000, spool = None):
+
+        # Call the base class constructor
+        threading.Thread.__init__(self)
+
+        # Ensure that this thread exits when the main program does
+        self.daemon = True
+
+        self.pool       = pool
+        self.batch_size = batch_size
+        self.max_age    = max_age
+        self.max_queued = max_queued
+        self.spool      = spool
+
+        # Create empty queues of points, and the condition that protects them
+        self.queue = collections.deque()
+        self.overflow = []
+        self.condition = threading.Condition()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # write() - Queues a list of points for writing.  Never blocks on the database
+    # ------------------------------------------------------------------------------
+    def write(self, points):
+
+        now = time.time_ns()
+
+        with self.condition:
+
+            for point in points:
+
+                # Remember when the point arrived, however late it gets written
+                point.setdefault('time', now)
+
+                # If the queue is full, have the writer thread spool this point, or throw it away
+                if len(self.queue) >= self.max_queued:
+                    if self.spool is not None and len(self.overflow) < self.max_queued:
+                        self.overflow.append(point)
+                    else:
+                        self.dropped += 1
+                    continue
+
+                # If this is the first point in an empty queue, start the age clock
+                if not self.queue:
+                    self.oldest = time.monotonic()
+
+                self.queue.append(point)
+                self.queued += 1
+
+            # If we have a full batch, or points to spool, wake up the writer thread
+            if len(self.queue) >= self.batch_size or self.overflow:
+                self.condition.notify_all()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # flush() - Waits until every point passed to write() so far has been written
+    #           to the database, spooled or dropped, writing queued points right
+    #           away rather than when their batch is due
+    #
+    # Returns: True, or False if "timeout" seconds passed first
+    # ------------------------------------------------------------------------------
+    def flush(self, timeout = None):
+
+        with self.condition:
+            self.flushing += 1
+            self.condition.notify_all()
+            try:
+                return self.condition.wait_for(lambda: not (self.queue or self.overflow or self.busy), timeout)
+            finally:
+                self.flushing -= 1
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # shutdown() - Tells the writer thread to flush whatever is queued and exit
+    # ------------------------------------------------------------------------------
+    def shutdown(self, timeout = 10):
+
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+        if self.is_alive():
+            self.join(timeout)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # stats() - Returns a dictionary of the writer's counters
+    # ------------------------------------------------------------------------------
+    def stats(self):
+        with self.condition:
+            return {
+                'queued'  : self.queued,
+                'flushed' : self.flushed,
+                'dropped' : self.dropped,
+                'spooled' : self.spooled,
+                'replayed': self.replayed,
+                'pending' : len(self.queue) + len(self.overflow)
+            }
+    # ------------------------------------------------------------------------------
+
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # From here on down are methods that are private to this class
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+
+    # ------------------------------------------------------------------------------
+    # next_batch() - Waits until a batch is due, then removes it from the queue.
+    #                Returns None when we're shutting down and the queue is empty,
+    #                or an empty list if "timeout" seconds pass first or there are
+    #                overflow points to spool
+    # ------------------------------------------------------------------------------
+    def next_batch(self, timeout = None):
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.condition:
+
+            while True:
+
+                # If we have a full batch, or we're shutting down, or somebody is waiting
+                # in flush(), stop waiting
+                if len(self.queue) >= self.batch_size or self.stopping or (self.flushing and self.queue):
+                    break
+
+                # If points have overflowed the queue, go and spool them
+                if self.overflow:
+                    return []
+
+                # If the oldest point has waited long enough, stop waiting
+                if self.queue:
+                    remaining = self.oldest + self.max_age - time.monotonic()
+                    if remaining <= 0:
+                        break
+                else:
+                    remaining = None
+
+                # If the caller has something else to do, don't wait past it
+                if deadline is not None:
+                    until_deadline = deadline - time.monotonic()
+                    if until_deadline <= 0:
+                        return []
+                    remaining = until_deadline if remaining is None else min(remaining, until_deadline)
+
+                self.condition.wait(remaining)
+
+            # If there is nothing to write, we're done
+            if not self.queue:
+                return None
+
+            # Pull a batch of points out of the queue
+            count = min(len(self.queue), self.batch_size)
+            batch = [self.queue.popleft() for _ in range(count)]
+            self.busy = True
+
+            # Whatever is left in the queue starts a fresh age clock
+            self.oldest = time.monotonic() if self.queue else None
+
+            return batch
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # run() - The writer thread.  Flushes batches until shutdown() is called
+    # ------------------------------------------------------------------------------
+    def run(self):
+
+        while True:
+
+            batch = self.next_batch(self.time_to_retry())
+            self.spool_overflow()
+
+            if batch:
+                self.deliver(batch)
+
+            self.settle()
+            if batch is None:
+                break
+
+            if self.spool is not None:
+                if self.spool.points and time.monotonic() >= self.retry_at:
+                    self.catch_up()
+                self.spool.sync()
+
+        if self.spool is not None:
+            self.spool.close()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # deliver() - Writes a batch to the database, or spools it
+    # ------------------------------------------------------------------------------
+    def deliver(self, batch):
+
+        # Keep things in order: while the spool holds anything, or the database is
+        # known to be down, new points go in behind what's already spooled
+        if self.spool is not None and (self.spool.points or time.monotonic() < self.retry_at):
+            self.spool_points(batch)
+            return
+
+        if self.write_batch(batch):
+            return
+
+        if self.spool is None:
+            with self.condition:
+                self.dropped += len(batch)
+            return
+
+        self.back_off()
+        self.spool_points(batch)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # catch_up() - Drains the spool into the database in large batches, until it's
+    #              empty, a write fails, or a batch of live points is due
+    # ------------------------------------------------------------------------------
+    def catch_up(self):
+
+        start_time = time.perf_counter()
+        replayed = 0
+
+        while True:
+
+            points, position = self.spool.read(self.bulk_size)
+            if not points:
+                break
+
+            if not self.write_batch(points):
+                self.back_off()
+                break
+
+            self.spool.commit(position)
+            replayed += len(points)
+
+            # Don't let the live queue back up behind a long catch-up
+            with self.condition:
+                if len(self.queue) >= self.batch_size or self.stopping:
+                    break
+
+        if replayed:
+            REPLAYED.inc(replayed)
+            CATCH_UP_RATE.set(replayed / (time.perf_counter() - start_time))
+            with self.condition:
+                self.replayed += replayed
+            print(f"Replayed {replayed} spooled points into InfluxDB, {self.spool.points} still spooled")
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # write_batch() - Writes points to the database
+    #
+    # Returns: True on success, otherwise False
+    # ------------------------------------------------------------------------------
+    def write_batch(self, batch):
+
+        try:
+            start_time = time.perf_counter()
+            with self.pool.connection() as client:
+                client.write_points(batch)
+            WRITE_SECONDS.observe(time.perf_counter() - start_time)
+        except Exception as e:
+            print(f"Error uploading to InfluxDB: {e}")
+            return False
+
+        with self.condition:
+            self.flushed += len(batch)
+        self.backoff = self.MIN_BACKOFF
+        return True
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # spool_overflow() - Spools the points that arrived while the queue was full
+    # ------------------------------------------------------------------------------
+    def spool_overflow(self):
+
+        with self.condition:
+            points, self.overflow = self.overflow, []
+            if points:
+                self.busy = True
+
+        if points:
+            self.spool_points(points)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # settle() - Says the points taken from the queues have all been dealt with,
+    #            waking anyone waiting in flush()
+    # ------------------------------------------------------------------------------
+    def settle(self):
+        with self.condition:
+            self.busy = False
+            if self.flushing:
+                self.condition.notify_all()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # spool_points() - Appends points to the spool, counting them as dropped if it
+    #                  won't take them or can't be written
+    # ------------------------------------------------------------------------------
+    def spool_points(self, points):
+
+        try:
+            accepted = self.spool.append(points)
+        except OSError as e:
+            print(f"Error spooling {len(points)} points: {e}")
+            accepted = False
+
+        with self.condition:
+            if accepted:
+                self.spooled += len(points)
+            else:
+                self.dropped += len(points)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # back_off() - Leaves the database alone for a while after a failed write,
+    #              waiting twice as long after each consecutive failure
+    # ------------------------------------------------------------------------------
+    def back_off(self):
+        self.retry_at = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # time_to_retry() - Returns how long next_batch() may wait before the spool
+    #                   needs attention, or None if it doesn't
+    # ------------------------------------------------------------------------------
+    def time_to_retry(self):
+
+        if self.spool is None:
+            return None
+
+        if self.spool.points:
+            return max(0.0, self.retry_at - time.monotonic())
+
+        # Nothing to replay, but wake up to fsync() anything recently spooled
+        return self.spool.sync_interval if self.spool.unsynced else None
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
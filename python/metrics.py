@@ -0,0 +1,229 @@
+# ==========================================================================================================
+# metrics.py - Low-overhead counters, gauges and fixed-bucket histograms, rendered in the Prometheus
+#              text exposition format
+#
+# Metrics are created once, at import time, by the module that updates them:
+#
+#     ACK_RTT = metrics.histogram('moteino_ack_rtt_seconds', 'Time from write to gateway ACK')
+#     ...
+#     ACK_RTT.observe(time.perf_counter() - start)
+#
+# and render() produces the text for every metric that has been created.  Updating a metric costs
+# an uncontended lock and a few additions; nothing is allocated.
+# ==========================================================================================================
+import bisect
+import math
+import threading
+import time
+
+# Bucket upper bounds, in seconds, for things measured in microseconds and for things measured in
+# milliseconds to seconds
+MICRO_BUCKETS   = (1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, .01)
+LATENCY_BUCKETS = (1e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+# Every metric that has been created, in the order it was created
+registry = []
+
+
+# ==========================================================================================================
+# Counter - A number that only goes up, optionally split by the value of one label
+# ==========================================================================================================
+class Counter:
+
+    kind = 'counter'
+
+    name   = None  # Metric name
+    help   = None  # One-line description
+    label  = None  # Name of the label, or None
+    values = None  # Dictionary of label value (None if unlabelled) -> count
+    mutex  = None
+
+    def __init__(self, name, help, label = None):
+        self.name   = name
+        self.help   = help
+        self.label  = label
+        self.values = {} if label else {None: 0}
+        self.mutex  = threading.Lock()
+
+    def inc(self, amount = 1, label_value = None):
+        with self.mutex:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def samples(self):
+        with self.mutex:
+            return list(self.values.items())
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# Gauge - A number that goes up and down.  Either set() it, or give it a function that is called
+#         at render time and returns a number (or, for a labelled gauge, a dictionary of label
+#         value -> number)
+# ==========================================================================================================
+class Gauge:
+
+    kind = 'gauge'
+
+    name     = None  # Metric name
+    help     = None  # One-line description
+    label    = None  # Name of the label, or None
+    value    = 0     # The value, if there is no function
+    function = None  # Called at render time to get the value
+
+    def __init__(self, name, help, function = None, label = None):
+        self.name     = name
+        self.help     = help
+        self.function = function
+        self.label    = label
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.function() if self.function else self.value
+        return list(value.items()) if self.label else [(None, value)]
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# Rate - A gauge of events per second for each value of a label, exponentially decayed so that it
+#        follows the recent rate.  "half_life" is in seconds
+# ==========================================================================================================
+class Rate:
+
+    kind = 'gauge'
+
+    name   = None  # Metric name
+    help   = None  # One-line description
+    label  = None  # Name of the label
+    tau    = 0     # Time constant of the decay
+    values = None  # Dictionary of label value -> (rate at "when", when)
+    mutex  = None
+
+    def __init__(self, name, help, label, half_life = 60.0):
+        self.name   = name
+        self.help   = help
+        self.label  = label
+        self.tau    = half_life / math.log(2)
+        self.values = {}
+        self.mutex  = threading.Lock()
+
+    def mark(self, label_value):
+        now = time.monotonic()
+        with self.mutex:
+            rate, when = self.values.get(label_value, (0.0, now))
+            self.values[label_value] = (rate * math.exp((when - now) / self.tau) + 1 / self.tau, now)
+
+    def samples(self):
+        now = time.monotonic()
+        with self.mutex:
+            return [(key, rate * math.exp((when - now) / self.tau)) for key, (rate, when) in self.values.items()]
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# Histogram - Counts observations into fixed buckets
+# ==========================================================================================================
+class Histogram:
+
+    kind = 'histogram'
+
+    name    = None  # Metric name
+    help    = None  # One-line description
+    buckets = None  # Tuple of bucket upper bounds, ascending
+    counts  = None  # List of counts, one per bucket plus one for +Inf
+    total   = 0     # Number of observations
+    sum     = 0.0   # Sum of all observations
+    mutex   = None
+
+    def __init__(self, name, help, buckets = LATENCY_BUCKETS):
+        self.name    = name
+        self.help    = help
+        self.buckets = tuple(buckets)
+        self.counts  = [0] * (len(self.buckets) + 1)
+        self.mutex   = threading.Lock()
+
+    # ------------------------------------------------------------------------------
+    # observe() - Records "count" observations of "value"
+    # ------------------------------------------------------------------------------
+    def observe(self, value, count = 1):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.mutex:
+            self.counts[index] += count
+            self.total += count
+            self.sum += value * count
+
+    # ------------------------------------------------------------------------------
+    # snapshot() - Returns (cumulative bucket counts, total, sum)
+    # ------------------------------------------------------------------------------
+    def snapshot(self):
+        with self.mutex:
+            counts, total, sum = list(self.counts), self.total, self.sum
+
+        running = 0
+        for i, count in enumerate(counts):
+            running += count
+            counts[i] = running
+
+        return counts, total, sum
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# counter(), gauge(), rate(), histogram() - Create a metric and add it to the registry
+# ==========================================================================================================
+def counter(name, help, label = None):
+    return add(Counter(name, help, label))
+
+def gauge(name, help, function = None, label = None):
+    return add(Gauge(name, help, function, label))
+
+def rate(name, help, label, half_life = 60.0):
+    return add(Rate(name, help, label, half_life))
+
+def histogram(name, help, buckets = LATENCY_BUCKETS):
+    return add(Histogram(name, help, buckets))
+
+def add(metric):
+    registry.append(metric)
+    return metric
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# render() - Returns every metric in the Prometheus text exposition format
+# ==========================================================================================================
+def render():
+
+    lines = []
+    for metric in registry:
+
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+
+        if metric.kind == 'histogram':
+            counts, total, sum = metric.snapshot()
+            for bound, count in zip(metric.buckets, counts):
+                lines.append(f'{metric.name}_bucket{{le="{bound:g}"}} {count}')
+            lines.append(f'{metric.name}_bucket{{le="+Inf"}} {total}')
+            lines.append(f'{metric.name}_sum {sum!r}')
+            lines.append(f'{metric.name}_count {total}')
+            continue
+
+        try:
+            samples = metric.samples()
+        except Exception:
+            continue
+
+        for label_value, value in samples:
+            if label_value is None:
+                lines.append(f'{metric.name} {value!r}')
+            else:
+                lines.append(f'{metric.name}{{{metric.label}="{label_value}"}} {value!r}')
+
+    return '\n'.join(lines) + '\n'
+# ==========================================================================================================
@@ -4,31 +4,76 @@
 # Vers    When     Who  What
 # --------------------------------------------------------------------------------------------------------
 # 1000  07-Jan-21  DWW  Initial creation
+# 1001  17-Oct-26  DWW  SP_BATCH: several packets under one CRC and one ACK, negotiated with the gateway
 # ========================================================================================================
 import serial
 import threading
 import socket
-import collections
 import select
 import struct
+import queue
+import time
+import concurrent.futures
+from crc16 import fast_crc16
+from framer import StreamFramer
+from capture import CaptureWriter, CapturingSerial
+from rx_queue import ReceiveQueue, DROP_OLDEST
+from rtt import RttEstimator
+import metrics
+
+# ==========================================================================================================
+# Every packet from the gateway starts with a 4-byte header: length, 2-byte CRC, packet type
+# ==========================================================================================================
+PACKET_HEADER_SIZE = 4
+
+# A radio packet follows the header with 2-byte src_node, 2-byte dst_node, 2-byte rssi, then data
+RADIO_HEADER = struct.Struct('<HHh')
+RADIO_DATA_OFFSET = PACKET_HEADER_SIZE + RADIO_HEADER.size
+
+# An SP_BATCH packet follows the header with sub-packets, each a 1-byte length (which counts itself),
+# the packet type, and the body of an ordinary packet of that type.  A batch is at most 255 bytes
+SUB_HEADER_SIZE = 2
+MAX_BATCH_SIZE  = 255
+# ==========================================================================================================
+
+# ==========================================================================================================
+# Instrumentation, exposed by metrics.render()
+# ==========================================================================================================
+FRAME_SECONDS = metrics.histogram('moteino_serial_frame_seconds',
+                                  'Time to frame and dispatch each packet read from the serial port',
+                                  metrics.MICRO_BUCKETS)
+SERIAL_BYTES  = metrics.counter('moteino_serial_bytes_total', 'Bytes read from the serial port')
+ACK_RTT       = metrics.histogram('moteino_ack_rtt_seconds', 'Time from a write to the gateway to its ACK')
+ACK_FAILURES  = metrics.counter('moteino_ack_failures_total', 'Writes to the gateway that were NAKed or timed out')
+TX_ABANDONED  = metrics.counter('moteino_tx_abandoned_total', 'Frames abandoned before the gateway ACKed them',
+                                label = 'reason')
+BATCHED       = metrics.counter('moteino_batched_packets_total', 'Packets carried in SP_BATCH frames',
+                                label = 'direction')
+# ==========================================================================================================
+
 
 # ==========================================================================================================
 # RadioPacket - Decodes an incoming radio packet
+#
+# The fixed header is unpacked once, with a precompiled Struct, into slots.  The packet keeps a
+# reference to the frame it was built from rather than a copy of the payload; "data" is only sliced
+# out of the frame the first time somebody asks for it, and the slice is kept for later callers.
 # ==========================================================================================================
 class RadioPacket:
 
-    src_node = None
-    dst_node = None
-    rssi     = None
-    data     = None
-
+    __slots__ = ('raw', 'src_node', 'dst_node', 'rssi', '_data')
 
-    # 4-byte header, 2-byte src_mode, 2-byte dst_node, 2-byte rssi, data
     def __init__(self, raw_packet):
-        format = '<4sHHh'
-        fixed_size = struct.calcsize(format)
-        _, self.src_node, self.dst_node, self.rssi = struct.unpack(format, raw_packet[:fixed_size])
-        self.data = raw_packet[fixed_size:]
+        self.raw = raw_packet
+        self.src_node, self.dst_node, self.rssi = RADIO_HEADER.unpack_from(raw_packet, PACKET_HEADER_SIZE)
+
+    @property
+    def data(self):
+        try:
+            return self._data
+        except AttributeError:
+            self._data = self.raw[RADIO_DATA_OFFSET:]
+            return self._data
 # ==========================================================================================================
 
 
@@ -36,67 +81,71 @@ class RadioPacket:
 # EchoPacket - Contains the payload of an SP_ECHO packet
 # ==========================================================================================================
 class EchoPacket:
+
+    __slots__ = ('raw',)
+
     def __init__(self, raw_packet):
-        self.payload = raw_packet[4:]
+        self.raw = raw_packet
+
+    @property
+    def payload(self):
+        return self.raw[PACKET_HEADER_SIZE:]
 # ==========================================================================================================
 
 # ==========================================================================================================
 # BadPacket - Indicates a packet that was thrown away due to bad CRC
 # ==========================================================================================================
 class BadPacket:
+
+    __slots__ = ('raw_packet',)
+
     def __init__(self, raw_packet):
         self.raw_packet = raw_packet
 # ==========================================================================================================
 
 
 # ==========================================================================================================
-# 8-bit CRC lookup table for polynomial 0x31
+# TxFrame - An outbound frame waiting in (or working its way through) the transmit queue
 # ==========================================================================================================
-crc16_table = [
-    0x0000, 0x1021, 0x2042, 0x3063, 0x4084, 0x50A5, 0x60C6, 0x70E7,
-    0x8108, 0x9129, 0xA14A, 0xB16B, 0xC18C, 0xD1AD, 0xE1CE, 0xF1EF,
-    0x1231, 0x0210, 0x3273, 0x2252, 0x52B5, 0x4294, 0x72F7, 0x62D6,
-    0x9339, 0x8318, 0xB37B, 0xA35A, 0xD3BD, 0xC39C, 0xF3FF, 0xE3DE,
-    0x2462, 0x3443, 0x0420, 0x1401, 0x64E6, 0x74C7, 0x44A4, 0x5485,
-    0xA56A, 0xB54B, 0x8528, 0x9509, 0xE5EE, 0xF5CF, 0xC5AC, 0xD58D,
-    0x3653, 0x2672, 0x1611, 0x0630, 0x76D7, 0x66F6, 0x5695, 0x46B4,
-    0xB75B, 0xA77A, 0x9719, 0x8738, 0xF7DF, 0xE7FE, 0xD79D, 0xC7BC,
-    0x48C4, 0x58E5, 0x6886, 0x78A7, 0x0840, 0x1861, 0x2802, 0x3823,
-    0xC9CC, 0xD9ED, 0xE98E, 0xF9AF, 0x8948, 0x9969, 0xA90A, 0xB92B,
-    0x5AF5, 0x4AD4, 0x7AB7, 0x6A96, 0x1A71, 0x0A50, 0x3A33, 0x2A12,
-    0xDBFD, 0xCBDC, 0xFBBF, 0xEB9E, 0x9B79, 0x8B58, 0xBB3B, 0xAB1A,
-    0x6CA6, 0x7C87, 0x4CE4, 0x5CC5, 0x2C22, 0x3C03, 0x0C60, 0x1C41,
-    0xEDAE, 0xFD8F, 0xCDEC, 0xDDCD, 0xAD2A, 0xBD0B, 0x8D68, 0x9D49,
-    0x7E97, 0x6EB6, 0x5ED5, 0x4EF4, 0x3E13, 0x2E32, 0x1E51, 0x0E70,
-    0xFF9F, 0xEFBE, 0xDFDD, 0xCFFC, 0xBF1B, 0xAF3A, 0x9F59, 0x8F78,
-    0x9188, 0x81A9, 0xB1CA, 0xA1EB, 0xD10C, 0xC12D, 0xF14E, 0xE16F,
-    0x1080, 0x00A1, 0x30C2, 0x20E3, 0x5004, 0x4025, 0x7046, 0x6067,
-    0x83B9, 0x9398, 0xA3FB, 0xB3DA, 0xC33D, 0xD31C, 0xE37F, 0xF35E,
-    0x02B1, 0x1290, 0x22F3, 0x32D2, 0x4235, 0x5214, 0x6277, 0x7256,
-    0xB5EA, 0xA5CB, 0x95A8, 0x8589, 0xF56E, 0xE54F, 0xD52C, 0xC50D,
-    0x34E2, 0x24C3, 0x14A0, 0x0481, 0x7466, 0x6447, 0x5424, 0x4405,
-    0xA7DB, 0xB7FA, 0x8799, 0x97B8, 0xE75F, 0xF77E, 0xC71D, 0xD73C,
-    0x26D3, 0x36F2, 0x0691, 0x16B0, 0x6657, 0x7676, 0x4615, 0x5634,
-    0xD94C, 0xC96D, 0xF90E, 0xE92F, 0x99C8, 0x89E9, 0xB98A, 0xA9AB,
-    0x5844, 0x4865, 0x7806, 0x6827, 0x18C0, 0x08E1, 0x3882, 0x28A3,
-    0xCB7D, 0xDB5C, 0xEB3F, 0xFB1E, 0x8BF9, 0x9BD8, 0xABBB, 0xBB9A,
-    0x4A75, 0x5A54, 0x6A37, 0x7A16, 0x0AF1, 0x1AD0, 0x2AB3, 0x3A92,
-    0xFD2E, 0xED0F, 0xDD6C, 0xCD4D, 0xBDAA, 0xAD8B, 0x9DE8, 0x8DC9,
-    0x7C26, 0x6C07, 0x5C64, 0x4C45, 0x3CA2, 0x2C83, 0x1CE0, 0x0CC1,
-    0xEF1F, 0xFF3E, 0xCF5D, 0xDF7C, 0xAF9B, 0xBFBA, 0x8FD9, 0x9FF8,
-    0x6E17, 0x7E36, 0x4E55, 0x5E74, 0x2E93, 0x3EB2, 0x0ED1, 0x1EF0
-]
+class TxFrame:
+    def __init__(self, frame, future, deadline):
+        self.frame    = frame              # The complete frame: CRC + packet type + payload
+        self.future   = future             # Resolved with True/False once the gateway ACKs or we give up
+        self.deadline = deadline           # time.monotonic() after which we stop trying
+        self.event    = threading.Event()  # Set by the reader thread when an ACK or NAK arrives
+        self.ack      = False              # True if the most recent reply was an ACK
+        self.failures = 0                  # Attempts (prologue or frame) that have failed so far
 # ==========================================================================================================
 
 # ==========================================================================================================
-# fast_crc16() - Computes the 16-bit CRC of a byte string
+# decode_packet() - Checks the CRC of a complete packet from the gateway and converts it to the
+#                   appropriate specialized packet class.  Packets of other types are returned as bytes.
+#                   Pass verify_crc=False for packets whose CRC has already been checked
 # ==========================================================================================================
-def fast_crc16(data):
-    crc = 0xFFFF
-    for value in data:
-        pos = (crc >> 8) ^ value
-        crc = ((crc << 8) ^ crc16_table[pos]) & 0xFFFF
-    return crc
+def decode_packet(packet, verify_crc = True):
+
+    # Packet-type is the 4th byte in the packet
+    packet_type = packet[3]
+
+    if verify_crc:
+
+        # Extract the CRC from the packet
+        packet_crc = int.from_bytes(packet[1:3], 'little')
+
+        # Compute a new CRC for the packet
+        new_crc = fast_crc16(packet[3:])
+
+        if packet_crc != new_crc:
+            print(">>> CRC MISMATCH DETECTED <<<")
+            return BadPacket(packet)
+
+    if packet_type == MoteinoGateway.SP_FROM_RADIO:
+        return RadioPacket(packet)
+
+    if packet_type == MoteinoGateway.SP_ECHO:
+        return EchoPacket(packet)
+
+    return packet
 # ==========================================================================================================
 
 # ==========================================================================================================
@@ -105,13 +154,38 @@ def fast_crc16(data):
 class MoteinoGateway(threading.Thread):
 
     comport    = None  # A PySerial object
-    queue      = None  # A queue of incoming packets
-    mutex      = None  # Mutex that protects the queue
-    event      = None  # An event that signals receipt of an ack from the gateway
+    queue      = None  # The ReceiveQueue of incoming packets
+    mutex      = None  # Mutex that protects the queue and "wakeup_pending"
+    tx_queue   = None  # A queue of TxFrame objects waiting to be sent to the gateway
+    tx_thread  = None  # The thread that drains tx_queue
+    in_flight  = None  # The TxFrame currently waiting for an ACK or NAK
+    framer     = None  # The StreamFramer that splits serial data into packets
+    stray_acks = 0     # ACKs/NAKs that arrived when nothing was waiting for one
     pipe_in    = None  # The read-side of a socket used for notifications
     pipe_out   = None  # The write-side of a socket used for notifications
-    packet_ack = False # True when the most recently sent packet gets acknowledged
-    local_port = 32122
+    wakeup_pending = False # True when a notification byte is sitting in the socket unread
+    wait_for_quiet = True  # Discard incoming bytes until the line goes quiet before framing
+    on_high_water  = None  # Called with the gateway when the receive queue passes its high-water mark
+    batching       = False # True once the gateway has agreed to SP_BATCH frames
+    batch_offered  = False # Set by the reader thread when the gateway answers an empty SP_BATCH
+    prologue_rtt   = None  # RttEstimator of how long the gateway takes to ACK a prologue
+    frame_rtt      = None  # RttEstimator of how long it takes to handle and ACK a frame
+    default_timeout = 10.0 # Seconds a send may take, including queueing, unless the caller says otherwise
+    closing        = False # Set by close() to stop the reader thread
+
+    # Counters
+    batches_sent     = 0   # SP_BATCH frames sent to the gateway
+    batched_sent     = 0   # Packets sent inside them
+    batches_received = 0   # SP_BATCH frames received from the gateway
+    batched_received = 0   # Packets received inside them
+    attempts         = 0   # Prologues and frames written to the gateway
+    timeouts         = 0   # Of those, how many went unanswered
+    naks             = 0   # Of those, how many were NAKed
+    expired          = 0   # Frames whose deadline passed while they were queued
+    gave_up          = 0   # Frames that ran out of attempts or time while being sent
+
+    PROLOGUE_ATTEMPTS = 10 # Most tries at a prologue before giving up on the frame
+    FRAME_ATTEMPTS    = 10 # Most tries at a frame (each with its own prologue)
 
     SP_PRINT       = 0x01      # From Gateway
     SP_READY       = 0x02      # From Gateway
@@ -122,77 +196,121 @@ class MoteinoGateway(threading.Thread):
     SP_FROM_RADIO  = 0x07      # From Gateway
     SP_TO_RADIO    = 0x08      # To Gateway
     SP_NAK         = 0x09      # From Gateway
+    SP_BATCH       = 0x0A      # To and From Gateway
 
     # ------------------------------------------------------------------------------
     # Constructor - Just calls the threading base-class constructor and creates
     #               objects we'll need to communicate between threads
+    #
+    # Passed: rx_capacity = Most radio packets the receive queue holds
+    #         rx_policy = What a full receive queue does: rx_queue.DROP_OLDEST,
+    #                     DROP_NEWEST or COALESCE
+    #         on_high_water = If not None, called on the reader thread with this
+    #                         gateway when the receive queue passes 80% full, so
+    #                         the application can shed load.  It must not block
+    #         default_timeout = Seconds a send may take, from the call to the ACK,
+    #                           when the caller doesn't pass a timeout
     # ------------------------------------------------------------------------------
-    def __init__(self):
+    def __init__(self, rx_capacity = 10000, rx_policy = DROP_OLDEST, on_high_water = None, default_timeout = 10.0):
 
         # Call the base class constructor
         threading.Thread.__init__(self)
 
         # Create an empty queue for our incoming messages
-        self.queue = collections.deque()
+        self.queue = ReceiveQueue(rx_capacity, rx_policy)
+        self.on_high_water = on_high_water
 
         # Create a mutex to protect the queue
         self.mutex = threading.Lock()
 
-        # Create an event to notify other thread of message receipts
-        self.event = threading.Event()
+        # Create the queue of outbound frames, and the thread that sends them, with
+        # ACK timeouts that adapt to how quickly the gateway answers
+        self.tx_queue = queue.Queue()
+        self.prologue_rtt = RttEstimator()
+        self.frame_rtt = RttEstimator()
+        self.default_timeout = default_timeout
+        self.tx_thread = threading.Thread(target=self.tx_writer, daemon=True)
 
     # ------------------------------------------------------------------------------
 
     # ------------------------------------------------------------------------------
     # startup() - Begins the process of monitoring the gateway
+    #
+    # Passed: port = A serial port name, or an object that behaves like an open
+    #                serial.Serial, such as a capture.ReplaySerial
+    #         capture = If not None, every byte read from and written to the port is
+    #                   recorded to a capture with this path prefix
+    #         wait_for_quiet = Discard whatever arrives until the line goes quiet.
+    #                          A replay wants every byte, so turns this off
     # ------------------------------------------------------------------------------
-    def startup(self, port):
+    def startup(self, port, capture = None, wait_for_quiet = True):
 
-        # Create a socket to start listening on
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(('localhost', self.local_port))
-        sock.listen(1)
+        # Create the connected pair of sockets the reader thread uses to wake us up
+        self.create_notification_pipe()
 
         # Open the connection to the serial port
-        self.comport = serial.Serial(port, 250000)
+        self.comport = serial.Serial(port, 250000) if isinstance(port, str) else port
+        self.wait_for_quiet = wait_for_quiet
+
+        # If asked to, record the raw byte stream in both directions
+        if capture:
+            self.comport = CapturingSerial(self.comport, CaptureWriter(capture))
 
         # Launch the thread that does a blocking read on the serial port
         self.launch_serial_reader_thread()
 
-        # Accept a connection from the other thread
-        self.pipe_in, _ = sock.accept()
-
-        # Close the temporary socket
-        sock.close()
+        # Launch the thread that transmits queued frames to the gateway
+        self.tx_thread.start()
     # ------------------------------------------------------------------------------
 
     # ------------------------------------------------------------------------------
     # wait_for_message() - Blocks, waiting for an incoming packet.  Returns
-    #                      the packet as bytes
+    #                      the packet, or None if the timeout expires
     # ------------------------------------------------------------------------------
     def wait_for_message(self, timeout_seconds = None):
+        packets = self.drain_messages(1, timeout_seconds)
+        return packets[0] if packets else None
+    # ------------------------------------------------------------------------------
 
-        # If the user wants a timeout, wait for data to arrive
-        if timeout_seconds:
-            ready = select.select([self.pipe_in], [], [], timeout_seconds)
-            if not ready[0]: return None
+    # ------------------------------------------------------------------------------
+    # drain_messages() - Blocks until at least one packet is available, then
+    #                    returns a list of up to "max_count" packets (or every
+    #                    waiting packet if max_count is None).  Returns an
+    #                    empty list if the timeout expires
+    # ------------------------------------------------------------------------------
+    def drain_messages(self, max_count = None, timeout_seconds = None):
+
+        # If the user wants a timeout, figure out when it expires
+        deadline = time.monotonic() + timeout_seconds if timeout_seconds else None
 
-        # Blocking read, waiting for a notification that a message is available
-        self.pipe_in.recv(1)
+        while True:
 
-        # And return the packet at the top of the FIFO
-        self.mutex.acquire()
-        packet = self.queue.popleft()
-        self.mutex.release()
-        return packet
+            with self.mutex:
+
+                # If there are packets waiting, hand them over, control packets first
+                if self.queue:
+                    return self.queue.drain(max_count)
+
+                # The queue is empty, so swallow any stale notification.  The
+                # reader thread will send a fresh one with the next packet
+                if self.wakeup_pending:
+                    self.pipe_in.recv(1)
+                    self.wakeup_pending = False
+
+            # Wait for a notification that a message is available
+            if deadline is None:
+                select.select([self.pipe_in], [], [])
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([self.pipe_in], [], [], remaining)[0]:
+                    return []
     # ------------------------------------------------------------------------------
 
     # ------------------------------------------------------------------------------
     # echo() - Ask the gateway to echo a message back to us
     # ------------------------------------------------------------------------------
-    def echo(self, payload):
-        return self.send_packet(self.SP_ECHO, payload)
+    def echo(self, payload, timeout = None):
+        return self.send_packet(self.SP_ECHO, payload, timeout)
     # ------------------------------------------------------------------------------
 
     # ------------------------------------------------------------------------------
@@ -216,14 +334,115 @@ class MoteinoGateway(threading.Thread):
         return self.send_packet(self.SP_ENCRYPT_KEY, key)
     # ------------------------------------------------------------------------------
 
+    # ------------------------------------------------------------------------------
+    # negotiate_batching() - Asks the gateway to carry several packets per frame.
+    #                        Call once the gateway is alive.  Radio packets queued
+    #                        together then go out as one SP_BATCH frame with a
+    #                        single prologue and ACK, and the gateway batches the
+    #                        radio packets it receives.  Firmware that predates
+    #                        SP_BATCH says it doesn't know the packet type, and we
+    #                        carry on sending single packets
+    #
+    # Returns: True if the gateway agreed to batching
+    # ------------------------------------------------------------------------------
+    def negotiate_batching(self):
+
+        self.batching = self.batch_offered = False
+
+        # The gateway's answer arrives before its ACK, so it has been seen by now
+        if self.send_packet(self.SP_BATCH, b''):
+            self.batching = self.batch_offered
+
+        return self.batching
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # link_stats() - Returns the health of the serial link as a dictionary: the
+    #                round-trip times of prologues and frames, and how often
+    #                writes had to be retried or were abandoned
+    # ------------------------------------------------------------------------------
+    def link_stats(self):
+        return {'prologue_rtt': self.prologue_rtt.stats(), 'frame_rtt': self.frame_rtt.stats(),
+                'attempts': self.attempts, 'retries': self.timeouts + self.naks, 'timeouts': self.timeouts,
+                'naks': self.naks, 'expired': self.expired, 'gave_up': self.gave_up,
+                'stray_acks': self.stray_acks}
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # batch_stats() - Returns the batching counters as a dictionary
+    # ------------------------------------------------------------------------------
+    def batch_stats(self):
+        return {'batching': self.batching, 'batches_sent': self.batches_sent, 'batched_sent': self.batched_sent,
+                'batches_received': self.batches_received, 'batched_received': self.batched_received}
+    # ------------------------------------------------------------------------------
+
     # ------------------------------------------------------------------------------
     # send_radio_packet() - Sends a data-packet to a node via the radio
     #
     # Returns: True on success, otherwise false
     # ------------------------------------------------------------------------------
-    def send_radio_packet(self, node_id, payload):
+    def send_radio_packet(self, node_id, payload, timeout = None):
+        return self.send_radio_packet_async(node_id, payload, timeout = timeout).result()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # send_radio_packet_async() - Queues a data-packet for a node and returns
+    #                             immediately
+    #
+    # Returns: A concurrent.futures.Future that resolves to True on success,
+    #          otherwise False.  If "callback" is given, it is called with the
+    #          future once it resolves.  If the gateway hasn't ACKed the packet
+    #          within "timeout" seconds (default_timeout if None), counting time
+    #          spent in the queue, it resolves to False
+    # ------------------------------------------------------------------------------
+    def send_radio_packet_async(self, node_id, payload, callback = None, timeout = None):
         packet = node_id.to_bytes(2, 'little') + payload
-        return self.send_packet(self.SP_TO_RADIO, packet)
+        return self.send_packet_async(self.SP_TO_RADIO, packet, callback, timeout)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # bulk_send_radio_packets() - Queues every (node_id, payload) pair and waits
+    #                             for them all to be sent
+    #
+    # Returns: A dictionary with the number of packets sent and failed, the
+    #          elapsed time, and the throughput in packets per second
+    # ------------------------------------------------------------------------------
+    def bulk_send_radio_packets(self, packets):
+
+        start_time = time.monotonic()
+
+        # Queue everything up front so the transmit thread never goes idle
+        futures = [self.send_radio_packet_async(node_id, payload) for node_id, payload in packets]
+
+        sent = sum(1 for future in futures if future.result())
+        elapsed = time.monotonic() - start_time
+
+        return {
+            'sent'    : sent,
+            'failed'  : len(futures) - sent,
+            'seconds' : elapsed,
+            'pps'     : len(futures) / elapsed if elapsed else 0.0
+        }
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # measure_downlink() - Sends "payload" to every node in "node_ids", first one
+    #                      blocking call at a time, then through the transmit
+    #                      queue, and reports packets per second for each
+    # ------------------------------------------------------------------------------
+    def measure_downlink(self, node_ids, payload):
+
+        start_time = time.monotonic()
+        for node_id in node_ids:
+            self.send_radio_packet(node_id, payload)
+        elapsed = time.monotonic() - start_time
+
+        queued = self.bulk_send_radio_packets([(node_id, payload) for node_id in node_ids])
+
+        return {
+            'blocking_pps' : len(node_ids) / elapsed if elapsed else 0.0,
+            'queued_pps'   : queued['pps']
+        }
     # ------------------------------------------------------------------------------
 
     # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
@@ -236,7 +455,30 @@ class MoteinoGateway(threading.Thread):
     # send_packet() - Sends a generic packet expressed as bytes and waits for
     #                 the gateway to send the acknowledgement
     # ------------------------------------------------------------------------------
-    def send_packet(self, packet_type, payload):
+    def send_packet(self, packet_type, payload, timeout = None):
+        return self.send_packet_async(packet_type, payload, timeout = timeout).result()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # send_packet_async() - Builds a frame in the caller's thread, places it on
+    #                       the transmit queue, and returns a Future.  The frame
+    #                       has "timeout" seconds from now to be ACKed
+    # ------------------------------------------------------------------------------
+    def send_packet_async(self, packet_type, payload, callback = None, timeout = None):
+
+        future = concurrent.futures.Future()
+        if callback:
+            future.add_done_callback(callback)
+
+        deadline = time.monotonic() + (self.default_timeout if timeout is None else timeout)
+        self.tx_queue.put(TxFrame(self.build_frame(packet_type, payload), future, deadline))
+        return future
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # build_frame() - Returns CRC + packet type + payload, ready for transmission
+    # ------------------------------------------------------------------------------
+    def build_frame(self, packet_type, payload):
 
         # Prepend the packet type to the packet data
         packet = packet_type.to_bytes(1, 'little') + payload
@@ -245,18 +487,148 @@ class MoteinoGateway(threading.Thread):
         crc = fast_crc16(packet).to_bytes(2, 'little')
 
         # Prepend the CRC to the packet
-        packet = crc + packet
+        return crc + packet
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # tx_writer() - The transmit thread.  Sends queued frames back-to-back until
+    #               it finds a None on the queue.  Once batching is negotiated,
+    #               radio packets that are waiting together go out as one batch
+    # ------------------------------------------------------------------------------
+    def tx_writer(self):
+
+        held = None
+        while True:
+
+            tx, held = held or self.tx_queue.get(), None
+            if tx is None:
+                break
+
+            # A caller may have cancelled the future while it sat in the queue, or
+            # its deadline may have passed
+            if not self.start_frame(tx):
+                continue
+
+            if self.batching and tx.frame[2] == self.SP_TO_RADIO:
+                batch, held = self.collect_batch(tx)
+            else:
+                batch = [tx]
+
+            # If the port fails, the error goes to everyone waiting on this send,
+            # and the thread carries on with the next one
+            try:
+                result = self.transmit_batch(batch) if len(batch) > 1 else self.transmit_frame(tx)
+            except Exception as e:
+                self.in_flight = None
+                for tx in batch:
+                    tx.future.set_exception(e)
+                continue
+
+            for tx in batch:
+                tx.future.set_result(result)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # collect_batch() - Gathers the radio packets already waiting behind "tx", as
+    #                   many as fit in one batch.  Never waits for more
+    #
+    # Returns: The list of TxFrames for the batch, and the TxFrame that ended it
+    #          and must be sent next, or None
+    # ------------------------------------------------------------------------------
+    def collect_batch(self, tx):
+
+        batch = [tx]
+
+        # Length byte + CRC + type, then each sub-packet loses its CRC but gains a length
+        size = PACKET_HEADER_SIZE + len(tx.frame) - 1
+
+        while True:
+
+            try:
+                tx = self.tx_queue.get_nowait()
+            except queue.Empty:
+                return batch, None
+
+            # The None that stops the thread goes back on the queue for tx_writer()
+            if tx is None:
+                self.tx_queue.put(None)
+                return batch, None
+
+            if tx.frame[2] != self.SP_TO_RADIO or size + len(tx.frame) - 1 > MAX_BATCH_SIZE:
+                return batch, tx
+
+            if self.start_frame(tx):
+                batch.append(tx)
+                size += len(tx.frame) - 1
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # start_frame() - Marks a queued frame as being sent
+    #
+    # Returns: False if the caller cancelled it, or its deadline has passed (in
+    #          which case it resolves to False), and it shouldn't be sent
+    # ------------------------------------------------------------------------------
+    def start_frame(self, tx):
+
+        if not tx.future.set_running_or_notify_cancel():
+            return False
+
+        if time.monotonic() >= tx.deadline:
+            self.expired += 1
+            TX_ABANDONED.inc(label_value = 'expired')
+            tx.future.set_result(False)
+            return False
+
+        return True
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # transmit_batch() - Sends several TO_RADIO frames as one SP_BATCH frame.  The
+    #                    batch gives up at the earliest of their deadlines
+    #
+    # Returns True if the gateway acknowledged the batch, else false
+    # ------------------------------------------------------------------------------
+    def transmit_batch(self, batch):
+
+        # Build the frame in place: CRC, type, then each frame's type and payload
+        # behind a length byte
+        frame = bytearray(3)
+        frame[2] = self.SP_BATCH
+        for tx in batch:
+            frame.append(len(tx.frame) - 1)
+            frame += memoryview(tx.frame)[2:]
+        frame[0:2] = fast_crc16(memoryview(frame)[2:]).to_bytes(2, 'little')
+
+        result = self.transmit_frame(TxFrame(frame, None, min(tx.deadline for tx in batch)))
+
+        self.batches_sent += 1
+        self.batched_sent += len(batch)
+        BATCHED.inc(len(batch), 'sent')
+
+        return result
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # transmit_frame() - Sends one frame (prologue + packet) to the gateway,
+    #                    retrying until it's ACKed, it runs out of attempts, or
+    #                    its deadline passes
+    #
+    # Returns True if the gateway acknowledged the packet, else false
+    # ------------------------------------------------------------------------------
+    def transmit_frame(self, tx):
 
         # The total length of the packet includes the length byte
-        packet_length = len(packet) + 1
+        packet_length = len(tx.frame) + 1
 
         # Make multiple attempts to transmit the prologue + packet
-        for attempt in range(0, 10):
-            if not self.send_prologue(packet_length):
+        for attempt in range(self.FRAME_ATTEMPTS):
+            if not self.send_prologue(tx, packet_length):
                 break
-            if self.send_and_wait(packet, 5):
+            if self.send_and_wait(tx, tx.frame, self.frame_rtt):
                 return True
 
+        self.gave_up += 1
+        TX_ABANDONED.inc(label_value = 'gave_up')
         print("Gave up sending packet!")
         return False
     # ------------------------------------------------------------------------------
@@ -265,14 +637,14 @@ class MoteinoGateway(threading.Thread):
     # send_prologue() - Constructs a 2-byte prologue from a length, and makes
     #                   multiple attempts to send it to the gateway
     # ------------------------------------------------------------------------------
-    def send_prologue(self, length):
+    def send_prologue(self, tx, length):
 
         # Create the two-byte packet prologue
         prologue = bytes([length, ~length & 0xFF])
 
         # Make multiple attempts to send the prologue
-        for attempt in range(0,10):
-            if self.send_and_wait(prologue, 1):
+        for attempt in range(self.PROLOGUE_ATTEMPTS):
+            if self.send_and_wait(tx, prologue, self.prologue_rtt):
                 return True
 
         # If we get here, we couldn't send it
@@ -280,15 +652,46 @@ class MoteinoGateway(threading.Thread):
     # ------------------------------------------------------------------------------
 
     # ------------------------------------------------------------------------------
-    # send_and_wait() - Sends data and waits for an ACK or NAK
+    # send_and_wait() - Sends data on behalf of a TxFrame and waits for an ACK
+    #                   or NAK.  Replies that arrive while no frame is in flight
+    #                   are counted and ignored by the reader thread
+    #
+    # The wait is the timeout "estimator" recommends after the frame's failures
+    # so far, cut short by the frame's deadline.  Only an ACK to a first attempt
+    # is a trustworthy round-trip time, so only those are fed back to it
     #
     # Returns True if an ACK was received, else false
     # ------------------------------------------------------------------------------
-    def send_and_wait(self, data, timeout):
-        self.event.clear()
-        self.packet_ack = False
+    def send_and_wait(self, tx, data, estimator):
+
+        remaining = tx.deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+
+        tx.event.clear()
+        tx.ack = False
+        self.in_flight = tx
+        start_time = time.perf_counter()
         self.comport.write(data)
-        return self.event.wait(timeout) and self.packet_ack
+        answered = tx.event.wait(min(estimator.timeout(tx.failures), remaining))
+        result = answered and tx.ack
+        self.in_flight = None
+        self.attempts += 1
+
+        if result:
+            rtt = time.perf_counter() - start_time
+            ACK_RTT.observe(rtt)
+            if tx.failures == 0:
+                estimator.observe(rtt)
+        else:
+            tx.failures += 1
+            if answered:
+                self.naks += 1
+            else:
+                self.timeouts += 1
+            ACK_FAILURES.inc()
+
+        return result
     # ------------------------------------------------------------------------------
 
     # ---------------------------------------------------------------------------
@@ -300,97 +703,176 @@ class MoteinoGateway(threading.Thread):
         # Ensure that this thread exits when the main program does
         self.daemon = True
 
-        # Create the socket that we will use to send notifications
-        self.pipe_out = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        # Make the socket connection to the other thread
-        self.pipe_out.connect(('localhost', self.local_port))
-
         # This launches the "self.run()" routine in it's own thread
         self.start()
     # ---------------------------------------------------------------------------
 
     # ---------------------------------------------------------------------------
-    # run() - A blocking thread that permanently waits for incoming messages
+    # create_notification_pipe() - Creates the pair of connected sockets that the
+    #                              reader thread uses to wake up the consumer.
+    #                              No TCP port is involved, so any number of
+    #                              gateway processes can share a host
+    # ---------------------------------------------------------------------------
+    def create_notification_pipe(self):
+        self.pipe_in, self.pipe_out = socket.socketpair()
+    # ---------------------------------------------------------------------------
+
+    # ---------------------------------------------------------------------------
+    # enqueue() - Places a packet into our queue and, if the consumer hasn't
+    #             already been told there is something waiting, notifies it.  A
+    #             burst of packets costs a single notification
+    # ---------------------------------------------------------------------------
+    def enqueue(self, packet):
+
+        with self.mutex:
+            high_water = self.queue.put(packet)
+            if not self.wakeup_pending:
+                self.wakeup_pending = True
+                self.pipe_out.send(b'\x01')
+
+        if high_water and self.on_high_water is not None:
+            self.on_high_water(self)
+    # ---------------------------------------------------------------------------
+
+    # ---------------------------------------------------------------------------
+    # run() - A blocking thread that waits for incoming messages until close()
     # ---------------------------------------------------------------------------
     def run(self):
 
         # Wait for the receive line to go quiet
         self.comport.timeout = .1
-        while not self.comport.read() == b'':
+        while self.wait_for_quiet and not self.closing and not self.comport.read() == b'':
             pass
-        self.comport.timeout = None
 
-        # We're going to wait for incoming messages forever
-        while True:
+        # Runs of garbage bytes are passed along as BadPackets for diagnostics
+        self.framer = StreamFramer(self.on_discard)
 
-            # Read in a packet
-            self.comport.timeout = None
-            packet = self.comport.read(1)
-            count = int.from_bytes(packet, 'little')
-            self.comport.timeout = .1
-            packet = packet + self.comport.read(count - 1)
+        # We're going to wait for incoming messages until we're closed
+        while not self.closing:
 
-            # If the packet is the wrong length, throw it away
-            if len(packet) != count:
-                print("Throwing away malformed packet")
-                continue
+            # Wait up to 100ms for data, then take everything that's waiting
+            data = self.comport.read(self.comport.in_waiting or 1)
 
-            # Packet-type is the 4th byte in the packet
-            packet_type = packet[3]
+            # If the line went quiet in the middle of a packet, that packet is bad
+            if data:
+                SERIAL_BYTES.inc(len(data))
+                self.framer.feed(data)
+            else:
+                self.framer.skip_stalled()
 
-            # If this is a "print this" packet, make it so
-            if packet_type == self.SP_PRINT:
-                print("Gateway says:", packet[4:])
-                continue
+            start_time = time.perf_counter()
+            count = 0
+            for frame in self.framer.frames():
+                self.dispatch(frame)
+                count += 1
 
-            # If this is a "Ready to receive" notification, tell the other thread
-            if packet_type == self.SP_READY:
-                self.packet_ack = True
-                self.event.set()
-                continue
+            if count:
+                FRAME_SECONDS.observe((time.perf_counter() - start_time) / count, count)
+    # ---------------------------------------------------------------------------
 
-            # If this is a NAK, tell the other thread
-            if packet_type == self.SP_NAK:
-                self.packet_ack = False
-                self.event.set()
-                continue
+    # ---------------------------------------------------------------------------
+    # dispatch() - Routes one CRC-checked packet (a memoryview that is only valid
+    #              for the duration of this call) from the gateway
+    # ---------------------------------------------------------------------------
+    def dispatch(self, frame):
+
+        # Packet-type is the 4th byte in the packet
+        packet_type = frame[3]
+
+        # If this is a "print this" packet, make it so
+        if packet_type == self.SP_PRINT:
+            print("Gateway says:", bytes(frame[4:]))
+            return
+
+        # If this is an ACK or a NAK, hand it to the frame that is waiting for it
+        if packet_type == self.SP_READY or packet_type == self.SP_NAK:
+            tx = self.in_flight
+            if tx is None:
+                self.stray_acks += 1
+            else:
+                tx.ack = (packet_type == self.SP_READY)
+                tx.event.set()
+            return
+
+        # If this is a batch, unpack the packets in it
+        if packet_type == self.SP_BATCH:
+            self.dispatch_batch(frame)
+            return
+
+        # A gateway that has rebooted has forgotten that we asked for batches
+        if packet_type == self.SP_ALIVE:
+            self.batching = False
+
+        # Convert the packet to a specialized packet class, and place it into our
+        # queue.  This is the one place the packet is copied out of the framer
+        self.enqueue(decode_packet(bytes(frame), verify_crc = False))
+    # ---------------------------------------------------------------------------
+
+    # ---------------------------------------------------------------------------
+    # dispatch_batch() - Queues each packet in an SP_BATCH frame.  An empty batch
+    #                    is the gateway agreeing to batching.  Each radio packet is
+    #                    copied straight out of the framer's buffer, behind a
+    #                    header that makes it look like it arrived on its own
+    # ---------------------------------------------------------------------------
+    def dispatch_batch(self, frame):
 
-            # Extract the CRC from the packet
-            packet_crc = int.from_bytes(packet[1:3], 'little')
+        end = len(frame)
+        if end == PACKET_HEADER_SIZE:
+            self.batch_offered = True
+            return
 
-            # Compute a new CRC for the packet
-            new_crc = fast_crc16(packet[3:])
+        self.batches_received += 1
+        position = PACKET_HEADER_SIZE
+        count = 0
 
-            # --------------------------------------------------------
-            # Convert the packet to specialized packet class
-            # --------------------------------------------------------
-            if packet_crc != new_crc:
-                packet = BadPacket(packet)
-                print(">>> CRC MISMATCH DETECTED <<<")
+        while position < end:
 
-            elif packet_type == self.SP_FROM_RADIO:
-                packet = RadioPacket(packet)
+            sub_len = frame[position]
+            packet_type = frame[position + 1] if position + 1 < end else None
 
-            elif packet_type == self.SP_ECHO:
-                packet = EchoPacket(packet)
-            # --------------------------------------------------------
+            # A sub-packet that's too short or runs off the end means the rest is garbage
+            if sub_len < SUB_HEADER_SIZE + RADIO_HEADER.size or position + sub_len > end \
+                    or packet_type != self.SP_FROM_RADIO:
+                self.enqueue(BadPacket(bytes(frame[position:])))
+                break
 
-            # Place this packet into our queue
-            self.mutex.acquire()
-            self.queue.append(packet)
-            self.mutex.release()
+            header = bytes((sub_len - SUB_HEADER_SIZE + PACKET_HEADER_SIZE, 0, 0, packet_type))
+            self.enqueue(RadioPacket(header + frame[position + SUB_HEADER_SIZE:position + sub_len]))
+            position += sub_len
+            count += 1
 
-            # Notify the other thread that there is a packet in the queue
-            self.pipe_out.send(b'\x01')
+        self.batched_received += count
+        BATCHED.inc(count, 'received')
+    # ---------------------------------------------------------------------------
+
+    # ---------------------------------------------------------------------------
+    # on_discard() - Called by the framer with each run of bytes it threw away
+    # ---------------------------------------------------------------------------
+    def on_discard(self, junk):
+        print(f">>> Discarded {len(junk)} bytes while resynchronising <<<")
+        self.enqueue(BadPacket(bytes(junk)))
     # ---------------------------------------------------------------------------
 
     # ---------------------------------------------------------------------------
     # close() - A function to close sockets after script interrupted or killed
     # ---------------------------------------------------------------------------
     def close(self):
+
+        # Stop the reader thread, which notices within one 100ms read, before the
+        # sockets it notifies through go away
+        self.closing = True
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+        # Stop the transmit thread once it has finished with what's already queued
+        self.tx_queue.put(None)
+
         self.pipe_in.close()
-        self.pipe_out.close()        
+        self.pipe_out.close()
+
+        # Make sure everything captured so far is on disk
+        if isinstance(self.comport, CapturingSerial):
+            self.comport.writer.close()
     # ---------------------------------------------------------------------------
 
 # ==========================================================================================================
@@ -0,0 +1,139 @@
+# ==========================================================================================================
+# node_cache.py - Remembers the most recent reading of each field for every node
+# ==========================================================================================================
+import threading
+import array
+import math
+import time
+
+
+# ==========================================================================================================
+# LatestCache - A thread-safe table of the latest value of each numeric field, indexed by node ID
+#
+# Storage is one flat array of doubles per field plus one array of timestamps, each indexed
+# directly by node ID, so a reading costs a few array stores rather than a dictionary.  Slots for
+# fields a node has never reported hold NaN.  The arrays grow on demand to fit the largest node ID.
+# ==========================================================================================================
+class LatestCache:
+
+    fields     = None  # Tuple of field names we keep
+    columns    = None  # Dictionary of field name -> array of values, one slot per node
+    timestamps = None  # Array of wall-clock times at which each node was last updated, 0 = never
+    ttl        = None  # If not None, readings older than this many seconds are reported as stale
+    mutex      = None  # Protects the arrays
+    capacity   = 0     # Number of node slots currently allocated
+
+    # ------------------------------------------------------------------------------
+    # Constructor - Allocates room for "capacity" nodes
+    # ------------------------------------------------------------------------------
+    def __init__(self, fields, capacity = 1024, ttl = None):
+        self.fields     = tuple(fields)
+        self.columns    = {name : array.array('d') for name in self.fields}
+        self.timestamps = array.array('d')
+        self.ttl        = ttl
+        self.mutex      = threading.Lock()
+        self.grow(capacity)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # update() - Records a node's latest measurements.  Fields we don't track are
+    #            ignored
+    # ------------------------------------------------------------------------------
+    def update(self, node_id, measurements, timestamp = None):
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.mutex:
+
+            if node_id >= self.capacity:
+                self.grow(max(node_id + 1, self.capacity * 2))
+
+            for name, value in measurements.items():
+                column = self.columns.get(name)
+                if column is not None and value is not None:
+                    column[node_id] = value
+
+            self.timestamps[node_id] = timestamp
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # get() - Returns a dictionary describing the latest value of a field, or None
+    #         if that node has never reported it:
+    #
+    #         {'value': 80.75, 'timestamp': 1644270013.5, 'age': 2.1, 'stale': False}
+    # ------------------------------------------------------------------------------
+    def get(self, node_id, field):
+
+        with self.mutex:
+            if node_id < 0 or node_id >= self.capacity:
+                return None
+            value = self.columns[field][node_id]
+            timestamp = self.timestamps[node_id]
+
+        if math.isnan(value):
+            return None
+
+        age = time.time() - timestamp
+        return {
+            'value'     : value,
+            'timestamp' : timestamp,
+            'age'       : age,
+            'stale'     : self.ttl is not None and age > self.ttl
+        }
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # snapshot() - Returns the latest values of "fields" for many nodes at once,
+    #              under a single lock.  "node_ids" of None means every node that
+    #              has reported.  Nodes that have never reported are left out:
+    #
+    #              {12: {'values': {'temperature': 80.75}, 'timestamp': 1644270013.5,
+    #                    'age': 2.1, 'stale': False}, ...}
+    # ------------------------------------------------------------------------------
+    def snapshot(self, node_ids = None, fields = None):
+
+        fields = self.fields if fields is None else fields
+        rows = []
+
+        with self.mutex:
+            if node_ids is None:
+                node_ids = [node for node in range(self.capacity) if self.timestamps[node]]
+            columns = [(name, self.columns[name]) for name in fields]
+            for node in node_ids:
+                if 0 <= node < self.capacity and self.timestamps[node]:
+                    rows.append((node, self.timestamps[node], [(name, column[node]) for name, column in columns]))
+
+        now = time.time()
+        result = {}
+        for node, timestamp, values in rows:
+            age = now - timestamp
+            result[node] = {
+                'values'    : {name: value for name, value in values if not math.isnan(value)},
+                'timestamp' : timestamp,
+                'age'       : age,
+                'stale'     : self.ttl is not None and age > self.ttl
+            }
+
+        return result
+    # ------------------------------------------------------------------------------
+
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # From here on down are methods that are private to this class
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+
+    # ------------------------------------------------------------------------------
+    # grow() - Extends every array to hold "capacity" nodes.  Caller must hold the
+    #          mutex (or be the constructor)
+    # ------------------------------------------------------------------------------
+    def grow(self, capacity):
+        extra = capacity - self.capacity
+        for column in self.columns.values():
+            column.extend([math.nan] * extra)
+        self.timestamps.extend([0.0] * extra)
+        self.capacity = capacity
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
@@ -0,0 +1,137 @@
+# ==========================================================================================================
+# node_registry.py - Remembers what every node is, across restarts
+# ==========================================================================================================
+import sqlite3
+import array
+import time
+
+
+# ==========================================================================================================
+# NodeRegistry - Device type, UID, firmware version, config version and last-seen time of every node
+#
+# The registry lives in a small SQLite file.  At startup every row is loaded into flat arrays indexed
+# by node ID, so looking up a node's device type on the hot path is a single array index.  Config
+# packets are rare, so they are written through immediately; last-seen times change on every packet,
+# so they are collected in memory and written out in bulk by flush().
+#
+# A registry belongs to one thread: the ingest loop.
+# ==========================================================================================================
+class NodeRegistry:
+
+    UNKNOWN        = 0     # The device type of a node we know nothing about
+    MAX_NODES      = 65536 # Node IDs are 16 bits
+    FLUSH_INTERVAL = 5.0   # Seconds between writes of last-seen times
+
+    filename       = None  # Path of the SQLite file
+    db             = None  # The SQLite connection, once open() has been called
+    device_types   = None  # array of device type, indexed by node ID
+    fw_versions    = None  # array of firmware version, indexed by node ID
+    config_versions = None # array of config version, indexed by node ID
+    last_seen      = None  # array of wall-clock time we last heard from the node, 0 = never
+    uids           = None  # Dictionary of node ID -> UID string, for nodes that sent a config
+    dirty          = None  # Set of node IDs whose last_seen hasn't been written yet
+    last_flush     = 0     # When we last wrote last_seen times
+
+    # ------------------------------------------------------------------------------
+    # Constructor - Doesn't touch the disk.  Call open() before using the registry
+    # ------------------------------------------------------------------------------
+    def __init__(self, filename = 'nodes.db'):
+        self.filename        = filename
+        self.device_types    = array.array('B', bytes(self.MAX_NODES))
+        self.fw_versions     = array.array('H', bytes(2 * self.MAX_NODES))
+        self.config_versions = array.array('B', bytes(self.MAX_NODES))
+        self.last_seen       = array.array('d', bytes(8 * self.MAX_NODES))
+        self.uids            = {}
+        self.dirty           = set()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # open() - Opens (or creates) the registry file and loads every node from it
+    # ------------------------------------------------------------------------------
+    def open(self):
+
+        self.db = sqlite3.connect(self.filename)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS nodes (
+                               node_id        INTEGER PRIMARY KEY,
+                               device_type    INTEGER NOT NULL,
+                               uid            TEXT,
+                               fw_version     INTEGER,
+                               config_version INTEGER,
+                               last_seen      REAL)''')
+
+        rows = self.db.execute('SELECT node_id, device_type, uid, fw_version, config_version, last_seen FROM nodes')
+        for node_id, device_type, uid, fw_version, config_version, last_seen in rows:
+            self.device_types[node_id]    = device_type
+            self.fw_versions[node_id]     = fw_version or 0
+            self.config_versions[node_id] = config_version or 0
+            self.last_seen[node_id]       = last_seen or 0
+            if uid:
+                self.uids[node_id] = uid
+
+        self.last_flush = time.monotonic()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # device_type() - Returns the device type of a node, or UNKNOWN
+    # ------------------------------------------------------------------------------
+    def device_type(self, node_id):
+        return self.device_types[node_id]
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # record_config() - Stores what a node told us about itself in a config packet
+    # ------------------------------------------------------------------------------
+    def record_config(self, node_id, device_type, uid, fw_version, config_version):
+
+        now = time.time()
+
+        self.device_types[node_id]    = device_type
+        self.fw_versions[node_id]     = fw_version
+        self.config_versions[node_id] = config_version
+        self.last_seen[node_id]       = now
+        self.uids[node_id]            = uid
+        self.dirty.discard(node_id)
+
+        self.db.execute('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?, ?)',
+                        (node_id, device_type, uid, fw_version, config_version, now))
+        self.db.commit()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # touch() - Notes that we've just heard from a node
+    # ------------------------------------------------------------------------------
+    def touch(self, node_id):
+        self.last_seen[node_id] = time.time()
+        if self.device_types[node_id] != self.UNKNOWN:
+            self.dirty.add(node_id)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # flush() - Writes out pending last-seen times.  Unless "force" is True, only
+    #           does so if FLUSH_INTERVAL seconds have passed since the last flush
+    # ------------------------------------------------------------------------------
+    def flush(self, force = False):
+
+        now = time.monotonic()
+        if not self.dirty or (not force and now - self.last_flush < self.FLUSH_INTERVAL):
+            return
+
+        self.db.executemany('UPDATE nodes SET last_seen = ? WHERE node_id = ?',
+                            [(self.last_seen[node_id], node_id) for node_id in self.dirty])
+        self.db.commit()
+        self.dirty.clear()
+        self.last_flush = now
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # close() - Writes out anything pending and closes the file
+    # ------------------------------------------------------------------------------
+    def close(self):
+        if self.db:
+            self.flush(force = True)
+            self.db.close()
+            self.db = None
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
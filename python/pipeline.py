@@ -0,0 +1,361 @@
+# ==========================================================================================================
+# pipeline.py - Hands received frames to worker processes through shared-memory ring buffers
+#
+# The reader process owns the serial port: it frames, checks and answers packets, and nothing else.
+# Everything slow (decoding, building points, writing to the database) happens in a pool of worker
+# processes, each with its own interpreter, so none of it can hold up a serial read or an ACK.
+#
+#     pipeline = Pipeline(4, setup, handler, teardown)
+#     pipeline.start()
+#     ...
+#     for packet in burst:
+#         pipeline.submit(packet.src_node, packet.raw, device_type)
+#     pipeline.flush()
+#     ...
+#     pipeline.stop()
+#
+# Every node is always sent to the same worker (node ID modulo the number of workers), so each
+# node's packets are handled in the order they arrived.
+# ==========================================================================================================
+import multiprocessing
+import signal
+import struct
+import time
+from multiprocessing import shared_memory
+
+POSITIONS = struct.Struct('<Q')   # Head and tail positions, each in its own cache line
+HEAD      = 0                     # Offset of the head position: bytes ever written
+TAIL      = 64                    # Offset of the tail position: bytes ever consumed
+HEADER    = 128                   # Size of the ring header
+
+RECORD    = struct.Struct('<HB')  # Frame length, device type
+WRAP      = 0xFFFF                # A record length meaning "the rest of the ring is unused"
+
+
+# ==========================================================================================================
+# FrameRing - A single-producer, single-consumer ring of frames in shared memory
+#
+# Records are a 3-byte header (frame length, device type) followed by the frame, and never straddle
+# the end of the ring: a record that doesn't fit in what's left is written at the start instead,
+# behind a WRAP marker.  The producer only ever writes the head and the consumer only ever writes the
+# tail, so no lock is needed.  The producer publishes a whole batch of records with one store of the
+# head, and the consumer frees a whole batch with one store of the tail, after it has handled it.
+# ==========================================================================================================
+class FrameRing:
+
+    memory   = None  # The SharedMemory block
+    data     = None  # memoryview of the record area
+    size     = 0     # Size of the record area
+    head     = 0     # Producer: bytes written, including records not yet published
+    tail     = 0     # Consumer: bytes consumed, including records not yet committed
+
+    # ------------------------------------------------------------------------------
+    # Constructor - Creates a new ring if "name" is None, otherwise attaches to the
+    #               ring of that name
+    # ------------------------------------------------------------------------------
+    def __init__(self, name = None, size = 4 << 20):
+
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create = True, size = HEADER + size)
+            self.memory.buf[:HEADER] = bytes(HEADER)
+        else:
+            self.memory = shared_memory.SharedMemory(name)
+
+        self.size = size
+        self.data = self.memory.buf[HEADER:HEADER + self.size]
+        self.head = POSITIONS.unpack_from(self.memory.buf, HEAD)[0]
+        self.tail = POSITIONS.unpack_from(self.memory.buf, TAIL)[0]
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # name - The name other processes attach to
+    # ------------------------------------------------------------------------------
+    @property
+    def name(self):
+        return self.memory.name
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # put() - Producer: appends a frame.  It isn't visible to the consumer until
+    #         publish() is called
+    #
+    # Returns: True, or False if the ring is too full to take it
+    # ------------------------------------------------------------------------------
+    def put(self, frame, device_type):
+
+        need = RECORD.size + len(frame)
+        tail = POSITIONS.unpack_from(self.memory.buf, TAIL)[0]
+        offset = self.head % self.size
+
+        # If the record won't fit before the end of the ring, it goes at the start
+        skip = self.size - offset if offset + need > self.size else 0
+        if self.head + skip + need - tail > self.size:
+            return False
+
+        if skip:
+            if skip >= RECORD.size:
+                RECORD.pack_into(self.data, offset, WRAP, 0)
+            self.head += skip
+            offset = 0
+
+        RECORD.pack_into(self.data, offset, len(frame), device_type)
+        self.data[offset + RECORD.size:offset + need] = frame
+        self.head += need
+        return True
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # publish() - Producer: makes every frame put() so far visible to the consumer
+    # ------------------------------------------------------------------------------
+    def publish(self):
+        POSITIONS.pack_into(self.memory.buf, HEAD, self.head)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # read() - Consumer: returns every published (frame, device type) after the
+    #          ones already read.  The frames are copies, so they stay valid after
+    #          commit() lets the producer reuse their space
+    # ------------------------------------------------------------------------------
+    def read(self):
+
+        head = POSITIONS.unpack_from(self.memory.buf, HEAD)[0]
+        records = []
+
+        while self.tail < head:
+
+            offset = self.tail % self.size
+
+            # A WRAP marker, or a tail too short to hold one, sends us to the start
+            if self.size - offset < RECORD.size:
+                self.tail += self.size - offset
+                continue
+            length, device_type = RECORD.unpack_from(self.data, offset)
+            if length == WRAP:
+                self.tail += self.size - offset
+                continue
+
+            start = offset + RECORD.size
+            records.append((bytes(self.data[start:start + length]), device_type))
+            self.tail += RECORD.size + length
+
+        return records
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # commit() - Consumer: frees the space of every record read() has returned
+    # ------------------------------------------------------------------------------
+    def commit(self):
+        POSITIONS.pack_into(self.memory.buf, TAIL, self.tail)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # used() - Bytes published but not yet committed
+    # ------------------------------------------------------------------------------
+    def used(self):
+        return POSITIONS.unpack_from(self.memory.buf, HEAD)[0] - POSITIONS.unpack_from(self.memory.buf, TAIL)[0]
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # close() - Detaches from the ring, and destroys it if "unlink" is True
+    # ------------------------------------------------------------------------------
+    def close(self, unlink = False):
+        self.data.release()
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# Pipeline - The reader's side: a FrameRing and a worker process for each shard
+#
+# "setup", "handler" and "teardown" run in the worker processes, so they must be module-level
+# functions.  setup(index) is called once when a worker starts, handler(records) with every batch
+# of (frame, device type) read from its ring, and teardown() when it is told to stop.  A batch is
+# committed as soon as handler() returns, so handler() must not return until whatever it made of
+# the records is safe (written to the database or spooled to disk, not just queued in memory).  A
+# worker that dies is restarted by check(), and carries on from the last batch it committed, so a
+# batch that was being handled when it died is handled again.
+# ==========================================================================================================
+class Pipeline:
+
+    RESTART_DELAY = 1.0    # Seconds between restarts of the same worker
+
+    count      = 0     # Number of workers
+    ring_bytes = 0     # Size of each worker's ring
+    setup      = None  # Called in each worker with its index
+    handler    = None  # Called in each worker with each batch of records
+    teardown   = None  # Called in each worker as it stops
+    context    = None  # The multiprocessing context workers are started from
+    rings      = None  # List of FrameRing, one per worker
+    wakeups    = None  # List of multiprocessing.Event, set when a worker's ring has new records
+    workers    = None  # List of multiprocessing.Process
+    started_at = None  # List of when each worker was last started
+    dirty      = None  # Set of worker indexes with records put() but not published
+    stopping   = None  # multiprocessing.Event telling the workers to finish up
+
+    # Counters
+    submitted  = 0     # Frames put into a ring
+    dropped    = 0     # Frames dropped because a worker's ring was full
+    restarts   = 0     # Workers restarted after dying
+
+    # ------------------------------------------------------------------------------
+    # Constructor
+    # ------------------------------------------------------------------------------
+    def __init__(self, count, setup, handler, teardown, ring_bytes = 4 << 20):
+        self.count      = count
+        self.ring_bytes = ring_bytes
+        self.setup      = setup
+        self.handler    = handler
+        self.teardown   = teardown
+        self.context    = multiprocessing.get_context('spawn')
+        self.dirty      = set()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # start() - Creates the rings and starts the workers
+    # ------------------------------------------------------------------------------
+    def start(self):
+
+        self.stopping   = self.context.Event()
+        self.rings      = [FrameRing(size = self.ring_bytes) for _ in range(self.count)]
+        self.wakeups    = [self.context.Event() for _ in range(self.count)]
+        self.workers    = [None] * self.count
+        self.started_at = [0.0] * self.count
+
+        for index in range(self.count):
+            self.start_worker(index)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # submit() - Queues a frame for the worker that owns its node.  Nothing is
+    #            visible to the workers until flush()
+    #
+    # Returns: True, or False if that worker's ring was full and the frame dropped
+    # ------------------------------------------------------------------------------
+    def submit(self, node_id, frame, device_type):
+
+        index = node_id % self.count
+        if not self.rings[index].put(frame, device_type):
+            self.dropped += 1
+            return False
+
+        self.dirty.add(index)
+        self.submitted += 1
+        return True
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # flush() - Publishes everything submitted since the last flush, and wakes the
+    #           workers that have something new.  Call once per burst
+    # ------------------------------------------------------------------------------
+    def flush(self):
+
+        for index in self.dirty:
+            self.rings[index].publish()
+            self.wakeups[index].set()
+
+        self.dirty.clear()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # check() - Restarts any worker that has died.  Call every so often
+    # ------------------------------------------------------------------------------
+    def check(self):
+
+        for index, worker in enumerate(self.workers):
+            if not worker.is_alive() and time.monotonic() - self.started_at[index] >= self.RESTART_DELAY:
+                print(f"Pipeline worker {index} exited with code {worker.exitcode}, restarting it")
+                self.restarts += 1
+                self.start_worker(index)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # stop() - Tells the workers to finish what's in their rings and exit, then
+    #          destroys the rings
+    # ------------------------------------------------------------------------------
+    def stop(self, timeout = 15):
+
+        self.flush()
+        self.stopping.set()
+        for wakeup in self.wakeups:
+            wakeup.set()
+
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.monotonic()))
+            if worker.is_alive():
+                print(f"Pipeline worker {worker.name} didn't stop, terminating it")
+                worker.terminate()
+                worker.join()
+
+        for ring in self.rings:
+            ring.close(unlink = True)
+        self.rings = []
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # stats() - Returns the counters and each ring's backlog as a dictionary
+    # ------------------------------------------------------------------------------
+    def stats(self):
+        return {'workers': self.count, 'submitted': self.submitted, 'dropped': self.dropped,
+                'restarts': self.restarts, 'backlog_bytes': [ring.used() for ring in self.rings]}
+    # ------------------------------------------------------------------------------
+
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # From here on down are methods that are private to this class
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+
+    # ------------------------------------------------------------------------------
+    # start_worker() - Starts (or restarts) the worker for one shard
+    # ------------------------------------------------------------------------------
+    def start_worker(self, index):
+
+        worker = self.context.Process(target = run_worker, name = f'pipeline-worker-{index}', daemon = True,
+                                      args = (index, self.rings[index].name, self.ring_bytes, self.wakeups[index],
+                                              self.stopping, self.setup, self.handler, self.teardown))
+        worker.start()
+        self.workers[index] = worker
+        self.started_at[index] = time.monotonic()
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# run_worker() - The body of a worker process: handles batches from its ring until told to stop, then
+#                handles whatever is left and exits
+# ==========================================================================================================
+def run_worker(index, ring_name, ring_bytes, wakeup, stopping, setup, handler, teardown):
+
+    # Ctrl-C goes to the whole process group; the reader decides when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    ring = FrameRing(ring_name, ring_bytes)
+    setup(index)
+
+    try:
+        while True:
+
+            # Clear first, so a flush() that lands after read() still wakes us
+            wakeup.clear()
+            records = ring.read()
+
+            # The handler has made the records safe by the time it returns, so their
+            # space can be given back
+            if records:
+                handler(records)
+                ring.commit()
+            elif stopping.is_set():
+                break
+            else:
+                wakeup.wait(1.0)
+
+    finally:
+        teardown()
+        ring.close()
+# ==========================================================================================================
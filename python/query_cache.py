@@ -0,0 +1,99 @@
+# ==========================================================================================================
+# query_cache.py - Caches the serialised results of API queries for a few seconds
+# ==========================================================================================================
+import collections
+import hashlib
+import json
+import threading
+import time
+import metrics
+
+CACHE_REQUESTS = metrics.counter('api_cache_requests_total', 'API query results served, by cache outcome',
+                                 label = 'result')
+
+
+# ==========================================================================================================
+# ResultCache - Remembers the JSON body and ETag of recent query results
+#
+# Results are keyed by whatever the caller likes (usually the route and its normalised arguments)
+# and kept for "ttl" seconds.  The body is serialised once, when it is computed, so a cache hit
+# costs a dictionary lookup.  If several threads ask for the same key while it is being computed,
+# only the first one runs the query and the rest wait for its answer.  At most "max_entries" results
+# are kept; the least recently used is forgotten first.
+#
+#     body, etag = results.get(('thermal', nodes), lambda: query_latest(nodes))
+# ==========================================================================================================
+class ResultCache:
+
+    ttl         = 0     # Seconds a result stays fresh
+    max_entries = 0     # How many results to keep
+    entries     = None  # OrderedDict of key -> (expiry time, body, ETag)
+    computing   = None  # Dictionary of key -> Event set when the result is ready
+    mutex       = None
+
+    # ------------------------------------------------------------------------------
+    # Constructor
+    # ------------------------------------------------------------------------------
+    def __init__(self, ttl = 2.0, max_entries = 256):
+        self.ttl         = ttl
+        self.max_entries = max_entries
+        self.entries     = collections.OrderedDict()
+        self.computing   = {}
+        self.mutex       = threading.Lock()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # get() - Returns the cached (body, ETag) for "key", calling "compute" to build
+    #         the result if there isn't a fresh one.  "compute" returns something
+    #         JSON-serialisable; if it raises, nothing is cached and the exception
+    #         reaches the caller
+    # ------------------------------------------------------------------------------
+    def get(self, key, compute, ttl = None):
+
+        while True:
+
+            with self.mutex:
+
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    CACHE_REQUESTS.inc(label_value = 'hit')
+                    return entry[1], entry[2]
+
+                # If nobody is computing this result, it's our job
+                pending = self.computing.get(key)
+                if pending is None:
+                    pending = self.computing[key] = threading.Event()
+                    break
+
+            # Somebody else is computing it.  Wait, then look again
+            pending.wait()
+
+        try:
+            body = json.dumps(compute(), separators = (',', ':')).encode()
+            etag = hashlib.blake2b(body, digest_size = 8).hexdigest()
+
+            with self.mutex:
+                self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), body, etag)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last = False)
+
+            CACHE_REQUESTS.inc(label_value = 'miss')
+            return body, etag
+
+        finally:
+            with self.mutex:
+                del self.computing[key]
+            pending.set()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # clear() - Forgets every cached result
+    # ------------------------------------------------------------------------------
+    def clear(self):
+        with self.mutex:
+            self.entries.clear()
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
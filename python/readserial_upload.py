@@ -7,12 +7,29 @@ import moteinogw
 import struct
 from timeit import default_timer as timer
 import sys
+import os
 import json
+import math
 import time
-import configparser
-from flask import Flask, request, jsonify
+import random
+from flask import Flask, Response, request, jsonify
 from datetime import datetime
-from influxdb import InfluxDBClient
+from influx_pool import InfluxPool
+from influx_writer import InfluxWriter
+from spool import Spool
+from node_cache import LatestCache
+from node_registry import NodeRegistry
+from dedup import DedupWindow
+from downlink import DownlinkMailbox, TASK_SETPOINT, TASK_MANUAL_INDEX, TASK_REBOOT, TASK_NODE_PARAMS
+from capture import ReplaySerial
+from query_cache import ResultCache, CACHE_REQUESTS
+from aggregator import WindowAggregator
+from pipeline import Pipeline
+from stream import TelemetryHub
+from http_server import ApiServer
+import metrics
+import telemetry_codecs
+from telemetry_codecs import TelemetryCodec, TAG, FIELD, SKIP
 
 
 
@@ -28,22 +45,125 @@ TYPE_STM_DEVICE = 2
 TYPE_CONFIG_PACKET       = 0
 TYPE_TELEMETRY_PACKET    = 1
 TYPE_RESPONSE_PACKET     = 2
-def read_db_config(filename='database.ini', section='influxdb'):
-    # Create a parser
-    parser = configparser.ConfigParser()
-    # Read the config file
-    parser.read(filename)
-
-    # Get section, default to influxdb
-    db_config = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            db_config[param[0]] = param[1]
-    else:
-        raise Exception(f'Section {section} not found in the {filename} file')
 
-    return db_config
+# ==========================================================================================================
+# Payload layouts.  Each entry is (name, struct format, divide-by, role).  To support a new kind of
+# node, register its layout here under (device type, telemetry version); a version of None matches
+# every version that doesn't have its own entry.
+# ==========================================================================================================
+CONFIG_CODEC = TelemetryCodec('config', [
+    ('packet_type',       'B', None, SKIP),
+    ('config_version',    'B', None, TAG),
+    ('device_type',       'B', None, TAG),
+    ('fw_version',        'H', None, TAG),
+])
+
+telemetry_codecs.register(TYPE_BORC_DEVICE, None, TelemetryCodec('BORC', [
+    ('packet_type',       'B', None, SKIP),
+    ('telemetry_version', 'B', None, TAG),
+    ('setpoint',          'B', None, FIELD),
+    ('manual_index',      'B', None, FIELD),
+    ('error_byte',        'B', None, TAG),
+    ('transaction_id',    'B', None, TAG),
+    ('humidity',          'H', 100,  FIELD),
+    ('temperature',       'H', 100,  FIELD),
+    ('battery',           'H', None, FIELD),
+    ('servo_PWM',         'H', None, FIELD),
+]))
+
+telemetry_codecs.register(TYPE_STM_DEVICE, None, TelemetryCodec('STM', [
+    ('packet_type',       'B', None, SKIP),
+    ('telemetry_version', 'B', None, TAG),
+    ('temp_before',       'H', 100,  FIELD),
+    ('temp_after',        'H', 100,  FIELD),
+    ('error_byte',        'B', None, TAG),
+    ('transaction_id',    'B', None, TAG),
+]))
+
+# ==========================================================================================================
+# Fraction of packets to dump to the console, between 0 (none, the default) and 1 (every packet).
+# Set MOTEINO_DEBUG_SAMPLE in the environment to turn the dump on
+# ==========================================================================================================
+DEBUG_SAMPLE = float(os.environ.get('MOTEINO_DEBUG_SAMPLE', '0'))
+
+# ==========================================================================================================
+# Instrumentation, served by /metrics
+# ==========================================================================================================
+DECODE_SECONDS   = metrics.histogram('moteino_decode_seconds', 'Time to decode each telemetry packet',
+                                     metrics.MICRO_BUCKETS)
+RESPONSE_SECONDS = metrics.histogram('moteino_response_seconds', 'Time from queueing a response to the gateway ACKing it')
+DUPLICATES       = metrics.counter('moteino_duplicates_dropped_total', 'Retransmitted packets answered from the dedup window')
+NODE_PACKETS     = metrics.counter('moteino_node_packets_total', 'Packets received from each node', label = 'node')
+NODE_RATE        = metrics.rate('moteino_node_packet_rate', 'Recent packets per second from each node', label = 'node')
+
+metrics.gauge('moteino_rx_queue_depth', 'Packets waiting for the ingest loop', lambda: len(gw.queue))
+metrics.gauge('moteino_tx_queue_depth', 'Frames waiting to be sent to the gateway', lambda: gw.tx_queue.qsize())
+metrics.gauge('moteino_ack_srtt_seconds', 'Smoothed time for the gateway to ACK each kind of write',
+              lambda: {'prologue': gw.prologue_rtt.srtt or 0, 'frame': gw.frame_rtt.srtt or 0}, label = 'write')
+metrics.gauge('moteino_ack_timeout_seconds', 'Current ACK timeout for each kind of write to the gateway',
+              lambda: {'prologue': gw.prologue_rtt.rto, 'frame': gw.frame_rtt.rto}, label = 'write')
+metrics.gauge('influx_writer_pending', 'Points waiting to be written to InfluxDB', lambda: writer.stats()['pending'])
+
+# ==========================================================================================================
+# Persistent InfluxDB connections shared by the ingest loop and the API
+# ==========================================================================================================
+pool = InfluxPool()
+
+# ==========================================================================================================
+# The latest reading of every numeric field from every node, updated as packets are decoded
+# ==========================================================================================================
+latest = LatestCache(('temperature', 'humidity', 'setpoint', 'manual_index', 'battery', 'servo_PWM',
+                      'temp_before', 'temp_after', 'RSSI'))
+
+# ==========================================================================================================
+# Optional window aggregation.  Set MOTEINO_AGGREGATE to a window length in seconds to write one
+# summary point per node per window instead of a point per packet, and MOTEINO_RAW_FIELDS to a
+# comma-separated list of fields that should still be written from every packet.  The API reads
+# aggregated fields back from the summary points: "<field>_last" for the latest reading, whose time is
+# then the start of its window, and "<field>_mean" for history
+# ==========================================================================================================
+AGGREGATE_WINDOW = float(os.environ.get('MOTEINO_AGGREGATE', '0'))
+RAW_FIELDS = [field for field in os.environ.get('MOTEINO_RAW_FIELDS', '').split(',') if field]
+
+aggregator = WindowAggregator(latest.fields, AGGREGATE_WINDOW, RAW_FIELDS) if AGGREGATE_WINDOW > 0 else None
+
+# ==========================================================================================================
+# Optional pipeline mode.  Set MOTEINO_WORKERS to a number of worker processes to have them decode and
+# upload packets, leaving this process to read and answer the gateway, and keep the latest readings
+# ==========================================================================================================
+PIPELINE_WORKERS = int(os.environ.get('MOTEINO_WORKERS', '0'))
+
+pipeline = None
+
+# ==========================================================================================================
+# Live telemetry for /stream clients.  The API is served from this process, on the address in
+# MOTEINO_API ("host:port"; set it empty to serve no API).  It has no authentication, and POST
+# /mailbox can reboot nodes, so by default it only listens on localhost.  Set MOTEINO_API to
+# "0.0.0.0:5000" to serve other machines, behind a firewall or an authenticating proxy
+# ==========================================================================================================
+hub = TelemetryHub()
+
+API_ADDRESS = os.environ.get('MOTEINO_API', '127.0.0.1:5000')
+STREAM_KEEPALIVE = 15   # Seconds between keep-alive comments on an idle /stream
+
+# ==========================================================================================================
+# What every node we've ever heard a config from is, persisted across restarts
+# ==========================================================================================================
+registry = NodeRegistry()
+
+# ==========================================================================================================
+# The transactions each node has sent recently, and the responses we sent back
+# ==========================================================================================================
+dedup = DedupWindow()
+
+# ==========================================================================================================
+# Commands waiting to go out to each node in the response to its next packet.  A response the gateway
+# hasn't ACKed within RESPONSE_TIMEOUT seconds is abandoned, and its commands wait for the next packet
+# ==========================================================================================================
+mailbox = DownlinkMailbox(TYPE_RESPONSE_PACKET, setpoint = 72, manual_index = 0, network_id = 10, node_id = 2,
+                          encryption_key = b'1234123412341234')
+
+RESPONSE_TIMEOUT = 1.0
 
 # ==========================================================================================================
 # Pack data into JSON packet
@@ -59,65 +179,43 @@ def pack_JSON(node_tags, measurements):
     json_dict["fields"] = measurements.copy()
     json_body.append(json_dict)
 
-    # print data on screen for debugging
-    print("==================================")
-    print(datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
-    print (json.dumps(json_body, indent = 4, sort_keys=True))
+    # print a sample of the data on screen for debugging
+    if debug_sampled():
+        print("==================================")
+        print(datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+        print (json.dumps(json_body, indent = 4, sort_keys=True))
 
     return json_body
 
 # ==========================================================================================================
-# Upload data to database
+# Decides whether this packet is one of the ones that gets dumped to the console
 # ==========================================================================================================
-def upload(json_body):
-    
-    # Influxdb credentials
-    db_config = read_db_config()
-    # start influx session and upload
-    try:
-        client = InfluxDBClient(db_config['server'], db_config['influx_port'], db_config['user'], db_config['passwd'], db_config['db'])
-        result = client.write_points(json_body)
-        print("Result: {0}".format(result))
-    except Exception as e:
-        print(f"Error uploading to InfluxDB: {e}")
-    finally:
-        client.close()
-
+def debug_sampled():
+    return DEBUG_SAMPLE > 0 and random.random() < DEBUG_SAMPLE
 
 # ==========================================================================================================
-# Unpacks a configuration packet from the node
+# Upload data to database
 # ==========================================================================================================
-def unpack_config_packet(device_type_mappings: dict):
-
-    # BORC data packet format
-    radio_format = '<BBBH'
-    radio_size   = struct.calcsize(radio_format)
+def upload(json_body):
 
-    # unpack the message into individual components
-    _, version, device_type, firmware_version = struct.unpack(radio_format, packet.data[:5])
-    
-    # map the node to a device type for receiving telemetry later
-    device_type_mappings[packet.src_node] = device_type
+    # hand the points to the background writer, this never waits on the database
+    writer.write(json_body)
 
-    # create a unique ID variable to save the unique ID in
-    uid = ""
 
-    # bytes 4-11 are UID (16-char)
-    for b in packet.data[5:]:
-        # format each byte into HEX
-        uid += '{:X}'.format(b)
+# ==========================================================================================================
+# Unpacks a configuration packet from the node, or returns None if it is too short.  Pass record=False
+# where the registry belongs to another process
+# ==========================================================================================================
+def unpack_config_packet(packet, record = True):
 
-    # clear contents from dictionaries if previously populated
-    node_tags = {}
-    measurements = {}
+    # unpack the fixed part of the message into tags
+    node_tags = decode_config_packet(packet)
+    if node_tags is None:
+        return None
 
-    # create a new dictionary of node tags
-    node_tags = {
-        "device_type"       : device_type,
-        "uid"               : uid,
-        "config_version"    : version,
-        "fw_version"        : firmware_version
-    }
+    # remember what this node is, so telemetry can be decoded even after a restart
+    if record:
+        record_config_packet(packet, node_tags)
 
     # create a new dictionary of measurements from the node
     measurements = {
@@ -125,169 +223,201 @@ def unpack_config_packet(device_type_mappings: dict):
     }
 
     # return back a neatly packed JSON packet to upload
-    return (pack_JSON(node_tags, measurements)), device_type_mappings
+    return (pack_JSON(node_tags, measurements))
+
 # ==========================================================================================================
+# Decodes the tags of a configuration packet, or returns None if it is too short
+# ==========================================================================================================
+def decode_config_packet(packet):
+
+    # unpack the fixed part of the message into tags
+    tags_and_fields = CONFIG_CODEC.decode(packet.data)
+    if tags_and_fields is None:
+        print(f"Config packet from node {packet.src_node} is too short.")
+        return None
+
+    node_tags, _ = tags_and_fields
+
+    # the remaining bytes are the UID, formatted as HEX
+    node_tags["uid"] = ''.join('{:X}'.format(b) for b in packet.data[CONFIG_CODEC.size:])
+
+    return node_tags
 
 # ==========================================================================================================
-# Determine type of telemetry packet for device that has not yet transmit config
+# Remembers what a node is, from its decoded configuration packet
+#
+# Returns: False if the packet was too short to decode
 # ==========================================================================================================
-def force_detect_device_type():
-    
-    # update user of what is happening
-    print("Force reading device type...")
-    
-    # check if it's BORC
-    try:
-        radio_format = '<BBBBBBHHHH'
-        _ = struct.unpack(radio_format, packet.data[:struct.calcsize(radio_format)])
-        return TYPE_BORC_DEVICE
-    except: pass
-    
-    # check if it's STM
-    try:
-        radio_format = '<BBHHBB'
-        _ = struct.unpack(radio_format, packet.data[:struct.calcsize(radio_format)])
-        return TYPE_STM_DEVICE
-    except: pass
-    
-    # return a generic error if neither fits
-    return -1
+def record_config_packet(packet, node_tags = None):
+
+    if node_tags is None:
+        node_tags = decode_config_packet(packet)
+        if node_tags is None:
+            return False
 
+    registry.record_config(packet.src_node, node_tags["device_type"], node_tags["uid"],
+                           node_tags["fw_version"], node_tags["config_version"])
+    return True
 # ==========================================================================================================
-# Determine device type and unpack accordingly
+
 # ==========================================================================================================
-def process_telemetry_packet(device_type_mappings):
+# Determine the codec for a telemetry packet, from the registry unless the caller knows the device type
+# ==========================================================================================================
+def find_telemetry_codec(packet, device_type = None):
 
     # determine device type
-    try:
-        device_type = device_type_mappings[packet.src_node]
-    except KeyError:
-        print(f"No config seen yet from node {packet.src_node}, please restart node to determine device type.")
-        device_type = force_detect_device_type()
-
-    # handle BORC packet
-    if device_type == TYPE_BORC_DEVICE:
-        return unpack_borc_telemetry_packet()
-
-    # handle STM packet
-    elif device_type == TYPE_STM_DEVICE:
-        return unpack_stm_telemetry_packet()
-    
-    else:
+    if device_type is None:
+        device_type = registry.device_type(packet.src_node)
+
+    # if this node has never sent a config, go by the length of its payload
+    if device_type == NodeRegistry.UNKNOWN:
+        device_type = telemetry_codecs.guess_device_type(len(packet.data))
+        if device_type is None:
+            print(f"No config seen yet from node {packet.src_node}, and no single device type matches "
+                  f"its {len(packet.data)}-byte payload.")
+            return None
+        print(f"No config seen yet from node {packet.src_node}, guessed device type {device_type} from the payload length.")
+
+    # byte 1 of every telemetry packet is the telemetry version
+    version = packet.data[1] if len(packet.data) > 1 else None
+
+    codec = telemetry_codecs.lookup(device_type, version)
+    if codec is None:
         print(f"Unrecognized packet type from node {packet.src_node}.")
 
+    return codec
 
 # ==========================================================================================================
-# Unpacks a telemetry packet from a BORC
+# Determine device type and unpack accordingly
 # ==========================================================================================================
-def unpack_borc_telemetry_packet():
+def process_telemetry_packet(packet):
 
-    # BORC telemetry packet format
-    radio_format = '<BBBBBBHHHH'
-    radio_size   = struct.calcsize(radio_format)
+    codec = find_telemetry_codec(packet)
+    if codec is None:
+        return None
 
-    # unpack the message into individual components
-    _, version, setpoint, manual_index, error_byte, transaction_id, hum, temp_f, battery, pwm = struct.unpack(radio_format, packet.data[:radio_size])
+    return build_telemetry_point(packet, codec.decode(packet.data))
 
-    # send a response back to BORC
-    send_response(packet.src_node)
+# ==========================================================================================================
+# Unpacks a burst of (packet, codec) pairs, decoding all the packets from each kind of device at once
+# ==========================================================================================================
+def process_telemetry_batch(packets):
 
-    # clear contents from dictionaries if previously populated
-    node_tags = {}
-    measurements = {}
-    node_tags.clear()
-    measurements.clear()
+    # group the packets by codec
+    groups = {}
+    for packet, codec in packets:
+        groups.setdefault(codec, []).append(packet)
+
+    # decode each group in one pass
+    json_body = []
+    for codec, group in groups.items():
+        start_time = time.perf_counter()
+        decoded = codec.decode_batch([packet.data for packet in group])
+        DECODE_SECONDS.observe((time.perf_counter() - start_time) / len(group), len(group))
+        for packet, tags_and_fields in zip(group, decoded):
+            point = build_telemetry_point(packet, tags_and_fields)
+            if point:
+                hub.publish(packet.src_node, codec.name, point[0])
+                json_body += point
+
+    return json_body
+
+# ==========================================================================================================
+# Builds the JSON point for one decoded telemetry packet
+# ==========================================================================================================
+def build_telemetry_point(packet, tags_and_fields):
+
+    if tags_and_fields is None:
+        print(f"Telemetry packet from node {packet.src_node} is too short.")
+        return None
+
+    decoded_tags, decoded_fields = tags_and_fields
 
     # create a new dictionary of node tags
-    node_tags = {
-        "node_id"           : packet.src_node,
-        "telemetry_version" : version,
-        "transaction_id"    : transaction_id,
-        "error_byte"        : error_byte
-    }
+    node_tags = {"node_id" : packet.src_node}
+    node_tags.update(decoded_tags)
 
     # create a new dictionary of measurements from the node
-    measurements = {
-        'temperature'    : temp_f/100,
-        'humidity'       : hum/100,
-        'setpoint'       : setpoint,
-        'manual_index'   : manual_index,
-        'battery'        : battery,
-        'servo_PWM'      : pwm,
-        'RSSI'           : packet.rssi
-    }
+    measurements = decoded_fields
+    measurements['RSSI'] = packet.rssi
+
+    # remember these as the node's latest readings
+    latest.update(packet.src_node, measurements)
+    registry.touch(packet.src_node)
 
     # return JSON packet
     return (pack_JSON(node_tags, measurements))
 # ==========================================================================================================
 
+
 # ==========================================================================================================
-# Unpacks a telemetry packet from a STM
+# Send a response back to Node, carrying every command waiting in its mailbox.  If "transaction_id"
+# is given, the response is remembered so a retransmission of that transaction gets it again.
+#
+# Each command goes out in exactly one response.  Until the gateway has sent a response carrying
+# commands, a retransmission is answered without them; once it has, retransmissions get the same
+# response, commands and all, because the node missed it.  If it can't be sent, the commands go back
+# in the mailbox for the node's next uplink, and retransmissions never see them.
 # ==========================================================================================================
-def unpack_stm_telemetry_packet():
+def send_response(destination, transaction_id = None):
 
-    # STM telemetry packet format
-    radio_format = '<BBHHBB'
-    radio_size   = struct.calcsize(radio_format)
+    # everything pending for this node goes out in one response
+    response, commands = mailbox.take(destination)
 
-    # unpack the message into individual components
-    _, version, before_temp, after_temp, error_byte, transaction_id = struct.unpack(radio_format, packet.data[:radio_size])
+    if transaction_id is not None:
+        dedup.remember(destination, transaction_id, response if commands is None else mailbox.idle)
 
-    # send a response back to STM
-    send_response(packet.src_node)
-
-    # clear contents from dictionaries if previously populated
-    node_tags = {}
-    measurements = {}
-    node_tags.clear()
-    measurements.clear()
-
-    # create a new dictionary of node tags
-    node_tags = {
-        "node_id"           : packet.src_node,
-        "telemetry_version" : version,
-        "transaction_id"    : transaction_id,
-        "error_byte"        : error_byte
-    }
+    def on_result(sent):
+        if commands is None:
+            return
+        if not sent:
+            mailbox.requeue(destination, commands)
+        elif transaction_id is not None:
+            dedup.replace(destination, transaction_id, response)
 
-    # create a new dictionary of measurements from the node
-    measurements = {
-        'temp_before'    : before_temp/100,
-        'temp_after'     : after_temp/100,
-        'RSSI'           : packet.rssi
-    }
+    transmit_response(destination, response, on_result)
 
-    # return JSON packet
-    return (pack_JSON(node_tags, measurements))
 # ==========================================================================================================
+# Queues a response for transmission; the ingest loop doesn't wait for the gateway's ACK.  A response
+# that can't be sent quickly is useless, because by then the node has retransmitted, so fresh and
+# repeated responses alike give up after RESPONSE_TIMEOUT.  Once the gateway has answered, the round
+# trip is timed and "on_result", if given, is called on the transmit thread with True if it was sent
+# ==========================================================================================================
+def transmit_response(destination, response, on_result = None):
 
+    start_time = time.perf_counter()
+    def on_sent(future):
+        sent = future.exception() is None and future.result()
+        if sent:
+            RESPONSE_SECONDS.observe(time.perf_counter() - start_time)
+        if on_result is not None:
+            on_result(sent)
+
+    gw.send_radio_packet_async(destination, response, on_sent, RESPONSE_TIMEOUT)
 
 # ==========================================================================================================
-# Send a response back to Node
+# Answers a telemetry packet, unless it's a retransmission of one we've already answered, in which
+# case the node missed our response and gets exactly the same response again
+#
+# Returns: True if the packet is new and should be decoded, False if it's a duplicate
 # ==========================================================================================================
-def send_response(destination):
-
-    # define the struct format we want to pack as a response
-    radio_format = '<BBBBBH16s'
+def respond_once(packet, codec):
 
-    # tasks_bit_field:
-    # Change setpoint        (1 << 0)
-    # Update manual index    (1 << 1)
-    # Reboot node            (1 << 2)
-    # Update Node params     (1 << 3)
-    
-    packet_type = TYPE_RESPONSE_PACKET
-    tasks_bit_field = 0
-    setpoint = 72
-    manual_index = 0
-    network_id = 10
-    node_id = 2
-    encryption_key = bytes('1234123412341234', 'utf-8')
+    transaction_id = codec.peek(packet.data, 'transaction_id')
+    if transaction_id is None:
+        send_response(packet.src_node)
+        return True
 
-    packet_components = struct.pack(radio_format, packet_type, tasks_bit_field, setpoint, manual_index, network_id, node_id, encryption_key)
+    response = dedup.lookup(packet.src_node, transaction_id)
+    if response is not None:
+        DUPLICATES.inc()
+        if debug_sampled():
+            print(f"Duplicate of transaction {transaction_id} from node {packet.src_node}, re-sending response")
+        transmit_response(packet.src_node, response)
+        return False
 
-    # send response to gateway for transmission
-    gw.send_radio_packet(destination, packet_components)
+    send_response(packet.src_node, transaction_id)
+    return True
 
 # ==========================================================================================================
 
@@ -297,31 +427,566 @@ def send_response(destination):
 app = Flask(__name__)
 @app.route('/thermal/<node_id>', methods=['GET'])
 def thermal_api_post(node_id):
-    # Influxdb credentials
-    db_config = read_db_config()
 
-    # start influx session and upload
+    # node IDs are numeric
+    if not node_id.isdigit():
+        return jsonify({'error': 'node_id must be a number'}), 400
+
+    # answer from the in-memory cache if the ingest loop has seen this node
+    reading = latest.get(int(node_id), 'temperature')
+    if reading is not None:
+        return jsonify({'node_id': node_id, 'temperature': reading['value'],
+                        'age_seconds': round(reading['age'], 3), 'stale': reading['stale']}), 200
+
+    # otherwise, borrow a persistent connection from the shared pool and ask the database
+    measurement, column = stored_column('temperature', 'last')
+    try:
+        with pool.connection() as client:
+            result = client.query(f'SELECT "{column}" AS temperature FROM {measurement} WHERE node_id = $node_id '
+                                  f'ORDER BY time DESC LIMIT 1', bind_params={'node_id': node_id}, epoch='s')
+            #Result: ResultSet({'('node_data', None)': [{'time': 1644270013, 'temperature': 80.75}]})
+    except Exception as e:
+        print(f'Error querying InfluxDB: {e}')
+        return jsonify({'error': 'Database unavailable'}), 503
+
+    for row in result.get_points():
+        if row['temperature'] is not None:
+
+            # seed the cache so the next request for this node doesn't hit the database
+            latest.update(int(node_id), {'temperature': row['temperature']}, row['time'])
+            reading = latest.get(int(node_id), 'temperature')
+            return jsonify({'node_id': node_id, 'temperature': reading['value'],
+                            'age_seconds': round(reading['age'], 3), 'stale': reading['stale']}), 200
+
+    return jsonify({'error': 'Temperature data not found for the given node_id'}), 404
+
+# ==========================================================================================================
+# Results of the bulk and history queries, kept for a few seconds so that repeated dashboard polls
+# cost nothing
+# ==========================================================================================================
+results = ResultCache(ttl = 2.0)
+
+MAX_QUERY_NODES        = 1000   # Most nodes one request may name
+LATEST_LOOKBACK        = '30d'  # How far back the database is searched for a node's latest reading
+HISTORY_TTL            = 30.0   # Seconds a history result is cached, at most
+DEFAULT_HISTORY_POINTS = 300    # Points per series when the caller doesn't pick an interval
+MAX_HISTORY_POINTS     = 2000   # Most points per series; longer ranges are downsampled further
+
+TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+# ==========================================================================================================
+# Latest readings for many nodes in one request.  "nodes" is a comma-separated list of node IDs, or
+# "all" (the default).  "fields" is a comma-separated list of fields (default "temperature")
+#
+#     GET /thermal?nodes=12,14,15&fields=temperature,humidity
+# ==========================================================================================================
+@app.route('/thermal', methods=['GET'])
+def thermal_bulk_api():
+
+    try:
+        nodes = parse_node_list(request.args.get('nodes'))
+        fields = parse_field_list(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return cached_json(('latest', nodes, fields), lambda: query_latest(nodes, fields))
+
+# ==========================================================================================================
+# Downsampled history for one or more nodes.  Each field is averaged over "interval" buckets between
+# "start" and "end".  Times are epoch seconds, "now", or relative to now like "-6h"; intervals are
+# seconds or a duration like "5m"
+#
+#     GET /thermal/history?nodes=12&fields=temperature&start=-24h&end=now&interval=10m
+# ==========================================================================================================
+@app.route('/thermal/history', methods=['GET'])
+def thermal_history_api():
+
+    try:
+        nodes = parse_node_list(request.args.get('nodes'))
+        fields = parse_field_list(request.args.get('fields'))
+        start_text = request.args.get('start', '-1h')
+        end_text = request.args.get('end', 'now')
+        interval_text = request.args.get('interval')
+        start, end, interval = history_range(start_text, end_text, interval_text)
+    except (ValueError, OverflowError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    # relative times are resolved when the query runs, so polls of "the last hour" share a result
+    key = ('history', nodes, fields, start_text, end_text, interval_text)
+    return cached_json(key, lambda: query_history(nodes, fields, *history_range(start_text, end_text, interval_text)),
+                       min(HISTORY_TTL, interval))
+
+# ==========================================================================================================
+# Serves a cached query result, answering 304 Not Modified if the client already has it
+# ==========================================================================================================
+def cached_json(key, compute, ttl = None):
+
+    try:
+        body, etag = results.get(key, compute, ttl)
+    except Exception as e:
+        print(f'Error querying InfluxDB: {e}')
+        return jsonify({'error': 'Database unavailable'}), 503
+
+    if request.if_none_match.contains(etag):
+        CACHE_REQUESTS.inc(label_value = 'not_modified')
+        response = Response(status = 304)
+    else:
+        response = Response(body, mimetype = 'application/json')
+
+    response.set_etag(etag)
+    response.cache_control.max_age = int(results.ttl if ttl is None else ttl)
+    return response
+
+# ==========================================================================================================
+# Parses a comma-separated list of node IDs into a sorted tuple, or None for "all"
+# ==========================================================================================================
+def parse_node_list(text):
+
+    if text is None or text == 'all':
+        return None
+
     try:
-        client = InfluxDBClient(db_config['server'], db_config['influx_port'], db_config['user'], db_config['passwd'], db_config['db'])
-        result = client.query(f"SELECT temperature FROM node_data WHERE node_id='{node_id}' LIMIT 1")
-        #Result: ResultSet({'('node_data', None)': [{'time': '2022-02-07T21:40:13.561208Z', 'RSSI': -29, 'after_temp': None, 'battery': 4187, 'before_temp': None, 'config_version': None, 'device_type': None, 'error_byte': None, 'fw_version': '1', 'humidity': 22.85, 'is_working': None, 'manual_index': 3, 'node_id': '2', 'servo_PWM': 3562, 'setpoint': 73, 'telemetry_version': None, 'temp_after': None, 'temp_before': None, 'temperature': 80.75, 'transaction_id': None, 'uid': None}]})
-        client.close()
-        temperature = None
-        for row in result.get_points():
-            temperature = row['temperature']
-
-        client.close()
-
-        if temperature is not None:
-            return jsonify({'node_id': node_id, 'temperature': temperature}), 200
+        nodes = tuple(sorted({int(node) for node in text.split(',') if node.strip()}))
+    except ValueError:
+        raise ValueError('nodes must be a comma-separated list of node IDs, or "all"') from None
+
+    if not nodes or nodes[0] < 0:
+        raise ValueError('nodes must be a comma-separated list of node IDs, or "all"')
+    if len(nodes) > MAX_QUERY_NODES:
+        raise ValueError(f'at most {MAX_QUERY_NODES} nodes per request')
+
+    return nodes
+
+# ==========================================================================================================
+# Parses a comma-separated list of field names.  Only fields we know about are allowed, because
+# field names can't be passed to InfluxDB as bind parameters
+# ==========================================================================================================
+def parse_field_list(text):
+
+    fields = tuple(field for field in (text or 'temperature').split(',') if field)
+    unknown = [field for field in fields if field not in latest.fields]
+    if unknown or not fields:
+        raise ValueError(f'fields must be some of {", ".join(latest.fields)}')
+
+    return fields
+
+# ==========================================================================================================
+# Converts "now", "-<duration>" or epoch seconds into epoch seconds, and a duration into seconds
+# ==========================================================================================================
+def parse_time(text, now):
+
+    if text == 'now':
+        return now
+    if text.startswith('-'):
+        return now - parse_duration(text[1:])
+    return float(text)
+
+def parse_duration(text):
+
+    if text and text[-1] in TIME_UNITS:
+        return float(text[:-1]) * TIME_UNITS[text[-1]]
+    return float(text)
+
+# ==========================================================================================================
+# Works out the time range and bucket size of a history query
+#
+# Returns: (start, end, interval), all in whole seconds
+# ==========================================================================================================
+def history_range(start_text, end_text, interval_text):
+
+    now = time.time()
+    start = int(parse_time(start_text, now))
+    end = int(math.ceil(parse_time(end_text, now)))
+    if end <= start:
+        raise ValueError('end must be after start')
+
+    span = end - start
+    interval = parse_duration(interval_text) if interval_text else span / DEFAULT_HISTORY_POINTS
+
+    # never return more than MAX_HISTORY_POINTS per series
+    interval = max(1, int(math.ceil(max(interval, span / MAX_HISTORY_POINTS))))
+
+    return start, end, interval
+
+# ==========================================================================================================
+# Builds the InfluxQL condition that limits a query to some nodes, adding a bind parameter for each
+# ==========================================================================================================
+def node_condition(nodes, bind_params):
+
+    if nodes is None:
+        return ''
+
+    names = []
+    for i, node in enumerate(nodes):
+        bind_params[f'node{i}'] = str(node)
+        names.append(f'node_id = $node{i}')
+
+    return f" AND ({' OR '.join(names)})"
+
+# ==========================================================================================================
+# Where the database keeps a field: its own column in node_data, or, when the aggregator folds it into
+# summary points, one of its statistics ("last", "mean", ...) in the aggregate measurement
+#
+# Returns: (measurement, column)
+# ==========================================================================================================
+def stored_column(field, statistic):
+
+    if aggregator is None or field not in aggregator.fields or field in aggregator.raw_fields:
+        return 'node_data', field
+
+    return aggregator.measurement, f'{field}_{statistic}'
+
+# ==========================================================================================================
+# The latest readings of some nodes: from the in-memory cache where we have them, and from a grouped
+# database query per field for the rest.  The result is cached and tagged by its content, so it holds
+# each reading's timestamp rather than its age, which would change on every request
+# ==========================================================================================================
+def query_latest(nodes, fields):
+
+    found = {}
+    for node, reading in latest.snapshot(nodes, fields).items():
+        if reading['values']:
+            found[str(node)] = {'values': reading['values'], 'timestamp': round(reading['timestamp'], 3),
+                                'stale': reading['stale']}
+
+    # ask the database about every node we don't have, or about everything if the caller wants all
+    # nodes, since the cache only knows about nodes we've heard from since we started
+    missing = None if nodes is None else [node for node in nodes if str(node) not in found]
+    if missing is None or missing:
+
+        # one field per query: with several selectors, InfluxDB reports the start of the time range
+        # as each row's time, rather than when the value was written
+        from_database = {}
+        with pool.connection() as client:
+            for field in fields:
+
+                bind_params = {}
+                measurement, column = stored_column(field, 'last')
+                query = (f'SELECT LAST("{column}") AS "{field}" FROM {measurement} '
+                         f'WHERE time > now() - {LATEST_LOOKBACK}'
+                         f'{node_condition(missing, bind_params)} GROUP BY node_id')
+                result = client.query(query, bind_params=bind_params or None, epoch='s')
+
+                for (_, tags), rows in result.items():
+                    if tags['node_id'] in found:
+                        continue
+                    for row in rows:
+                        if row.get(field) is not None:
+                            entry = from_database.setdefault(tags['node_id'],
+                                                             {'values': {}, 'timestamp': None, 'stale': None})
+                            entry['values'][field] = row[field]
+                            entry['timestamp'] = max(entry['timestamp'] or 0, row['time'])
+
+        found.update(from_database)
+
+    return {'nodes': found,
+            'missing': [node for node in nodes if str(node) not in found] if nodes is not None else []}
+
+# ==========================================================================================================
+# The averaged history of some nodes, from one grouped database query per measurement the fields are
+# kept in.  Aggregated fields are averaged from their window means
+# ==========================================================================================================
+def query_history(nodes, fields, start, end, interval):
+
+    selects = {}
+    for field in fields:
+        measurement, column = stored_column(field, 'mean')
+        selects.setdefault(measurement, []).append(f'MEAN("{column}") AS "{field}"')
+
+    # {node ID: {time: row}}, merging the rows of each measurement by time
+    merged = {}
+    with pool.connection() as client:
+        for measurement, columns in selects.items():
+
+            bind_params = {'start': start * 1000000000, 'end': end * 1000000000}
+            query = (f'SELECT {", ".join(columns)} FROM {measurement} WHERE time >= $start AND time < $end'
+                     f'{node_condition(nodes, bind_params)} GROUP BY time({interval}s), node_id fill(none)')
+            result = client.query(query, bind_params=bind_params, epoch='s')
+
+            for (_, tags), rows in result.items():
+                times = merged.setdefault(tags['node_id'], {})
+                for row in rows:
+                    times.setdefault(row['time'], {}).update(row)
+
+    series = {}
+    for node, times in merged.items():
+        columns = series[node] = {'time': sorted(times), **{field: [] for field in fields}}
+        for time_bucket in columns['time']:
+            for field in fields:
+                columns[field].append(times[time_bucket].get(field))
+
+    return {'start': start, 'end': end, 'interval_seconds': interval, 'nodes': series}
+
+# ==========================================================================================================
+# Queue commands for a node, to be delivered in the response to its next packet.  POST a JSON object
+# with any of "setpoint", "manual_index", "reboot" (true or false) and "node_params" ({"network_id",
+# "node_id", "encryption_key"}).  GET shows what's waiting
+# ==========================================================================================================
+@app.route('/mailbox/<node_id>', methods=['GET', 'POST'])
+def mailbox_api(node_id):
+
+    # node IDs are numeric
+    if not node_id.isdigit():
+        return jsonify({'error': 'node_id must be a number'}), 400
+    node = int(node_id)
+
+    if request.method == 'POST':
+        commands = request.get_json(silent=True)
+        if not isinstance(commands, dict):
+            return jsonify({'error': 'expected a JSON object'}), 400
+
+        # check every command before posting any, so a bad request leaves the mailbox alone
+        tasks = 0
+        values = {}
+        try:
+            if 'setpoint' in commands:
+                tasks |= TASK_SETPOINT
+                values['setpoint'] = int(commands['setpoint'])
+            if 'manual_index' in commands:
+                tasks |= TASK_MANUAL_INDEX
+                values['manual_index'] = int(commands['manual_index'])
+            if 'reboot' in commands:
+                if commands['reboot'] is True:
+                    tasks |= TASK_REBOOT
+                elif commands['reboot'] is not False:
+                    return jsonify({'error': 'reboot must be true or false'}), 400
+            if 'node_params' in commands:
+                params = commands['node_params']
+                key = params['encryption_key'].encode('utf-8')
+                if len(key) != 16:
+                    return jsonify({'error': 'encryption_key must be 16 bytes'}), 400
+                tasks |= TASK_NODE_PARAMS
+                values.update(network_id = int(params['network_id']), node_id = int(params['node_id']),
+                              encryption_key = key)
+            if tasks:
+                mailbox.post(node, tasks, values)
+        except (KeyError, TypeError, ValueError, AttributeError, struct.error) as e:
+            return jsonify({'error': f'bad command: {e}'}), 400
+
+    pending = mailbox.peek(node)
+    if pending is not None:
+        pending['encryption_key'] = pending['encryption_key'].decode('utf-8', 'replace')
+    return jsonify({'node_id': node_id, 'pending': pending}), 200
+
+# ==========================================================================================================
+# Live telemetry as Server-Sent Events: every point is pushed as soon as it's decoded.  Optionally
+# filtered to some nodes and device types (by codec name).  A client that can't keep up loses its
+# oldest events, and is sent a "dropped" event saying how many
+#
+#     GET /stream?nodes=12,14&devices=BORC
+# ==========================================================================================================
+@app.route('/stream', methods=['GET'])
+def stream_api():
+
+    try:
+        nodes = parse_node_list(request.args.get('nodes'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    devices = request.args.get('devices')
+    if devices is not None:
+        devices = [device.strip().upper() for device in devices.split(',') if device.strip()]
+
+    subscriber = hub.subscribe(nodes, devices)
+    if subscriber is None:
+        return jsonify({'error': 'Too many stream clients'}), 503
+
+    def events():
+        try:
+            yield b'retry: 2000\n\n'
+            while True:
+                yield subscriber.get(STREAM_KEEPALIVE) or b': keep-alive\n\n'
+        finally:
+            hub.unsubscribe(subscriber)
+
+    return Response(events(), mimetype = 'text/event-stream',
+                    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# ==========================================================================================================
+# Prometheus scrape endpoint
+# ==========================================================================================================
+@app.route('/metrics', methods=['GET'])
+def metrics_api():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# ==========================================================================================================
+# Handles one burst of packets from the gateway: answers each of them, and uploads what they carried
+# ==========================================================================================================
+def handle_burst(packets):
+
+    # telemetry packets from this burst, decoded together once the burst is sorted
+    telemetry = []
+
+    for packet in packets:
+
+        # check if the packet received is of RadioPacket type
+        if isinstance(packet, moteinogw.RadioPacket):
+
+            NODE_PACKETS.inc(label_value = packet.src_node)
+            NODE_RATE.mark(packet.src_node)
+        
+            # If it is a config packet
+            if (packet.data[0] == TYPE_CONFIG_PACKET):
+                print ("Config packet received")
+
+                # unpack packet, skipping it if it's too short to make sense of
+                json_body = unpack_config_packet(packet)
+                if json_body is None:
+                    continue
+
+                # send a response back
+                send_response(packet.src_node)
+
+                # upload it to the database
+                upload(json_body)
+
+            # If it is a telemetry packet
+            elif (packet.data[0] == TYPE_TELEMETRY_PACKET):
+
+                # figure out how to decode it
+                codec = find_telemetry_codec(packet)
+                if codec is None:
+                    continue
+
+                # send a response back to BORC, and save it for batch decoding unless it's a retransmission
+                if respond_once(packet, codec):
+                    telemetry.append((packet, codec))
+
+    # decode the burst's telemetry and upload it to the database
+    if telemetry:
+        json_body = process_telemetry_batch(telemetry)
+        if not json_body:
+            print("Failed to unpack telemetry.")
+        else:
+            # fold the points into their nodes' windows, keeping only the fields wanted raw
+            if aggregator is not None:
+                json_body = aggregator.add_points(json_body)
+            upload(json_body)
+
+    # write out the windows of nodes that have gone quiet
+    if aggregator is not None:
+        upload(aggregator.flush_due())
+
+    # write out last-seen times every few seconds
+    registry.flush()
+
+# ==========================================================================================================
+# Pipeline mode, reader side: answers each packet in a burst, then hands it to the worker process that
+# owns its node for decoding and uploading
+# ==========================================================================================================
+def route_burst(packets):
+
+    for packet in packets:
+
+        if not isinstance(packet, moteinogw.RadioPacket):
+            continue
+
+        NODE_PACKETS.inc(label_value = packet.src_node)
+        NODE_RATE.mark(packet.src_node)
+
+        # config packets are answered and recorded here, because the registry lives here
+        if (packet.data[0] == TYPE_CONFIG_PACKET):
+            print ("Config packet received")
+            if not record_config_packet(packet):
+                continue
+            send_response(packet.src_node)
+            pipeline.submit(packet.src_node, packet.raw, 0)
+
+        elif (packet.data[0] == TYPE_TELEMETRY_PACKET):
+            codec = find_telemetry_codec(packet)
+            if codec is not None and respond_once(packet, codec):
+                pipeline.submit(packet.src_node, packet.raw, registry.device_type(packet.src_node))
+                observe_telemetry(packet, codec)
+
+    # let the workers see the whole burst at once
+    pipeline.flush()
+
+    # write out last-seen times every few seconds
+    registry.flush()
+
+# ==========================================================================================================
+# Pipeline mode: the workers decode telemetry in other processes, so the reader decodes a copy of each
+# packet for what lives here: the API's latest readings, the registry's last-seen times, and anyone
+# watching /stream
+# ==========================================================================================================
+def observe_telemetry(packet, codec):
+
+    tags_and_fields = codec.decode(packet.data)
+    if tags_and_fields is None:
+        return
+
+    tags, fields = tags_and_fields
+    fields['RSSI'] = packet.rssi
+    latest.update(packet.src_node, fields)
+    registry.touch(packet.src_node)
+
+    if hub.subscribers:
+        hub.publish(packet.src_node, codec.name, pack_JSON({'node_id': packet.src_node, **tags}, fields)[0])
+
+# ==========================================================================================================
+# Pipeline mode, worker side: runs once when a worker process starts
+# ==========================================================================================================
+def worker_setup(index):
+
+    global writer
+
+    # each worker has its own database writer, and its own spool
+    spool = Spool(os.path.join(os.environ.get('MOTEINO_SPOOL', 'spool'), f'worker{index}'))
+    spool.open()
+    writer = InfluxWriter(pool, spool = spool)
+    writer.start()
+
+# ==========================================================================================================
+# Pipeline mode, worker side: decodes and uploads a batch of (frame, device type) from the reader.
+# Doesn't return until the points are in the database or the spool, because the batch is freed from
+# the ring as soon as it does.  With aggregation on, points still in an open window are only in
+# memory, and are lost if the worker is killed
+# ==========================================================================================================
+def worker_handle(records):
+
+    json_body = []
+    telemetry = []
+
+    for frame, device_type in records:
+
+        packet = moteinogw.RadioPacket(frame)
+
+        if (packet.data[0] == TYPE_CONFIG_PACKET):
+            json_body += unpack_config_packet(packet, record = False) or []
+
+        # the reader already answered it, and dropped it if it was a retransmission
         else:
-            return jsonify({'error': 'Temperature data not found for the given node_id'}), 404
-    except:
-        print('Error connecting/uploading to InfluxDB')
+            codec = find_telemetry_codec(packet, device_type)
+            if codec is not None:
+                telemetry.append((packet, codec))
 
+    if telemetry:
+        points = process_telemetry_batch(telemetry)
+        if aggregator is not None:
+            points = aggregator.add_points(points)
+        json_body += points
 
+    if aggregator is not None:
+        json_body += aggregator.flush_due()
 
+    upload(json_body)
+    writer.flush()
+
+# ==========================================================================================================
+# Pipeline mode, worker side: flushes everything as the worker stops
 # ==========================================================================================================
+def worker_teardown():
+
+    if aggregator is not None:
+        upload(aggregator.flush_all())
+    writer.shutdown()
+    pool.close()
+
+# ==========================================================================================================
+# Called on the gateway's reader thread when packets are arriving faster than we handle them
+# ==========================================================================================================
+def receive_queue_high(gateway):
+    print(f"Receive queue is backing up: {gateway.queue.stats()}")
 
 # ==========================================================================================================
 # MAIN
@@ -329,17 +994,26 @@ def thermal_api_post(node_id):
 if __name__ == '__main__':
 
     if len(sys.argv) != 2:
-        print("Usage: python3 script.py <serial_port>")
+        print("Usage: python3 script.py <serial_port | replay:<capture>[@speed]>")
         sys.exit(1)
 
     # get the COM port from the cli argument
     com_port = sys.argv[1]
 
-    # create gateway object
-    gw = moteinogw.MoteinoGateway()
+    # "replay:<capture>@<speed>" plays a capture back instead of opening a serial port
+    replaying = com_port.startswith('replay:')
+    if replaying:
+        capture_base, _, speed = com_port[len('replay:'):].partition('@')
+        com_port = ReplaySerial(capture_base, float(speed or 1))
 
-    # startup gateway object on specified COM port
-    gw.startup(com_port)
+    # create gateway object, with a bounded receive queue whose overflow policy MOTEINO_RX_POLICY
+    # can change to drop_newest or coalesce
+    gw = moteinogw.MoteinoGateway(rx_policy = os.environ.get('MOTEINO_RX_POLICY', 'drop_oldest'),
+                                  on_high_water = receive_queue_high)
+
+    # startup gateway object on specified COM port, recording the raw traffic if
+    # MOTEINO_CAPTURE names a capture to write
+    gw.startup(com_port, capture = os.environ.get('MOTEINO_CAPTURE'), wait_for_quiet = not replaying)
 
     # Wait for the packet that tells us the gateway is alive
     packet = gw.wait_for_message()
@@ -350,52 +1024,71 @@ if __name__ == '__main__':
     # Set the encryption key
     gw.set_encryption_key(b'1234123412341234')
 
+    # carry several packets per UART frame if the firmware can.  A replay just plays back whatever
+    # the capture holds, batched or not
+    if not replaying:
+        print(f"UART batching: {'on' if gw.negotiate_batching() else 'off, the firmware predates it'}")
+
     print("Initialized!")
 
-    # a dictionary to link known devices to their respective device types
-    device_type_mappings = {}
+    # load the device types of every node we've seen before
+    registry.open()
+
+    # in pipeline mode the workers do the uploading, otherwise start the background thread that
+    # batches points into InfluxDB, spooling them to disk whenever the database can't take them
+    if PIPELINE_WORKERS:
+        pipeline = Pipeline(PIPELINE_WORKERS, worker_setup, worker_handle, worker_teardown)
+        pipeline.start()
+    else:
+        spool = Spool(os.environ.get('MOTEINO_SPOOL', 'spool'))
+        spool.open()
+        writer = InfluxWriter(pool, spool = spool)
+        writer.start()
+
+    # serve the API from this process, so it shares the caches and mailbox with the ingest loop
+    api = None
+    if API_ADDRESS:
+        host, _, port = API_ADDRESS.rpartition(':')
+        api = ApiServer(app, host or '0.0.0.0', int(port), threads = hub.max_subscribers + 8)
+        api.start()
+        print(f"Serving the API on {api.address()} with {api.kind}")
 
     try:
 
-        # Sit in a loop, displaying incoming radio packets
+        # Sit in a loop, handling incoming radio packets
         while True:
-
-            # wait for the next message
-            packet = gw.wait_for_message()
-        
-            # check if the packet received is of RadioPacket type
-            if isinstance(packet, moteinogw.RadioPacket):
-                
-                # If it is a config packet
-                if (packet.data[0] == TYPE_CONFIG_PACKET):
-                    print ("Config packet received")
-                    
-                    # send a response back
-                    send_response(packet.src_node)
-                    
-                    # unpack packet
-                    json_body, device_type_mappings = unpack_config_packet(device_type_mappings)
-
-                # If it is a telemetry packet
-                elif (packet.data[0] == TYPE_TELEMETRY_PACKET):
-                    print ("Telemetry packet received")
-
-                    # send a response back to BORC
-                    send_response(packet.src_node)
-
-                    # process and unpack packet
-                    json_body = process_telemetry_packet(device_type_mappings)
-                    if not json_body:
-                        print("Failed to unpack telemetry.")
-                        continue
-
-                # pack the data into JSON and upload to database
-                upload(json_body)
+            if pipeline is None:
+                handle_burst(gw.drain_messages())
+            else:
+                route_burst(gw.drain_messages(timeout_seconds = 1))
+                pipeline.check()
     
     except KeyboardInterrupt:
 
         # close out the sockets in use
         print ("\nShutting down...\n")
+        if api is not None:
+            api.close()
         gw.close()
 
-# ==========================================================================================================
\ No newline at end of file
+        # let the workers finish what they have, or flush whatever points are still waiting to
+        # be written, including unfinished windows
+        if pipeline is not None:
+            pipeline.stop()
+            print(f"Pipeline: {pipeline.stats()}")
+        else:
+            if aggregator is not None:
+                upload(aggregator.flush_all())
+                print(f"Aggregator: {aggregator.stats()}")
+            writer.shutdown()
+            print(f"InfluxDB writer: {writer.stats()}")
+            print(f"Spool: {spool.stats()}")
+        print(f"Duplicate filter: {dedup.stats()}")
+        print(f"Downlink mailbox: {mailbox.stats()}")
+        print(f"Receive queue: {gw.queue.stats()}")
+        print(f"UART batching: {gw.batch_stats()}")
+        print(f"Serial link: {gw.link_stats()}")
+        pool.close()
+        registry.close()
+
+# ==========================================================================================================
@@ -0,0 +1,87 @@
+# ==========================================================================================================
+# rtt.py - Estimates how long the gateway takes to answer, and so how long to wait before retrying
+# ==========================================================================================================
+import collections
+import random
+
+
+# ==========================================================================================================
+# RttEstimator - A smoothed round-trip time and its variance, maintained the way TCP maintains them
+#                (RFC 6298), and the retransmission timeout (RTO) they imply
+#
+# Every ACK that answers a first attempt is a sample.  An ACK that answers a retry is not, because
+# it may be a late answer to the attempt before (Karn's algorithm).  The timeout for a retry doubles
+# with each failure, and is stretched by up to a quarter at random so that retries don't fall into
+# step with whatever made the first attempt fail.
+#
+# The most recent samples are kept for percentiles, so link health can be reported.
+# ==========================================================================================================
+class RttEstimator:
+
+    MIN_RTO     = 0.1     # Never time out sooner than this, whatever the samples say
+    MAX_RTO     = 5.0     # Never wait longer than this for any one attempt
+    INITIAL_RTO = 1.0     # Timeout until the first sample arrives
+    ALPHA       = 1 / 8   # Weight of each new sample in the smoothed RTT
+    BETA        = 1 / 4   # Weight of each new sample in the variance
+    GRANULARITY = 0.001   # Clock granularity, the least the variance can add to the timeout
+
+    srtt    = None  # Smoothed round-trip time in seconds, or None before the first sample
+    rttvar  = 0.0   # Round-trip time variance in seconds
+    rto     = 0.0   # Timeout for a first attempt
+    recent  = None  # deque of the most recent samples
+    count   = 0     # Samples taken
+
+    # ------------------------------------------------------------------------------
+    # Constructor - Keeps the most recent "history" samples for percentiles
+    # ------------------------------------------------------------------------------
+    def __init__(self, history = 1000):
+        self.rto    = self.INITIAL_RTO
+        self.recent = collections.deque(maxlen = history)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # observe() - Folds in a round-trip time measured on a first attempt
+    # ------------------------------------------------------------------------------
+    def observe(self, rtt):
+
+        if self.srtt is None:
+            self.srtt   = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt   += self.ALPHA * (rtt - self.srtt)
+
+        rto = self.srtt + max(self.GRANULARITY, 4 * self.rttvar)
+        self.rto = min(self.MAX_RTO, max(self.MIN_RTO, rto))
+
+        self.recent.append(rtt)
+        self.count += 1
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # timeout() - Returns how long to wait for an answer after "failures" attempts
+    #             have already failed
+    # ------------------------------------------------------------------------------
+    def timeout(self, failures = 0):
+        if failures == 0:
+            return self.rto
+        return min(self.MAX_RTO, self.rto * (2 ** min(failures, 16)) * random.uniform(1.0, 1.25))
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # stats() - Returns the estimate and percentiles of the recent samples, in
+    #           milliseconds, as a dictionary
+    # ------------------------------------------------------------------------------
+    def stats(self):
+
+        samples = sorted(self.recent)
+        result = {'samples': self.count, 'rto_ms': self.rto * 1000,
+                  'srtt_ms': None if self.srtt is None else self.srtt * 1000, 'rttvar_ms': self.rttvar * 1000}
+
+        for name, fraction in (('p50_ms', .5), ('p90_ms', .9), ('p99_ms', .99)):
+            result[name] = samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000 if samples else None
+
+        return result
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
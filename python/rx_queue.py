@@ -0,0 +1,176 @@
+# ==========================================================================================================
+# rx_queue.py - The bounded, two-lane queue of packets waiting for the gateway's consumer
+# ==========================================================================================================
+import collections
+import metrics
+
+RX_DROPPED = metrics.counter('moteino_rx_dropped_total', 'Received packets dropped from a full receive queue',
+                             label = 'reason')
+
+DROP_OLDEST = 'drop_oldest'   # A full queue throws away its oldest packet to make room
+DROP_NEWEST = 'drop_newest'   # A full queue refuses the new packet
+COALESCE    = 'coalesce'      # A full queue keeps only the latest packet from each node
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+
+# ==========================================================================================================
+# ReceiveQueue - Packets from the gateway, with control traffic ahead of radio data
+#
+# Radio packets go in the data lane, which never holds more than "capacity" packets.  Everything
+# else (echo replies, BadPacket diagnostics, anything unrecognised) goes in the control lane, which
+# is small, and is always handed out first so it never waits behind a backlog of telemetry.
+#
+# When the data lane is full, "policy" decides what gives.  COALESCE first throws away every packet
+# that has a newer one from the same node behind it; that pass costs O(n) but frees room for many
+# packets, so it is cheap spread over the packets that follow.  If every waiting packet is from a
+# different node, it falls back to dropping the oldest.
+#
+# put() reports when the data lane climbs past "high_water" (a fraction of capacity), so the
+# application can shed load.  It doesn't report again until the lane has drained below half that.
+#
+# Not thread-safe on its own: MoteinoGateway guards it with its mutex.
+# ==========================================================================================================
+class ReceiveQueue:
+
+    CONTROL_CAPACITY = 1024   # Control packets kept; the oldest are dropped beyond that
+
+    control    = None  # deque of control packets
+    data       = None  # deque of radio packets
+    capacity   = 0     # Most radio packets held
+    policy     = None  # One of POLICIES
+    high_water = 0     # Data depth at which put() reports high water
+    low_water  = 0     # Data depth below which the report is re-armed
+    above_high = False # True between reporting high water and draining below low water
+
+    # Counters
+    dropped_oldest  = 0  # Radio packets dropped to make room
+    dropped_newest  = 0  # Radio packets refused
+    coalesced       = 0  # Radio packets dropped because a newer one from the same node was waiting
+    control_dropped = 0  # Control packets dropped to make room
+    high_water_hits = 0  # Times the data lane climbed past high water
+
+    # ------------------------------------------------------------------------------
+    # Constructor
+    # ------------------------------------------------------------------------------
+    def __init__(self, capacity = 10000, policy = DROP_OLDEST, high_water = 0.8):
+
+        if policy not in POLICIES:
+            raise ValueError(f'policy must be one of {", ".join(POLICIES)}, not {policy!r}')
+
+        self.control    = collections.deque()
+        self.data       = collections.deque()
+        self.capacity   = capacity
+        self.policy     = policy
+        self.high_water = max(1, int(capacity * high_water))
+        self.low_water  = self.high_water // 2
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # put() - Adds a packet to the right lane, applying the overflow policy
+    #
+    # Returns: True if this packet took the data lane past high water
+    # ------------------------------------------------------------------------------
+    def put(self, packet):
+
+        # Only radio packets have a source node
+        if not hasattr(packet, 'src_node'):
+            if len(self.control) >= self.CONTROL_CAPACITY:
+                self.control.popleft()
+                self.control_dropped += 1
+                RX_DROPPED.inc(label_value = 'control')
+            self.control.append(packet)
+            return False
+
+        if len(self.data) >= self.capacity and not self.make_room():
+            return False
+
+        self.data.append(packet)
+
+        if not self.above_high and len(self.data) >= self.high_water:
+            self.above_high = True
+            self.high_water_hits += 1
+            return True
+
+        return False
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # drain() - Removes and returns up to "max_count" packets (all of them if
+    #           None), control packets first
+    # ------------------------------------------------------------------------------
+    def drain(self, max_count = None):
+
+        packets = []
+        for lane in (self.control, self.data):
+            if max_count is None or max_count - len(packets) >= len(lane):
+                packets += lane
+                lane.clear()
+            else:
+                packets += [lane.popleft() for _ in range(max_count - len(packets))]
+                break
+
+        if self.above_high and len(self.data) < self.low_water:
+            self.above_high = False
+
+        return packets
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # stats() - Returns the counters as a dictionary
+    # ------------------------------------------------------------------------------
+    def stats(self):
+        return {'control': len(self.control), 'data': len(self.data), 'capacity': self.capacity,
+                'policy': self.policy, 'dropped_oldest': self.dropped_oldest,
+                'dropped_newest': self.dropped_newest, 'coalesced': self.coalesced,
+                'control_dropped': self.control_dropped, 'high_water_hits': self.high_water_hits}
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # __len__() - The number of packets waiting in both lanes
+    # ------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.control) + len(self.data)
+    # ------------------------------------------------------------------------------
+
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # From here on down are methods that are private to this class
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+
+    # ------------------------------------------------------------------------------
+    # make_room() - Frees at least one slot in the full data lane
+    #
+    # Returns: False if the policy is to refuse the new packet instead
+    # ------------------------------------------------------------------------------
+    def make_room(self):
+
+        if self.policy == DROP_NEWEST:
+            self.dropped_newest += 1
+            RX_DROPPED.inc(label_value = DROP_NEWEST)
+            return False
+
+        if self.policy == COALESCE:
+
+            # Keep the newest packet from each node, in arrival order
+            packets = list(self.data)
+            newest = {}
+            for index, packet in enumerate(packets):
+                newest[packet.src_node] = index
+
+            if len(newest) < len(packets):
+                keep = sorted(newest.values())
+                dropped = len(packets) - len(keep)
+                self.data = collections.deque(packets[index] for index in keep)
+                self.coalesced += dropped
+                RX_DROPPED.inc(dropped, COALESCE)
+                return True
+
+        self.data.popleft()
+        self.dropped_oldest += 1
+        RX_DROPPED.inc(label_value = DROP_OLDEST)
+        return True
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
@@ -0,0 +1,466 @@
+# ==========================================================================================================
+# spool.py - A durable, append-only spool of points that couldn't be written to InfluxDB
+#
+# The spool is a directory of segment files, "00000000.spool", "00000001.spool" and so on.  Each
+# segment starts with an 8-byte magic number followed by records of:
+#
+#     length      uint32    Number of bytes of data that follow the header
+#     crc         uint32    CRC-32 of the data
+#     count       uint32    Number of points in the record
+#     data        bytes     The points, as compact JSON, compressed with zlib
+#
+# Records are only ever appended, and are read back in the order they were written.  How far the
+# reader has got is kept in a small "cursor" file beside the segments; a segment is deleted once
+# everything in it has been read and committed.  Points carry their own timestamps, so if we crash
+# after writing a batch but before saving the cursor, delivering that batch again is harmless.
+# ==========================================================================================================
+import os
+import json
+import zlib
+import glob
+import struct
+import threading
+import time
+import metrics
+
+MAGIC  = b'MGWSPL01'
+RECORD = struct.Struct('<III')
+CURSOR = struct.Struct('<IQ')
+
+SPOOL_POINTS  = metrics.gauge('influx_spool_points', 'Points waiting in the on-disk spool')
+SPOOL_BYTES   = metrics.gauge('influx_spool_bytes', 'Size of the on-disk spool')
+SPOOL_EVICTED = metrics.counter('influx_spool_evicted_points_total', 'Points thrown away because the spool was full')
+
+
+# ==========================================================================================================
+# Spool - Appends batches of points to disk, and hands them back in order
+#
+# The spool never grows beyond "max_bytes".  When it is full, "evict" decides what gives: 'oldest'
+# deletes the oldest whole segment to make room, 'newest' refuses the incoming batch.  Appends are
+# buffered, and the file is fsync()ed at most once every "sync_interval" seconds, so a power cut
+# loses at most that much of the spool.  open() recovers from a crash: it truncates any record that
+# was only partly written and carries on from the saved cursor.
+#
+# Safe to use from any thread.
+# ==========================================================================================================
+class Spool:
+
+    directory     = None  # Where the segment files live
+    segment_bytes = 0     # Size at which a new segment is started
+    max_bytes     = 0     # Most disk space the spool may use
+    sync_interval = 0     # Most seconds between fsync()s of the current segment
+    evict         = None  # 'oldest' or 'newest'
+    segments      = None  # Dictionary of segment number -> size in bytes, oldest first
+    file          = None  # The segment being appended to
+    reader        = None  # (segment number, file) we're reading from, or None
+    cursor        = None  # (segment number, offset) of the next record to read
+    last_sync     = 0     # When the current segment was last fsync()ed
+    unsynced      = False # True if there are appends that haven't been fsync()ed
+    mutex         = None
+
+    # Counters
+    points    = 0         # Points in the spool that haven't been read and committed
+    bytes     = 0         # Size of every segment on disk
+    appended  = 0         # Points appended
+    committed = 0         # Points read back and committed
+    evicted   = 0         # Points thrown away because the spool was full
+    corrupt   = 0         # Records found damaged, and dropped, during recovery
+
+    # ------------------------------------------------------------------------------
+    # Constructor - Doesn't touch the disk.  Call open() before using the spool
+    # ------------------------------------------------------------------------------
+    def __init__(self, directory, segment_bytes = 16 << 20, max_bytes = 512 << 20, sync_interval = 1.0,
+                 evict = 'oldest'):
+
+        if evict not in ('oldest', 'newest'):
+            raise ValueError(f"evict must be 'oldest' or 'newest', not {evict!r}")
+
+        self.directory     = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes     = max_bytes
+        self.sync_interval = sync_interval
+        self.evict         = evict
+        self.segments      = {}
+        self.mutex         = threading.Lock()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # open() - Recovers whatever a previous run left in the spool, and starts a new
+    #          segment to append to
+    # ------------------------------------------------------------------------------
+    def open(self):
+
+        os.makedirs(self.directory, exist_ok = True)
+
+        with self.mutex:
+
+            numbers = sorted(int(os.path.basename(path)[:-6]) for path in glob.glob(self.path('*')))
+            self.cursor = self.load_cursor(numbers)
+
+            for number in numbers:
+
+                # Anything before the cursor has already been delivered
+                if number < self.cursor[0]:
+                    os.remove(self.path(number))
+                    continue
+
+                start = self.cursor[1] if number == self.cursor[0] else len(MAGIC)
+                points, end = self.scan(number, start)
+
+                # A segment that doesn't even have its magic number is useless
+                if end == 0:
+                    self.corrupt += 1
+                    os.remove(self.path(number))
+                    continue
+
+                # Cut off a record that was only partly written, or anything damaged
+                size = os.path.getsize(self.path(number))
+                if end < size:
+                    self.corrupt += 1
+                    os.truncate(self.path(number), end)
+
+                self.segments[number] = end
+                self.bytes += end
+                self.points += points
+
+            self.next_segment()
+            self.update_metrics()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # append() - Writes a batch of points to the end of the spool
+    #
+    # Returns: True if the batch was spooled, False if the spool is full and
+    #          "evict" is 'newest'
+    # ------------------------------------------------------------------------------
+    def append(self, points):
+
+        if not points:
+            return True
+
+        data = zlib.compress(json.dumps(points, separators = (',', ':')).encode(), 1)
+        record = RECORD.pack(len(data), zlib.crc32(data), len(points)) + data
+
+        with self.mutex:
+
+            if self.bytes + len(record) > self.max_bytes and self.evict == 'newest':
+                self.evicted += len(points)
+                SPOOL_EVICTED.inc(len(points))
+                return False
+
+            # Start a new segment if this one is full
+            number = self.current()
+            if self.segments[number] > len(MAGIC) and self.segments[number] + len(record) > self.segment_bytes:
+                self.next_segment()
+                number = self.current()
+
+            self.file.write(record)
+            self.segments[number] += len(record)
+            self.bytes += len(record)
+            self.points += len(points)
+            self.appended += len(points)
+            self.unsynced = True
+
+            # Make room by throwing away the oldest segments
+            while self.bytes > self.max_bytes and len(self.segments) > 1:
+                self.evict_oldest()
+
+            if time.monotonic() - self.last_sync >= self.sync_interval:
+                self.sync_locked()
+
+            self.update_metrics()
+            return True
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # read() - Reads at least "max_points" points (or everything, if there are
+    #          fewer) from the head of the spool without consuming them
+    #
+    # Returns: (list of points, position).  Pass the position to commit() once the
+    #          points have been delivered
+    # ------------------------------------------------------------------------------
+    def read(self, max_points):
+
+        with self.mutex:
+
+            self.file.flush()
+            points = []
+            number, offset = self.cursor
+
+            while len(points) < max_points and number in self.segments:
+
+                # At the end of a segment, move on to the next one
+                if offset >= self.segments[number]:
+                    later = [n for n in self.segments if n > number]
+                    if not later:
+                        break
+                    number, offset = later[0], len(MAGIC)
+                    continue
+
+                file = self.open_reader(number)
+                file.seek(offset)
+                length, crc, count = RECORD.unpack(file.read(RECORD.size))
+                data = file.read(length)
+                offset += RECORD.size + length
+
+                if len(data) == length and zlib.crc32(data) == crc:
+                    points += json.loads(zlib.decompress(data))
+
+            # Reaching the end with nothing to show means the spool is empty
+            if not points:
+                self.points = 0
+                self.update_metrics()
+
+            return points, (self.cursor, (number, offset), len(points))
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # commit() - Consumes everything read() returned
+    # ------------------------------------------------------------------------------
+    def commit(self, position):
+
+        start, end, count = position
+
+        with self.mutex:
+
+            self.committed += count
+
+            if self.cursor == start:
+                self.cursor = end
+                self.points -= count
+
+            # The oldest segments were evicted while the points were being delivered,
+            # so some of them have already been taken off the count.  Count again
+            elif end[0] in self.segments:
+                self.cursor = max(self.cursor, end)
+                self.file.flush()
+                self.points = sum(self.count_points(number, self.cursor[1] if number == self.cursor[0] else len(MAGIC))
+                                  for number in self.segments if number >= self.cursor[0])
+
+            # Delete every fully consumed segment except the one we're appending to
+            for number in [n for n in self.segments if n < self.cursor[0]]:
+                self.remove_segment(number)
+
+            self.save_cursor()
+            self.update_metrics()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # sync() - Forces everything appended so far onto the disk
+    # ------------------------------------------------------------------------------
+    def sync(self):
+        with self.mutex:
+            if self.unsynced:
+                self.sync_locked()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # close() - Syncs and closes the spool.  Whatever is left in it is picked up by
+    #           the next open()
+    # ------------------------------------------------------------------------------
+    def close(self):
+
+        with self.mutex:
+
+            if self.file is None:
+                return
+
+            self.sync_locked()
+            self.file.close()
+            self.file = None
+            if self.reader is not None:
+                self.reader[1].close()
+                self.reader = None
+
+            # Don't leave an empty segment behind
+            number = max(self.segments)
+            if self.segments[number] == len(MAGIC):
+                self.remove_segment(number)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # stats() - Returns the counters as a dictionary
+    # ------------------------------------------------------------------------------
+    def stats(self):
+        with self.mutex:
+            return {'points': self.points, 'bytes': self.bytes, 'segments': len(self.segments),
+                    'appended': self.appended, 'committed': self.committed,
+                    'evicted': self.evicted, 'corrupt': self.corrupt}
+    # ------------------------------------------------------------------------------
+
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # From here on down are methods that are private to this class.  Callers hold the mutex
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+    # <><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><><>
+
+    # ------------------------------------------------------------------------------
+    # path() - Returns the path of a segment file, or of a glob pattern
+    # ------------------------------------------------------------------------------
+    def path(self, number):
+        name = number if isinstance(number, str) else f'{number:08d}'
+        return os.path.join(self.directory, f'{name}.spool')
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # current() - Returns the number of the segment being appended to
+    # ------------------------------------------------------------------------------
+    def current(self):
+        return next(reversed(self.segments))
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # next_segment() - Syncs and closes the current segment and starts another
+    # ------------------------------------------------------------------------------
+    def next_segment(self):
+
+        if self.file is not None:
+            self.sync_locked()
+            self.file.close()
+
+        number = self.current() + 1 if self.segments else self.cursor[0]
+        self.file = open(self.path(number), 'wb')
+        self.file.write(MAGIC)
+        self.segments[number] = len(MAGIC)
+        self.bytes += len(MAGIC)
+        self.sync_locked()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # sync_locked() - Flushes and fsync()s the current segment
+    # ------------------------------------------------------------------------------
+    def sync_locked(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_sync = time.monotonic()
+        self.unsynced = False
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # scan() - Walks the records of a segment from "offset", checking each one
+    #
+    # Returns: (points in the good records, offset just past the last good record)
+    # ------------------------------------------------------------------------------
+    def scan(self, number, offset):
+
+        points = 0
+        with open(self.path(number), 'rb') as file:
+
+            if file.read(len(MAGIC)) != MAGIC:
+                return 0, 0
+
+            file.seek(offset)
+            while True:
+                header = file.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                length, crc, count = RECORD.unpack(header)
+                data = file.read(length)
+                if len(data) < length or zlib.crc32(data) != crc:
+                    break
+                points += count
+                offset += RECORD.size + length
+
+        return points, offset
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # count_points() - Adds up the point counts of a segment's records from
+    #                  "offset", reading only their headers
+    # ------------------------------------------------------------------------------
+    def count_points(self, number, offset):
+
+        points = 0
+        with open(self.path(number), 'rb') as file:
+            while offset < self.segments[number]:
+                file.seek(offset)
+                length, _, count = RECORD.unpack(file.read(RECORD.size))
+                points += count
+                offset += RECORD.size + length
+
+        return points
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # evict_oldest() - Throws away the oldest segment and whatever unread points it
+    #                  held
+    # ------------------------------------------------------------------------------
+    def evict_oldest(self):
+
+        number = next(iter(self.segments))
+        start = self.cursor[1] if number == self.cursor[0] else len(MAGIC)
+        lost = self.count_points(number, start)
+
+        self.remove_segment(number)
+        self.points -= lost
+        self.evicted += lost
+        SPOOL_EVICTED.inc(lost)
+
+        # If the reader was in that segment, it carries on from the next one
+        if self.cursor[0] <= number:
+            self.cursor = (next(iter(self.segments)), len(MAGIC))
+            self.save_cursor()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # remove_segment() - Deletes a segment file
+    # ------------------------------------------------------------------------------
+    def remove_segment(self, number):
+
+        if self.reader is not None and self.reader[0] == number:
+            self.reader[1].close()
+            self.reader = None
+
+        self.bytes -= self.segments.pop(number)
+        os.remove(self.path(number))
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # open_reader() - Returns a file open for reading the given segment
+    # ------------------------------------------------------------------------------
+    def open_reader(self, number):
+
+        if self.reader is None or self.reader[0] != number:
+            if self.reader is not None:
+                self.reader[1].close()
+            self.reader = (number, open(self.path(number), 'rb'))
+
+        return self.reader[1]
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # load_cursor() - Reads the saved cursor, or points at the start of the oldest
+    #                 segment if there isn't a usable one
+    # ------------------------------------------------------------------------------
+    def load_cursor(self, numbers):
+
+        try:
+            with open(os.path.join(self.directory, 'cursor'), 'rb') as file:
+                number, offset = CURSOR.unpack(file.read(CURSOR.size))
+            if number in numbers:
+                return number, offset
+        except (OSError, struct.error):
+            pass
+
+        return (numbers[0] if numbers else 0), len(MAGIC)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # save_cursor() - Atomically replaces the saved cursor
+    # ------------------------------------------------------------------------------
+    def save_cursor(self):
+        path = os.path.join(self.directory, 'cursor')
+        with open(path + '.tmp', 'wb') as file:
+            file.write(CURSOR.pack(*self.cursor))
+        os.replace(path + '.tmp', path)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # update_metrics() - Publishes the spool's depth
+    # ------------------------------------------------------------------------------
+    def update_metrics(self):
+        SPOOL_POINTS.set(self.points)
+        SPOOL_BYTES.set(self.bytes)
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
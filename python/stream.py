@@ -0,0 +1,156 @@
+# ==========================================================================================================
+# stream.py - Pushes decoded telemetry to live subscribers, for the /stream Server-Sent-Events endpoint
+# ==========================================================================================================
+import collections
+import json
+import threading
+import time
+import metrics
+
+STREAM_EVENTS  = metrics.counter('stream_events_total', 'Telemetry events published to live subscribers')
+STREAM_DROPPED = metrics.counter('stream_dropped_events_total', 'Events dropped because a subscriber fell behind')
+
+
+# ==========================================================================================================
+# Subscriber - One client's view of the stream: its filters and a bounded buffer of waiting events
+#
+# If the client reads more slowly than events arrive, the oldest waiting events are dropped and
+# counted, and the client is told how many it missed.  Publishing never waits for a subscriber.
+# ==========================================================================================================
+class Subscriber:
+
+    nodes     = None  # Frozenset of node IDs wanted, or None for all
+    devices   = None  # Frozenset of device names wanted (e.g. 'BORC'), or None for all
+    buffer    = None  # deque of encoded events waiting to be sent
+    condition = None  # Protects "buffer" and "missed", and wakes the client's thread
+    missed    = 0     # Events dropped since the client last read
+
+    # ------------------------------------------------------------------------------
+    # Constructor
+    # ------------------------------------------------------------------------------
+    def __init__(self, nodes, devices, max_events):
+        self.nodes     = None if nodes is None else frozenset(nodes)
+        self.devices   = None if devices is None else frozenset(devices)
+        self.buffer    = collections.deque(maxlen = max_events)
+        self.condition = threading.Condition()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # wants() - True if this subscriber wants events from this node and device
+    # ------------------------------------------------------------------------------
+    def wants(self, node_id, device):
+        return (self.nodes is None or node_id in self.nodes) and (self.devices is None or device in self.devices)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # put() - Adds an encoded event, dropping the oldest if the buffer is full
+    # ------------------------------------------------------------------------------
+    def put(self, event):
+        with self.condition:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.missed += 1
+                STREAM_DROPPED.inc()
+            self.buffer.append(event)
+            self.condition.notify()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # get() - Waits up to "timeout" seconds for events
+    #
+    # Returns: The waiting events as one block of bytes, preceded by a "dropped"
+    #          event if any were missed, or b'' if the timeout expired
+    # ------------------------------------------------------------------------------
+    def get(self, timeout):
+        with self.condition:
+            if not self.buffer:
+                self.condition.wait(timeout)
+            events = list(self.buffer)
+            self.buffer.clear()
+            missed, self.missed = self.missed, 0
+
+        if missed:
+            events.insert(0, f'event: dropped\ndata: {{"count":{missed}}}\n\n'.encode())
+
+        return b''.join(events)
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# TelemetryHub - Fans each decoded telemetry point out to every subscriber that wants it
+#
+# The ingest loop calls publish() for every point.  With no subscribers that costs one check; with
+# subscribers, the point is encoded once and appended to each matching buffer.
+# ==========================================================================================================
+class TelemetryHub:
+
+    max_subscribers = 0     # Most subscribers at once
+    max_events      = 0     # Size of each subscriber's buffer
+    subscribers     = None  # Tuple of Subscriber, replaced (never modified) when it changes
+    sequence        = 0     # ID of the last event published
+    mutex           = None  # Serialises subscribe() and unsubscribe()
+
+    # ------------------------------------------------------------------------------
+    # Constructor
+    # ------------------------------------------------------------------------------
+    def __init__(self, max_subscribers = 64, max_events = 256):
+        self.max_subscribers = max_subscribers
+        self.max_events      = max_events
+        self.subscribers     = ()
+        self.mutex           = threading.Lock()
+        metrics.gauge('stream_subscribers', 'Clients connected to /stream', lambda: len(self.subscribers))
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # subscribe() - Adds a subscriber.  "nodes" and "devices" are collections to
+    #               filter on, or None for everything
+    #
+    # Returns: The Subscriber, or None if there are already too many
+    # ------------------------------------------------------------------------------
+    def subscribe(self, nodes = None, devices = None):
+
+        subscriber = Subscriber(nodes, devices, self.max_events)
+
+        with self.mutex:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            self.subscribers += (subscriber,)
+
+        return subscriber
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # unsubscribe() - Removes a subscriber
+    # ------------------------------------------------------------------------------
+    def unsubscribe(self, subscriber):
+        with self.mutex:
+            self.subscribers = tuple(s for s in self.subscribers if s is not subscriber)
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # publish() - Sends a decoded point to every subscriber that wants it.  Stamps
+    #             the point's time, if it has none, so the stream and the database
+    #             agree on it
+    # ------------------------------------------------------------------------------
+    def publish(self, node_id, device, point):
+
+        subscribers = self.subscribers
+        if not subscribers:
+            return
+
+        event = None
+        for subscriber in subscribers:
+            if subscriber.wants(node_id, device):
+                if event is None:
+                    self.sequence += 1
+                    point.setdefault('time', time.time_ns())
+                    data = json.dumps({'node_id': node_id, 'device': device, 'tags': point['tags'],
+                                       'fields': point['fields'], 'time': point['time']},
+                                      separators = (',', ':'))
+                    event = f'id: {self.sequence}\nevent: telemetry\ndata: {data}\n\n'.encode()
+                    STREAM_EVENTS.inc()
+                subscriber.put(event)
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
@@ -0,0 +1,172 @@
+# ==========================================================================================================
+# telemetry_codecs.py - Declarative decoders for the payloads that nodes send us
+#
+# Each kind of payload is described by a table of fields.  The table is compiled once into a
+# struct.Struct for decoding single packets, and into a NumPy structured dtype for decoding a whole
+# batch of packets in one vectorised pass.  NumPy is only needed for batch decoding; without it
+# decode_batch() falls back to decoding the packets one at a time.
+# ==========================================================================================================
+import struct
+
+TAG   = 'tag'     # The field is stored as an InfluxDB tag
+FIELD = 'field'   # The field is stored as an InfluxDB field
+SKIP  = None      # The field is decoded but not stored
+
+
+# ==========================================================================================================
+# TelemetryCodec - A compiled payload layout
+#
+# "layout" is a list of (name, struct format character, scale, role) tuples, in payload order.  If
+# scale is not None the raw integer is divided by it.  role is TAG, FIELD or SKIP.
+# ==========================================================================================================
+class TelemetryCodec:
+
+    name     = None  # A human-readable name for log messages
+    layout   = None  # The layout we were built from
+    struct   = None  # Compiled struct.Struct for the whole layout
+    size     = 0     # Number of payload bytes the layout covers
+    tags     = None  # List of (index, name, scale) for tag fields
+    fields   = None  # List of (index, name, scale) for measurement fields
+    offsets  = None  # Dictionary of field name -> (byte offset, struct.Struct) within the payload
+    np_dtype = None  # NumPy structured dtype, built on first use
+
+    # ------------------------------------------------------------------------------
+    # Constructor - Compiles the layout
+    # ------------------------------------------------------------------------------
+    def __init__(self, name, layout):
+        self.name   = name
+        self.layout = tuple(layout)
+        self.struct = struct.Struct('<' + ''.join(fmt for _, fmt, _, _ in self.layout))
+        self.size   = self.struct.size
+        self.tags   = [(i, n, scale) for i, (n, _, scale, role) in enumerate(self.layout) if role == TAG]
+        self.fields = [(i, n, scale) for i, (n, _, scale, role) in enumerate(self.layout) if role == FIELD]
+
+        self.offsets = {}
+        prefix = '<'
+        for name, fmt, _, _ in self.layout:
+            self.offsets[name] = (struct.calcsize(prefix), struct.Struct('<' + fmt))
+            prefix += fmt
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # decode() - Decodes one payload
+    #
+    # Returns: (tags, fields) dictionaries, or None if the payload is too short
+    # ------------------------------------------------------------------------------
+    def decode(self, data):
+
+        if len(data) < self.size:
+            return None
+
+        values = self.struct.unpack_from(data)
+        tags   = {name : scaled(values[i], scale) for i, name, scale in self.tags}
+        fields = {name : scaled(values[i], scale) for i, name, scale in self.fields}
+        return tags, fields
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # peek() - Returns the raw value of one field without decoding the rest, or None
+    #          if the layout has no such field or the payload is too short
+    # ------------------------------------------------------------------------------
+    def peek(self, data, name):
+
+        entry = self.offsets.get(name)
+        if entry is None or len(data) < self.size:
+            return None
+
+        offset, field = entry
+        return field.unpack_from(data, offset)[0]
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # decode_batch() - Decodes a list of payloads in one pass
+    #
+    # Returns: A list with one (tags, fields) tuple per payload, in the same order,
+    #          with None in place of any payload that was too short
+    # ------------------------------------------------------------------------------
+    def decode_batch(self, payloads):
+
+        try:
+            import numpy
+        except ImportError:
+            return [self.decode(data) for data in payloads]
+
+        # Short payloads can't take part in the vectorised decode
+        usable = [i for i, data in enumerate(payloads) if len(data) >= self.size]
+        results = [None] * len(payloads)
+        if not usable:
+            return results
+
+        # Lay the fixed-size part of every payload end to end and view it as records
+        records = numpy.frombuffer(b''.join(bytes(payloads[i][:self.size]) for i in usable), dtype = self.dtype())
+
+        # Convert (and scale) a whole column at a time
+        tag_columns   = [(name, column(records, name, scale)) for _, name, scale in self.tags]
+        field_columns = [(name, column(records, name, scale)) for _, name, scale in self.fields]
+
+        for row, i in enumerate(usable):
+            tags   = {name : values[row] for name, values in tag_columns}
+            fields = {name : values[row] for name, values in field_columns}
+            results[i] = (tags, fields)
+
+        return results
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # dtype() - Returns the NumPy structured dtype equivalent to our struct
+    # ------------------------------------------------------------------------------
+    def dtype(self):
+
+        if self.np_dtype is None:
+            import numpy
+            self.np_dtype = numpy.dtype([(name, '<' + fmt) for name, fmt, _, _ in self.layout])
+
+        return self.np_dtype
+    # ------------------------------------------------------------------------------
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# scaled() - Applies a scale factor to a single raw value
+# ==========================================================================================================
+def scaled(value, scale):
+    return value if scale is None else value / scale
+# ==========================================================================================================
+
+# ==========================================================================================================
+# column() - Extracts one column of a record array as a list of Python numbers, scaled
+# ==========================================================================================================
+def column(records, name, scale):
+    values = records[name]
+    if scale is not None:
+        values = values / scale
+    return values.tolist()
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# The registry of telemetry codecs, keyed by (device_type, telemetry_version).  A telemetry_version
+# of None is the codec used for any version of that device type that has no entry of its own.
+# ==========================================================================================================
+codecs = {}
+
+def register(device_type, telemetry_version, codec):
+    codecs[(device_type, telemetry_version)] = codec
+
+def lookup(device_type, telemetry_version = None):
+    return codecs.get((device_type, telemetry_version)) or codecs.get((device_type, None))
+
+# ==========================================================================================================
+# guess_device_type() - Returns the device type whose telemetry payload is exactly "length" bytes
+#                       long or, failing that, the one device type whose payload fits in "length"
+#                       bytes (newer firmware may append fields), or None if neither is unique
+# ==========================================================================================================
+def guess_device_type(length):
+
+    matches = {device_type for (device_type, _), codec in codecs.items() if codec.size == length}
+    if not matches:
+        matches = {device_type for (device_type, _), codec in codecs.items() if codec.size <= length}
+
+    return matches.pop() if len(matches) == 1 else None
+# ==========================================================================================================
@@ -0,0 +1,106 @@
+# ==========================================================================================================
+# test_batching.py - Drives MoteinoGateway against the emulator, with and without SP_BATCH support
+#
+#     python3 -m pytest test_batching.py
+# ==========================================================================================================
+import time
+import pytest
+import moteinogw
+from framer import build_frame
+from emulator import GatewayEmulator, Faults, make_nodes
+
+NODE_COUNT     = 20
+DOWNLINK_COUNT = 200
+UPLINK_SECONDS = 2.0
+
+
+# ==========================================================================================================
+# session() - A powered-up emulator, batching or not, and a MoteinoGateway that has tried to
+#             negotiate batches with it
+#
+# Returns: (gateway, emulator, nodes, what negotiate_batching() returned)
+# ==========================================================================================================
+@pytest.fixture(params = [True, False], ids = ['batching firmware', 'pre-batching firmware'])
+def session(request):
+
+    nodes = make_nodes(NODE_COUNT, interval = 0.2)
+    emulator = GatewayEmulator(nodes, Faults(burst_size = 30, burst_every = 0.25), boot_delay = 0.2,
+                               batching_supported = request.param)
+    emulator.start()
+
+    gw = moteinogw.MoteinoGateway()
+    gw.startup(emulator.path)
+
+    # Power up, and ask for batches
+    assert gw.wait_for_message(5) is not None, 'no SP_ALIVE'
+    assert gw.init_radio(915, 1, 10)
+    assert gw.set_encryption_key(b'1234123412341234')
+    negotiated = gw.negotiate_batching()
+
+    yield gw, emulator, nodes, negotiated
+
+    # Stop the gateway's reader thread before the pty it reads goes away
+    gw.close()
+    emulator.stop()
+# ==========================================================================================================
+
+
+def test_negotiation(session):
+    gw, emulator, _, negotiated = session
+    assert negotiated == emulator.batching_supported
+    assert gw.batching == emulator.batching_supported
+
+
+def test_every_packet_delivered_both_ways(session):
+
+    gw, emulator, nodes, negotiated = session
+
+    # Host to gateway: everything is delivered, in batches if they were negotiated
+    result = gw.bulk_send_radio_packets([(node.node_id, bytes((2, 0, 72))) for node in nodes] *
+                                        (DOWNLINK_COUNT // NODE_COUNT))
+    assert result['failed'] == 0
+    assert emulator.radio_tx == result['sent'] == DOWNLINK_COUNT
+    assert (gw.batches_sent > 0) == negotiated
+
+    # Gateway to host: every radio packet arrives intact
+    received = []
+    deadline = time.monotonic() + UPLINK_SECONDS
+    while time.monotonic() < deadline:
+        received += gw.drain_messages(timeout_seconds = .1)
+
+    # Power the emulator down, then collect what was still on the wire
+    emulator.stopping = True
+    emulator.join()
+    time.sleep(.2)
+    received += gw.drain_messages(timeout_seconds = .1)
+
+    node_ids = {node.node_id for node in nodes}
+    assert all(isinstance(packet, moteinogw.RadioPacket) for packet in received)
+    assert all(packet.src_node in node_ids and len(packet.data) > 0 for packet in received)
+    assert len(received) == emulator.radio_rx - emulator.tx_batched
+    assert (gw.batches_received > 0) == negotiated
+
+
+def test_malformed_sub_packet():
+
+    gw = moteinogw.MoteinoGateway()
+    gw.create_notification_pipe()
+
+    # Two good sub-packets, then one whose length runs off the end of the frame
+    good = [moteinogw.RADIO_HEADER.pack(100 + i, 1, -60) + bytes((1, 1, i)) for i in range(2)]
+    subs = b''.join(bytes((len(sub) + moteinogw.SUB_HEADER_SIZE, gw.SP_FROM_RADIO)) + sub for sub in good)
+    bad = bytes((40, gw.SP_FROM_RADIO)) + moteinogw.RADIO_HEADER.pack(102, 1, -60)
+    frame = build_frame(gw.SP_BATCH, subs + bad)
+
+    gw.dispatch_batch(memoryview(frame))
+    packets = gw.drain_messages(timeout_seconds = 1)
+
+    # The bad packet is in the control lane, so it comes out first
+    assert isinstance(packets[0], moteinogw.BadPacket)
+    assert packets[0].raw_packet == bad
+    assert [(packet.src_node, bytes(packet.data)) for packet in packets[1:]] == [(100, b'\x01\x01\x00'),
+                                                                                 (101, b'\x01\x01\x01')]
+    assert gw.batches_received == 1
+    assert gw.batched_received == 2
+
+    gw.close()
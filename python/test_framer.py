@@ -0,0 +1,176 @@
+# ==========================================================================================================
+# test_framer.py - Feeds StreamFramer clean and corrupted byte streams
+#
+#     python3 -m pytest test_framer.py
+# ==========================================================================================================
+import random
+from crc16 import fast_crc16
+from framer import StreamFramer, build_frame
+
+SP_READY      = 0x02
+SP_FROM_RADIO = 0x07
+
+
+# ==========================================================================================================
+# random_frames() - Returns "count" radio frames with random payloads
+# ==========================================================================================================
+def random_frames(rng, count):
+    return [build_frame(SP_FROM_RADIO, bytes(rng.getrandbits(8) for _ in range(rng.randint(6, 60))))
+            for _ in range(count)]
+# ==========================================================================================================
+
+# ==========================================================================================================
+# run() - Feeds "stream" to a framer in random-sized chunks of up to "max_chunk" bytes, then skips
+#         stalled bytes the way the reader thread does when the line goes quiet
+#
+# Returns: The framer, and the list of frames it produced
+# ==========================================================================================================
+def run(stream, rng = None, on_discard = None, max_chunk = 40):
+
+    rng = rng or random.Random(1)
+    framer = StreamFramer(on_discard)
+    output = []
+
+    position = 0
+    while position < len(stream):
+        size = rng.randint(1, max_chunk)
+        framer.feed(stream[position:position + size])
+        position += size
+        output += [bytes(frame) for frame in framer.frames()]
+
+    while framer.pending():
+        framer.skip_stalled()
+        output += [bytes(frame) for frame in framer.frames()]
+
+    return framer, output
+# ==========================================================================================================
+
+# ==========================================================================================================
+# is_subsequence() - True if every item of "wanted" appears in "output", in order
+# ==========================================================================================================
+def is_subsequence(wanted, output):
+    remaining = iter(output)
+    return all(any(item == candidate for candidate in remaining) for item in wanted)
+# ==========================================================================================================
+
+
+def test_clean_stream():
+    frames = random_frames(random.Random(2), 200)
+    framer, output = run(b''.join(frames))
+    assert output == frames
+    assert framer.frames_ok == 200
+    assert framer.bytes_discarded == 0
+    assert framer.resyncs == 0
+
+
+def test_junk_between_frames():
+
+    rng = random.Random(3)
+    frames = random_frames(rng, 100)
+    discarded = []
+
+    # Bytes below the header size can never start a packet, so each run is one resync as long as
+    # it arrives in one read
+    stream = b''
+    junk_bytes = 0
+    for frame in frames:
+        junk = bytes(rng.randrange(4) for _ in range(rng.randint(1, 5)))
+        junk_bytes += len(junk)
+        stream += junk + frame
+
+    framer, output = run(stream, on_discard = lambda junk: discarded.append(bytes(junk)), max_chunk = len(stream))
+    assert output == frames
+    assert framer.bytes_discarded == junk_bytes
+    assert framer.resyncs == 100
+    assert sum(len(junk) for junk in discarded) == junk_bytes
+
+
+def test_random_junk_between_frames():
+
+    rng = random.Random(4)
+    frames = random_frames(rng, 100)
+    stream = b''.join(bytes(rng.getrandbits(8) for _ in range(rng.randint(1, 30))) + frame for frame in frames)
+
+    framer, output = run(stream)
+    assert is_subsequence(frames, output)
+    assert framer.bytes_discarded > 0
+    assert framer.resyncs > 0
+
+
+def test_dropped_bytes():
+
+    rng = random.Random(5)
+    frames = random_frames(rng, 200)
+    damaged = set(rng.sample(range(200), 20))
+
+    stream = b''
+    for index, frame in enumerate(frames):
+        if index in damaged:
+            cut = rng.randrange(len(frame))
+            frame = frame[:cut] + frame[cut + 1:]
+        stream += frame
+
+    framer, output = run(stream)
+    intact = [frame for index, frame in enumerate(frames) if index not in damaged]
+    assert is_subsequence(intact, output)
+    assert framer.resyncs > 0
+    assert framer.bytes_discarded >= sum(len(frames[index]) - 1 for index in damaged)
+
+
+def test_flipped_bits():
+
+    rng = random.Random(6)
+    frames = random_frames(rng, 200)
+    damaged = set(rng.sample(range(200), 20))
+
+    stream = b''
+    for index, frame in enumerate(frames):
+        if index in damaged:
+            frame = bytearray(frame)
+            frame[rng.randrange(1, len(frame))] ^= 1 << rng.randrange(8)
+            frame = bytes(frame)
+        stream += frame
+
+    framer, output = run(stream)
+    intact = [frame for index, frame in enumerate(frames) if index not in damaged]
+    assert is_subsequence(intact, output)
+    assert not any(frame in output for index, frame in enumerate(frames) if index in damaged and frame not in intact)
+    assert framer.bytes_discarded >= sum(len(frames[index]) for index in damaged)
+
+
+def test_false_length_byte_recovers_through_skip_stalled():
+
+    frame = build_frame(SP_FROM_RADIO, b'\x01\x00\x02\x00\xc4\xff' + b'payload')
+    framer = StreamFramer()
+
+    # A stray byte claims a 240-byte packet, so the real one waits behind it
+    framer.feed(b'\xf0' + frame)
+    assert [bytes(f) for f in framer.frames()] == []
+    assert framer.pending() == len(frame) + 1
+
+    # The line goes quiet: the stray byte is dropped and the real packet comes out
+    framer.skip_stalled()
+    assert [bytes(f) for f in framer.frames()] == [frame]
+    assert framer.pending() == 0
+    assert framer.bytes_discarded == 1
+    assert framer.resyncs == 1
+
+
+def test_bare_ack_is_accepted():
+
+    # The firmware's constant ACK has no CRC stamped in it
+    bare_ack = bytes([4, 0, 0, SP_READY])
+    framer, output = run(bare_ack + build_frame(SP_READY, b''))
+    assert output == [bare_ack, build_frame(SP_READY, b'')]
+    assert framer.bytes_discarded == 0
+
+
+def test_bare_header_of_other_types_is_rejected():
+
+    # Only ACK and NAK get away without a CRC
+    bogus = bytes([4, 0, 0, SP_FROM_RADIO])
+    assert fast_crc16(bytes([SP_FROM_RADIO])) != 0
+    frame = build_frame(SP_FROM_RADIO, b'\x01\x00\x02\x00\xc4\xff')
+    framer, output = run(bogus + frame)
+    assert output == [frame]
+    assert framer.bytes_discarded == 4
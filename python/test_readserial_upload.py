@@ -0,0 +1,239 @@
+# ==========================================================================================================
+# test_readserial_upload.py - Exercises the ingest loop's responses and the HTTP API, with the gateway
+#                             and the database stubbed out
+#
+#     python3 -m pytest test_readserial_upload.py
+# ==========================================================================================================
+import concurrent.futures
+import contextlib
+import re
+import struct
+import types
+import pytest
+import moteinogw
+import readserial_upload as ru
+from dedup import DedupWindow
+from downlink import DownlinkMailbox, TASK_REBOOT
+from node_cache import LatestCache
+from aggregator import WindowAggregator
+from node_registry import NodeRegistry
+
+NODE = 12
+
+
+# ==========================================================================================================
+# FakeGateway - Records the radio packets queued for sending, and lets the test decide how each went
+# ==========================================================================================================
+class FakeGateway:
+
+    sent = None  # List of (node ID, payload, timeout, future)
+
+    def __init__(self):
+        self.sent = []
+
+    def send_radio_packet_async(self, node_id, payload, callback = None, timeout = None):
+        future = concurrent.futures.Future()
+        if callback:
+            future.add_done_callback(callback)
+        self.sent.append((node_id, payload, timeout, future))
+        return future
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# StubPipeline - Stands in for the worker processes, keeping what the reader hands them
+# ==========================================================================================================
+class StubPipeline:
+
+    submitted = None  # List of (node ID, frame, device type)
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, node_id, frame, device_type):
+        self.submitted.append((node_id, frame, device_type))
+
+    def flush(self):
+        pass
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# gateway() - Gives the module a FakeGateway, and a fresh mailbox and dedup window
+# ==========================================================================================================
+@pytest.fixture
+def gateway(monkeypatch):
+    gw = FakeGateway()
+    monkeypatch.setattr(ru, 'gw', gw, raising = False)
+    monkeypatch.setattr(ru, 'dedup', DedupWindow())
+    monkeypatch.setattr(ru, 'mailbox', DownlinkMailbox(ru.TYPE_RESPONSE_PACKET, setpoint = 72, manual_index = 0,
+                                                       network_id = 10, node_id = 2,
+                                                       encryption_key = b'1234123412341234'))
+    return gw
+# ==========================================================================================================
+
+# ==========================================================================================================
+# telemetry() - A BORC telemetry RadioPacket from NODE with the given transaction ID and temperature
+# ==========================================================================================================
+def telemetry(transaction_id, temperature = 22.5, node = NODE):
+    payload = struct.pack('<BBBBBBHHHH', ru.TYPE_TELEMETRY_PACKET, 1, 72, 3, 0, transaction_id,
+                          4000, int(temperature * 100), 3300, 1500)
+    return moteinogw.RadioPacket(bytes(moteinogw.PACKET_HEADER_SIZE) + moteinogw.RADIO_HEADER.pack(node, 1, -60)
+                                 + payload)
+# ==========================================================================================================
+
+# ==========================================================================================================
+# respond() - Runs a packet through respond_once()
+# ==========================================================================================================
+def respond(packet):
+    return ru.respond_once(packet, ru.telemetry_codecs.lookup(ru.TYPE_BORC_DEVICE))
+# ==========================================================================================================
+
+# ==========================================================================================================
+# tasks() - The tasks_bit_field of a response
+# ==========================================================================================================
+def tasks(response):
+    return response[1]
+# ==========================================================================================================
+
+
+def test_failed_response_delivers_its_commands_once(gateway):
+
+    ru.mailbox.reboot(NODE)
+
+    # The response carrying the reboot can't be sent
+    assert respond(telemetry(7))
+    assert tasks(gateway.sent[0][1]) == TASK_REBOOT
+    gateway.sent[0][3].set_result(False)
+
+    # The node retransmits: it gets an answer, but not the reboot, which is back in the mailbox
+    assert not respond(telemetry(7))
+    assert tasks(gateway.sent[1][1]) == 0
+    gateway.sent[1][3].set_result(True)
+
+    # The reboot goes out with the node's next transaction, and only there
+    assert respond(telemetry(8))
+    assert tasks(gateway.sent[2][1]) == TASK_REBOOT
+    gateway.sent[2][3].set_result(True)
+    assert not respond(telemetry(7))
+    assert tasks(gateway.sent[3][1]) == 0
+    assert ru.mailbox.peek(NODE) is None
+
+
+def test_sent_response_is_repeated_to_a_retransmission(gateway):
+
+    ru.mailbox.reboot(NODE)
+    assert respond(telemetry(7))
+
+    # While the gateway hasn't sent it, a retransmission doesn't get the commands
+    assert not respond(telemetry(7))
+    assert tasks(gateway.sent[1][1]) == 0
+
+    # Once it has, the node missed it, so gets the same response again
+    gateway.sent[0][3].set_result(True)
+    assert not respond(telemetry(7))
+    assert gateway.sent[2][1] == gateway.sent[0][1]
+    assert ru.mailbox.peek(NODE) is None
+
+
+
+@pytest.mark.parametrize('reboot', ['false', 'no', 1, 0, None, [], {}])
+def test_mailbox_reboot_must_be_a_boolean(gateway, reboot):
+    response = ru.app.test_client().post(f'/mailbox/{NODE}', json = {'setpoint': 70, 'reboot': reboot})
+    assert response.status_code == 400
+    assert ru.mailbox.peek(NODE) is None
+
+
+@pytest.mark.parametrize('reboot, expected', [(True, TASK_REBOOT), (False, 0)])
+def test_mailbox_reboot(gateway, reboot, expected):
+    response = ru.app.test_client().post(f'/mailbox/{NODE}', json = {'setpoint': 70, 'reboot': reboot})
+    assert response.status_code == 200
+    assert ru.mailbox.peek(NODE)['tasks_bit_field'] & TASK_REBOOT == expected
+
+
+# ==========================================================================================================
+# StubPool - Stands in for the InfluxDB pool, answering LAST() queries over the rows it was given the
+#            way InfluxDB does: one selector reports when its value was written, several report the
+#            start of the time range
+# ==========================================================================================================
+class StubPool:
+
+    RANGE_START = 1000  # What InfluxDB reports as the time of a row with several selectors
+
+    points  = None  # {node ID: [(time, {field: value})]}
+    queries = None  # Every query asked
+
+    def __init__(self, points):
+        self.points  = points
+        self.queries = []
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self
+
+    def query(self, query, bind_params = None, epoch = None):
+        self.queries.append(query)
+        selects = re.findall(r'LAST\("(\w+)"\) AS "(\w+)"', query)
+        result = []
+        for node, points in self.points.items():
+            row = {}
+            for column, field in selects:
+                written = [(time, values[column]) for time, values in points if column in values]
+                if written:
+                    row['time'], row[field] = max(written)
+            if row:
+                if len(selects) > 1:
+                    row['time'] = self.RANGE_START
+                result.append((('node_data', {'node_id': str(node)}), [row]))
+        return types.SimpleNamespace(items = lambda: result)
+
+# ==========================================================================================================
+
+
+def test_latest_from_database_has_the_time_of_the_reading(monkeypatch):
+
+    stub = StubPool({NODE: [(5000, {'temperature': 21.0, 'humidity': 40.0}), (5060, {'temperature': 21.5})]})
+    monkeypatch.setattr(ru, 'pool', stub)
+    monkeypatch.setattr(ru, 'latest', LatestCache(ru.latest.fields))
+
+    reading = ru.query_latest([NODE], ['temperature', 'humidity'])['nodes'][str(NODE)]
+    assert reading['values'] == {'temperature': 21.5, 'humidity': 40.0}
+    assert reading['timestamp'] == 5060
+    assert all(query.count('LAST(') == 1 for query in stub.queries)
+
+
+def test_latest_from_database_reads_aggregated_fields_from_the_summaries(monkeypatch):
+
+    stub = StubPool({NODE: [(5040, {'temperature_last': 21.5, 'humidity': 40.0})]})
+    monkeypatch.setattr(ru, 'pool', stub)
+    monkeypatch.setattr(ru, 'latest', LatestCache(ru.latest.fields))
+    monkeypatch.setattr(ru, 'aggregator', WindowAggregator(ru.latest.fields, 60, raw_fields = ['humidity']))
+
+    reading = ru.query_latest([NODE], ['temperature', 'humidity'])['nodes'][str(NODE)]
+    assert reading['values'] == {'temperature': 21.5, 'humidity': 40.0}
+    assert [query.split(' WHERE ')[0] for query in stub.queries] == [
+        'SELECT LAST("temperature_last") AS "temperature" FROM node_data_aggregate',
+        'SELECT LAST("humidity") AS "humidity" FROM node_data']
+
+
+def test_pipeline_keeps_the_latest_readings_current(gateway, monkeypatch, tmp_path):
+
+    registry = NodeRegistry(str(tmp_path / 'nodes.db'))
+    registry.open()
+    monkeypatch.setattr(ru, 'registry', registry)
+    monkeypatch.setattr(ru, 'latest', LatestCache(ru.latest.fields))
+    monkeypatch.setattr(ru, 'pipeline', StubPipeline())
+
+    # An earlier request for the node missed the cache, and seeded it from the database
+    ru.latest.update(NODE, {'temperature': 19.0}, 5000)
+
+    client = ru.app.test_client()
+    for transaction_id, temperature in [(1, 21.0), (2, 23.5)]:
+        ru.route_burst([telemetry(transaction_id, temperature)])
+        assert client.get(f'/thermal/{NODE}').get_json()['temperature'] == temperature
+
+    assert len(ru.pipeline.submitted) == 2
+    assert registry.last_seen[NODE] > 5000
+    registry.close()
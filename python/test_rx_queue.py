@@ -0,0 +1,174 @@
+# ==========================================================================================================
+# test_rx_queue.py - Overfills MoteinoGateway's receive queue, through a fake serial port, under each
+#                    overflow policy
+#
+#     python3 -m pytest test_rx_queue.py
+# ==========================================================================================================
+import threading
+import time
+import pytest
+import moteinogw
+from framer import build_frame
+from rx_queue import DROP_OLDEST, DROP_NEWEST, COALESCE
+
+CAPACITY = 10   # High water is 8 packets, and re-arms below 4
+
+
+# ==========================================================================================================
+# FakeSerial - Just enough of serial.Serial for the gateway's reader thread, fed from the test
+# ==========================================================================================================
+class FakeSerial:
+
+    timeout   = None  # Seconds read() waits for data, set by the reader thread
+    buffer    = None  # Bytes waiting to be read
+    condition = None  # Protects "buffer" and wakes read()
+
+    # ------------------------------------------------------------------------------
+    # Constructor
+    # ------------------------------------------------------------------------------
+    def __init__(self):
+        self.buffer    = bytearray()
+        self.condition = threading.Condition()
+    # ------------------------------------------------------------------------------
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+
+    # ------------------------------------------------------------------------------
+    # feed() - Makes bytes available to read()
+    # ------------------------------------------------------------------------------
+    def feed(self, data):
+        with self.condition:
+            self.buffer += data
+            self.condition.notify()
+    # ------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------
+    # read() - Returns up to "size" bytes, or b'' if none arrive within the timeout
+    # ------------------------------------------------------------------------------
+    def read(self, size = 1):
+        with self.condition:
+            if not self.buffer:
+                self.condition.wait(self.timeout)
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+    # ------------------------------------------------------------------------------
+
+    def write(self, data):
+        return len(data)
+
+# ==========================================================================================================
+
+
+# ==========================================================================================================
+# radio() - An SP_FROM_RADIO frame from "node", whose payload is "sequence"
+# ==========================================================================================================
+def radio(node, sequence):
+    return build_frame(moteinogw.MoteinoGateway.SP_FROM_RADIO,
+                       moteinogw.RADIO_HEADER.pack(node, 1, -60) + bytes([sequence]))
+# ==========================================================================================================
+
+# ==========================================================================================================
+# echo() - An SP_ECHO reply, which goes in the control lane
+# ==========================================================================================================
+def echo(payload):
+    return build_frame(moteinogw.MoteinoGateway.SP_ECHO, payload)
+# ==========================================================================================================
+
+# ==========================================================================================================
+# deliver() - Sends frames through the fake port, followed by a marker echo, and waits until the
+#             reader thread has queued the marker, and so everything before it
+# ==========================================================================================================
+def deliver(gw, port, frames, marker):
+
+    port.feed(b''.join(frames) + echo(marker))
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with gw.mutex:
+            if any(packet.payload == marker for packet in gw.queue.control):
+                return
+        time.sleep(.005)
+
+    raise AssertionError('the reader thread never queued the marker')
+# ==========================================================================================================
+
+# ==========================================================================================================
+# gateway() - A started MoteinoGateway on a FakeSerial, and the list its high-water callback appends to
+# ==========================================================================================================
+@pytest.fixture(params = [DROP_OLDEST, DROP_NEWEST, COALESCE])
+def gateway(request):
+
+    port = FakeSerial()
+    high_water = []
+    gw = moteinogw.MoteinoGateway(rx_capacity = CAPACITY, rx_policy = request.param,
+                                  on_high_water = lambda gw: high_water.append(len(gw.queue.data)))
+    gw.startup(port, wait_for_quiet = False)
+
+    yield gw, port, high_water
+
+    gw.close()
+    assert not gw.is_alive()
+# ==========================================================================================================
+
+
+def test_overflow(gateway):
+
+    gw, port, high_water = gateway
+    policy = gw.queue.policy
+
+    # Five nodes take turns sending 30 packets, with an echo reply arriving behind them
+    packets = [(100 + i % 5, i) for i in range(30)]
+    deliver(gw, port, [radio(node, sequence) for node, sequence in packets] + [echo(b'reply')], b'first')
+
+    stats = gw.queue.stats()
+    assert stats['data'] == CAPACITY
+    assert stats['control'] == 2
+
+    if policy == DROP_OLDEST:
+        assert stats['dropped_oldest'] == 20
+        kept = packets[-CAPACITY:]
+    elif policy == DROP_NEWEST:
+        assert stats['dropped_newest'] == 20
+        kept = packets[:CAPACITY]
+    else:
+        assert stats['coalesced'] == 20
+        assert stats['dropped_oldest'] == 0
+        kept = packets[-CAPACITY:]
+
+    # The queue climbed past high water once, and stayed there
+    assert high_water == [8]
+    assert stats['high_water_hits'] == 1
+
+    # Control packets come out ahead of the radio packets that arrived before them
+    drained = gw.drain_messages(3, 1)
+    assert [packet.payload for packet in drained[:2]] == [b'reply', b'first']
+    assert drained[2].src_node == kept[0][0]
+
+    drained += gw.drain_messages(None, 1)
+    assert [(packet.src_node, packet.data[0]) for packet in drained[2:]] == kept
+
+    # Having drained below low water, the next climb past high water is reported again
+    deliver(gw, port, [radio(200 + i, i) for i in range(CAPACITY)], b'second')
+    assert high_water == [8, 8]
+    assert gw.queue.high_water_hits == 2
+
+
+def test_high_water_rearms_only_below_low_water(gateway):
+
+    gw, port, high_water = gateway
+
+    deliver(gw, port, [radio(100 + i, i) for i in range(8)], b'first')
+    assert high_water == [8]
+
+    # Draining to 4 packets isn't below low water, so climbing back doesn't report
+    gw.drain_messages(5, 1)
+    deliver(gw, port, [radio(200 + i, i) for i in range(4)], b'second')
+    assert high_water == [8]
+
+    # Draining to 3 is
+    gw.drain_messages(6, 1)
+    deliver(gw, port, [radio(300 + i, i) for i in range(5)], b'third')
+    assert high_water == [8, 8]